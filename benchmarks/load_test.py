@@ -0,0 +1,381 @@
+#!/usr/bin/env python
+"""End-to-end load test of the web app and the Celery workers.
+
+Starts the stub WBM (see stub_wbm.py) serving a synthetic corpus, the web app
+with gunicorn and Celery workers configured to use it and a local Redis, then
+sends a mix of `/calculate-simhash`, `/job` and `/simhash` requests from
+`--clients` threads for `--duration` seconds:
+
+    python benchmarks/load_test.py --urls 200 --captures 50-500 \\
+        --content-types text/html=0.9,application/pdf=0.1 --error-rate 0.01 \\
+        --duration 300 -o load.json
+
+It reports the jobs per hour, captures per second, web latency percentiles per
+endpoint and the Redis memory, as JSON. With `--compare`, it exits with an
+error if the throughput is lower or the p99 latency higher than a previous
+run by more than `--threshold`.
+
+Simhash data, the Celery broker and the result backend use databases 11, 12
+and 13 of `--redis`, which are flushed before the run unless `--keep-data` is
+given.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timezone
+
+import urllib3
+import yaml
+from redis import StrictRedis
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+# pylint: disable=wrong-import-position
+from stub_wbm import add_corpus_arguments, parse_weights, server_from_args
+from wayback_discover_diff.util import job_progress
+
+# Databases of `--redis` used by the load test.
+SIMHASH_DB = 11
+BROKER_DB = 12
+BACKEND_DB = 13
+# Requests of `--mix`.
+REQUESTS = ('calculate', 'job', 'simhash')
+
+
+def percentile(values, fraction):
+    """Return the `fraction` (0-1) percentile of `values` or None.
+    """
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(int(fraction * len(values)), len(values) - 1)]
+
+
+def write_config(args, stub, path):
+    """Write the conf.yml of the web app and the workers: the example config
+    using the stub WBM and the load test Redis databases.
+    """
+    with open(os.path.join(ROOT, 'wayback_discover_diff', 'conf.yml.example')) as example:
+        cfg = yaml.safe_load(example)
+    redis = args.redis.rstrip('/')
+    cfg['redis']['url'] = '%s/%d' % (redis, SIMHASH_DB)
+    cfg['celery'].update(broker_url='%s/%d' % (redis, BROKER_DB),
+                         result_backend='%s/%d' % (redis, BACKEND_DB))
+    cfg['upstream'].update(cdx={'endpoints': [stub]},
+                           playback={'endpoints': [stub]},
+                           maxsize=args.threads)
+    cfg['threads'] = args.threads
+    cfg['snapshots']['number_per_year'] = args.snapshots
+    # no statsd server and less logging
+    cfg['statsd'] = {'host': '127.0.0.1', 'port': 8125}
+    cfg['logging']['root']['level'] = 'WARNING'
+    for logger in cfg['logging'].get('loggers', {}).values():
+        logger['level'] = 'WARNING'
+    with open(path, 'w') as out:
+        yaml.safe_dump(cfg, out)
+
+
+def start_services(args, conf, log_dir):
+    """Start gunicorn and the Celery workers, return the processes.
+    """
+    env = dict(os.environ, WAYBACK_DISCOVER_DIFF_CONF=conf)
+    commands = []
+    if not args.web_url:
+        commands.append(('web', [
+            sys.executable, '-m', 'gunicorn', '--workers', str(args.web_workers),
+            '--threads', str(args.web_threads), '-b', args.bind,
+            'wayback_discover_diff.wsgi:APP']))
+    for i in range(args.workers):
+        commands.append(('worker%d' % i, [
+            sys.executable, '-m', 'celery', '-A', 'wayback_discover_diff.worker.CELERY',
+            'worker', '--concurrency', str(args.concurrency), '-n', 'load%d@%%h' % i,
+            '--without-gossip', '--without-mingle', '-l', 'warning']))
+    processes = []
+    for name, command in commands:
+        log = open(os.path.join(log_dir, '%s.log' % name), 'w')
+        processes.append(subprocess.Popen(command, env=env, cwd=ROOT,
+                                          stdout=log, stderr=subprocess.STDOUT))
+    return processes
+
+
+def wait_ready(http, web_url, timeout=30):
+    """Wait until the web app answers.
+    """
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            if http.request('GET', web_url + '/', retries=False).status == 200:
+                return
+        except urllib3.exceptions.HTTPError:
+            pass
+        time.sleep(0.5)
+    raise RuntimeError('web app at %s is not ready' % web_url)
+
+
+class LoadGenerator:
+    """Send a weighted mix of requests from several threads and record their
+    latencies and the jobs they start.
+    """
+
+    def __init__(self, http, web_url, urls, years, mix, think=0):
+        self.http = http
+        self.web_url = web_url
+        self.urls = urls
+        self.years = years
+        self.mix = mix
+        self.think = think
+        self.latencies = {name: [] for name in REQUESTS}
+        self.errors = {name: 0 for name in REQUESTS}
+        # job_id -> start time of the jobs started by the load test
+        self.pending = {}
+        self.finished = {}
+        self.failed = set()
+        self._lock = threading.Lock()
+
+    def request(self, name, path, fields):
+        started = time.perf_counter()
+        try:
+            response = self.http.request('GET', self.web_url + path, fields=fields)
+            data = json.loads(response.data.decode('utf-8'))
+            ok = response.status == 200
+        except (urllib3.exceptions.HTTPError, ValueError):
+            (data, ok) = ({}, False)
+        elapsed = time.perf_counter() - started
+        with self._lock:
+            self.latencies[name].append(elapsed)
+            if not ok:
+                self.errors[name] += 1
+        return data if isinstance(data, dict) else {}
+
+    def calculate(self, rnd):
+        data = self.request('calculate', '/calculate-simhash',
+                            {'url': rnd.choice(self.urls),
+                             'year': rnd.choice(self.years)})
+        job_id = data.get('job_id')
+        if job_id:
+            with self._lock:
+                if job_id not in self.finished:
+                    self.pending.setdefault(job_id, time.time())
+
+    def job(self, rnd):
+        with self._lock:
+            jobs = list(self.pending)
+        if not jobs:
+            self.simhash(rnd)
+            return
+        job_id = rnd.choice(jobs)
+        data = self.request('job', '/job', {'job_id': job_id})
+        self.job_status(job_id, data.get('status'))
+
+    def job_status(self, job_id, status):
+        if status in ('SUCCESS', 'error'):
+            with self._lock:
+                started = self.pending.pop(job_id, None)
+                if started is not None:
+                    self.finished[job_id] = time.time() - started
+                    if status == 'error':
+                        self.failed.add(job_id)
+
+    def simhash(self, rnd):
+        self.request('simhash', '/simhash', {'url': rnd.choice(self.urls),
+                                             'year': rnd.choice(self.years),
+                                             'page': 1})
+
+    def client(self, seed, deadline):
+        rnd = random.Random(seed)
+        names = list(self.mix)
+        weights = list(self.mix.values())
+        while time.time() < deadline:
+            getattr(self, rnd.choices(names, weights)[0])(rnd)
+            if self.think:
+                time.sleep(self.think)
+
+    def run(self, clients, duration):
+        deadline = time.time() + duration
+        threads = [threading.Thread(target=self.client, args=(i, deadline))
+                   for i in range(clients)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def drain(self, timeout, interval=1):
+        """Poll the pending jobs until they finish or `timeout` seconds.
+        """
+        deadline = time.time() + timeout
+        while self.pending and time.time() < deadline:
+            for job_id in list(self.pending):
+                data = self.request('job', '/job', {'job_id': job_id})
+                self.job_status(job_id, data.get('status'))
+            time.sleep(interval)
+
+
+def report(args, load, redis, wbm, elapsed):
+    """Return the results of the run.
+    """
+    captures = 0
+    for job_id in load.finished:
+        progress = job_progress(redis, job_id) or {}
+        captures += sum(progress.get(counter, 0)
+                        for counter in ('cached', 'hashed', 'failed'))
+    completed = len(load.finished) - len(load.failed)
+    requests = {}
+    for name, latencies in load.latencies.items():
+        requests[name] = {'count': len(latencies), 'errors': load.errors[name],
+                          'p50': percentile(latencies, 0.5),
+                          'p99': percentile(latencies, 0.99)}
+    latencies = [value for values in load.latencies.values() for value in values]
+    memory = redis.info('memory')
+    durations = list(load.finished.values())
+    return {
+        'meta': {'date': datetime.now(timezone.utc).isoformat(),
+                 'python': platform.python_version(),
+                 'platform': platform.platform(),
+                 'args': vars(args)},
+        'elapsed': elapsed,
+        'jobs': {'started': len(load.finished) + len(load.pending),
+                 'completed': completed, 'failed': len(load.failed),
+                 'unfinished': len(load.pending),
+                 'per_hour': completed * 3600 / elapsed,
+                 'duration_p50': percentile(durations, 0.5),
+                 'duration_p99': percentile(durations, 0.99)},
+        'captures': {'processed': captures, 'per_sec': captures / elapsed},
+        'web': {'requests': len(latencies),
+                'per_sec': len(latencies) / elapsed,
+                'p50': percentile(latencies, 0.5),
+                'p99': percentile(latencies, 0.99),
+                'endpoints': requests},
+        'redis': {'used_memory': memory['used_memory'],
+                  'used_memory_peak': memory['used_memory_peak'],
+                  'keys': redis.dbsize()},
+        'wbm': dict(wbm.stats),
+    }
+
+
+def compare(results, baseline, threshold):
+    """Print the change of the main metrics vs `baseline` and return the
+    names of those worse by more than `threshold` (e.g. 0.1 for 10%).
+    """
+    regressions = []
+    # (name, value getter, higher is better)
+    metrics = [('jobs_per_hour', lambda r: r['jobs']['per_hour'], True),
+               ('captures_per_sec', lambda r: r['captures']['per_sec'], True),
+               ('web_p99', lambda r: r['web']['p99'], False)]
+    for name, get, higher in metrics:
+        (base, value) = (get(baseline), get(results))
+        if not base or value is None:
+            continue
+        change = value / base - 1
+        flag = ''
+        if (-change if higher else change) > threshold:
+            regressions.append(name)
+            flag = '  REGRESSION'
+        print('%-20s %12.3f -> %12.3f %+7.1f%%%s' % (
+            name, base, value, change * 100, flag), file=sys.stderr)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--redis', default='redis://localhost:6379',
+                        help='Redis server, without database')
+    parser.add_argument('--keep-data', action='store_true',
+                        help='do not flush the load test databases first')
+    parser.add_argument('--web-url', help='use this running web app instead of '
+                        'starting gunicorn')
+    parser.add_argument('--bind', default='127.0.0.1:8097')
+    parser.add_argument('--web-workers', type=int, default=2)
+    parser.add_argument('--web-threads', type=int, default=4)
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Celery worker processes to start, 0 to use running workers')
+    parser.add_argument('--concurrency', type=int, default=2,
+                        help='concurrency of each Celery worker')
+    parser.add_argument('--threads', type=int, default=8,
+                        help='download threads of each job')
+    parser.add_argument('--snapshots', type=int, default=-1,
+                        help='max captures per year (default: all)')
+    parser.add_argument('--urls', type=int, default=50,
+                        help='number of distinct URLs requested')
+    parser.add_argument('--years', default='2019',
+                        help='comma separated years requested')
+    parser.add_argument('--mix', type=parse_weights,
+                        default={'calculate': 1, 'job': 4, 'simhash': 5},
+                        help='request weights (default: calculate=1,job=4,simhash=5)')
+    parser.add_argument('--clients', type=int, default=8)
+    parser.add_argument('--think', type=float, default=0,
+                        help='seconds between the requests of a client')
+    parser.add_argument('--duration', type=float, default=60)
+    parser.add_argument('--drain', type=float, default=60,
+                        help='max seconds to wait for the pending jobs at the end')
+    parser.add_argument('--log-dir', help='logs of the web app and workers '
+                        '(default: a temporary directory)')
+    parser.add_argument('-o', '--output', help='write JSON results to this file')
+    parser.add_argument('--compare', help='JSON results of a previous run to compare with')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='max allowed regression vs --compare (default: 0.1)')
+    add_corpus_arguments(parser)
+    args = parser.parse_args()
+    unknown = set(args.mix) - set(REQUESTS)
+    if unknown:
+        parser.error('unknown requests in --mix: %s' % ', '.join(sorted(unknown)))
+
+    redis_url = args.redis.rstrip('/')
+    redis = StrictRedis.from_url('%s/%d' % (redis_url, SIMHASH_DB),
+                                 decode_responses=True)
+    if not args.keep_data:
+        for db in (SIMHASH_DB, BROKER_DB, BACKEND_DB):
+            StrictRedis.from_url('%s/%d' % (redis_url, db)).flushdb()
+
+    log_dir = args.log_dir or tempfile.mkdtemp(prefix='wdd-load-')
+    conf = os.path.join(log_dir, 'conf.yml')
+    wbm = server_from_args(args).start()
+    write_config(args, 'http://%s:%d' % wbm.server_address, conf)
+    processes = start_services(args, conf, log_dir)
+    web_url = (args.web_url or 'http://' + args.bind).rstrip('/')
+    http = urllib3.PoolManager(maxsize=args.clients,
+                               timeout=urllib3.Timeout(connect=5, read=60))
+    try:
+        wait_ready(http, web_url)
+        urls = ['http://site%d.example.com/' % i for i in range(args.urls)]
+        years = [int(year) for year in args.years.split(',')]
+        load = LoadGenerator(http, web_url, urls, years, args.mix, args.think)
+        started = time.time()
+        load.run(args.clients, args.duration)
+        load.drain(args.drain)
+        results = report(args, load, redis, wbm, time.time() - started)
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait()
+        wbm.shutdown()
+        wbm.server_close()
+    print('logs in %s' % log_dir, file=sys.stderr)
+
+    if args.output:
+        with open(args.output, 'w') as out:
+            json.dump(results, out, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+
+    if args.compare:
+        with open(args.compare) as base:
+            regressions = compare(results, json.load(base), args.threshold)
+        if regressions:
+            print('regressions: %s' % ', '.join(regressions), file=sys.stderr)
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
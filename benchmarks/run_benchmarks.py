@@ -0,0 +1,346 @@
+#!/usr/bin/env python
+"""Benchmarks of the capture processing pipeline.
+
+Run all benchmarks and write the results as JSON:
+
+    python benchmarks/run_benchmarks.py -o results.json
+
+Compare with the results of a previous release and exit with an error if any
+benchmark is slower by more than `--threshold`:
+
+    python benchmarks/run_benchmarks.py --compare baseline.json
+
+Use `-k` to select benchmarks by name substring and `--redis-url` to run the
+Redis benchmarks against a local Redis instead of an in-memory fake.
+"""
+import argparse
+import base64
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'tests'))
+
+# pylint: disable=wrong-import-position
+import mock
+from stub_wbm import StubWBM, make_captures, make_page
+from test_util import StubRedis
+from wayback_discover_diff.discover import (Discover, extract_html_features,
+    calculate_simhash, custom_hash_function, pack_simhash_to_bytes)
+from wayback_discover_diff import hamming
+from wayback_discover_diff.columnar import encode_captures
+from wayback_discover_diff.util import (compress_captures, year_simhash,
+                                        handle_results)
+
+
+BENCHMARKS = {}
+
+
+def benchmark(name):
+    """Register a benchmark. The decorated function does the setup and
+    returns the callable to time.
+    """
+    def register(func):
+        BENCHMARKS[name] = func
+        return func
+    return register
+
+
+def get_redis(args):
+    """Return a client of the local Redis in `--redis-url` or an empty
+    in-memory stub, the one of the tests.
+    """
+    if args.redis_url:
+        from redis import StrictRedis
+        return StrictRedis.from_url(args.redis_url, decode_responses=True)
+    redis = StubRedis()
+    redis.clear()
+    return redis
+
+
+def sample_captures(count, year=2019):
+    """Return `count` captures `[timestamp, simhash]` as stored in Redis.
+    """
+    captures = []
+    for timestamp, _, page_seed in make_captures(year, count, duplicates=0.7):
+        captures.append([timestamp, '%044x' % page_seed])
+    return captures
+
+
+@benchmark('extract_html_features')
+def bench_extract_html_features(args):
+    page = make_page(1, args.page_size)
+    return lambda: extract_html_features(page)
+
+
+def bench_simhash_size(size):
+    def setup(args):
+        features = extract_html_features(make_page(1, args.page_size))
+        return lambda: calculate_simhash(features, size,
+                                         hashfunc=custom_hash_function)
+    return setup
+
+
+for SIZE in (64, 128, 256, 512):
+    benchmark('calculate_simhash[%d]' % SIZE)(bench_simhash_size(SIZE))
+
+
+@benchmark('pack_simhash_to_bytes')
+def bench_pack_simhash_to_bytes(args):
+    features = extract_html_features(make_page(1, args.page_size))
+    simhash = calculate_simhash(features, 256, hashfunc=custom_hash_function)
+    return lambda: pack_simhash_to_bytes(simhash, 256)
+
+
+@benchmark('compress_captures')
+def bench_compress_captures(args):
+    captures = sample_captures(args.captures)
+    return lambda: compress_captures(captures)
+
+
+@benchmark('encode_captures[json]')
+def bench_encode_json(args):
+    captures = sample_captures(args.captures)
+    return lambda: json.dumps({'captures': captures})
+
+
+@benchmark('encode_captures[columnar]')
+def bench_encode_columnar(args):
+    captures = sample_captures(args.captures)
+    return lambda: encode_captures(captures, 2019)
+
+
+def hamming_hashes(args, size=256):
+    rnd = random.Random(1)
+    return [base64.b64encode(rnd.getrandbits(size).to_bytes(size // 8, 'little'))
+            for _ in range(args.hamming_count)]
+
+
+@benchmark('decode_simhashes')
+def bench_decode_simhashes(args):
+    simhashes = hamming_hashes(args)
+    return lambda: hamming.decode_simhashes(simhashes)
+
+
+def bench_pairwise(size, popcount):
+    def setup(args):
+        hashes = hamming.decode_simhashes(hamming_hashes(args, size))
+
+        def run():
+            with mock.patch.object(hamming, '_popcount', popcount):
+                hamming.pairwise(hashes)
+        return run
+    return setup
+
+
+# N x N comparisons, with np.bitwise_count if available and the lookup table
+for SIZE in (64, 256, 512):
+    benchmark('hamming_pairwise[%d]' % SIZE)(bench_pairwise(SIZE, hamming._popcount))
+benchmark('hamming_pairwise[256,lookup]')(
+    bench_pairwise(256, hamming.lookup_popcount))
+
+
+@benchmark('hamming_consecutive')
+def bench_consecutive(args):
+    hashes = hamming.decode_simhashes(hamming_hashes(args))
+    return lambda: hamming.consecutive(hashes)
+
+
+@benchmark('hamming_python[consecutive]')
+def bench_python_consecutive(args):
+    values = [int.from_bytes(base64.b64decode(simhash), 'little')
+              for simhash in hamming_hashes(args)]
+    return lambda: [bin(a ^ b).count('1') for a, b in zip(values, values[1:])]
+
+
+@benchmark('year_simhash')
+def bench_year_simhash(args):
+    redis = get_redis(args)
+    url = 'http://benchmark.example.com/year'
+    redis.delete('com,example,benchmark)/year')
+    redis.hmset('com,example,benchmark)/year', dict(sample_captures(args.captures)))
+    return lambda: year_simhash(redis, url, 2019)
+
+
+@benchmark('handle_results[page]')
+def bench_handle_results(args):
+    redis = get_redis(args)
+    url = 'http://benchmark.example.com/page'
+    captures = sample_captures(args.captures)
+    redis.delete('com,example,benchmark)/page')
+    redis.hmset('com,example,benchmark)/page', dict(captures))
+    timestamps = [timestamp for timestamp, _ in captures]
+    return lambda: handle_results(redis, timestamps, url, 600, 2)
+
+
+@benchmark('discover_run')
+@contextmanager
+def bench_discover_run(args):
+    captures = make_captures(2019, args.run_captures, duplicates=0.5)
+    with StubWBM(captures, page_size=args.page_size) as server:
+        yield discover_run(args, server)
+
+
+def discover_run(args, server):
+    """Return a function running a `Discover` job against the stub WBM
+    `server`.
+    """
+    from celery import Celery
+    cfg = {
+        'simhash': {'size': 256, 'expire_after': 86400},
+        'redis': {'url': args.redis_url or 'redis://localhost:6379/1',
+                  'decode_responses': True},
+        'threads': args.threads,
+        'snapshots': {'number_per_year': -1, 'number_per_page': 600},
+    }
+    host, port = server.server_address
+    stub = 'http://%s:%d' % (host, port)
+    cfg['upstream'] = {'maxsize': args.threads, 'cdx': {'endpoints': [stub]},
+                       'playback': {'endpoints': [stub]}}
+    task = Discover(cfg)
+    task.redis = get_redis(args)
+    app = Celery('benchmarks', broker='memory://', backend='cache+memory://')
+    app.register_task(task)
+    return lambda: task.apply(args=['http://benchmark.example.com/', 2019,
+                                    time.time()]).get()
+
+
+def bench_startup(module):
+    def setup(args):
+        root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+        env = dict(os.environ, WAYBACK_DISCOVER_DIFF_CONF=os.path.join(
+            root, 'wayback_discover_diff', 'conf.yml.example'))
+        command = [sys.executable, '-c', 'import %s' % module]
+        return lambda: subprocess.run(command, env=env, cwd=root, check=True)
+    return setup
+
+
+# Time to import the web and worker entry points in a new interpreter.
+benchmark('startup[web]')(bench_startup('wayback_discover_diff.wsgi'))
+benchmark('startup[worker]')(bench_startup('wayback_discover_diff.worker'))
+
+
+@contextmanager
+def as_context(bench):
+    """Yield the function returned by the setup of a benchmark, or by the
+    context manager it returned to release its resources afterwards.
+    """
+    if hasattr(bench, '__enter__'):
+        with bench as func:
+            yield func
+    else:
+        yield bench
+
+
+def measure(func, repeat, min_time):
+    """Time `func` like `timeit`: calibrate the number of loops to take at
+    least `min_time` seconds, then take `repeat` samples. Return per call
+    statistics in seconds.
+    """
+    loops = 1
+    while True:
+        started = time.perf_counter()
+        for _ in range(loops):
+            func()
+        elapsed = time.perf_counter() - started
+        if elapsed >= min_time:
+            break
+        loops = max(loops * 2, int(loops * min_time / max(elapsed, 1e-9)))
+    samples = [elapsed / loops]
+    for _ in range(repeat - 1):
+        started = time.perf_counter()
+        for _ in range(loops):
+            func()
+        samples.append((time.perf_counter() - started) / loops)
+    return {'min': min(samples), 'median': statistics.median(samples),
+            'mean': statistics.mean(samples),
+            'stdev': statistics.stdev(samples) if len(samples) > 1 else 0.0,
+            'loops': loops, 'repeat': repeat}
+
+
+def compare(results, baseline, threshold):
+    """Print the change of each benchmark vs `baseline` and return the names
+    of those slower by more than `threshold` (e.g. 0.1 for 10%).
+    """
+    regressions = []
+    for name, stats in results['benchmarks'].items():
+        base = baseline['benchmarks'].get(name)
+        if not base:
+            continue
+        change = stats['min'] / base['min'] - 1
+        flag = ''
+        if change > threshold:
+            regressions.append(name)
+            flag = '  REGRESSION'
+        print('%-28s %12.6fs -> %12.6fs %+7.1f%%%s' % (
+            name, base['min'], stats['min'], change * 100, flag),
+              file=sys.stderr)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-k', dest='select', help='run benchmarks matching this substring')
+    parser.add_argument('-o', '--output', help='write JSON results to this file')
+    parser.add_argument('--compare', help='JSON results of a previous run to compare with')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='max allowed slowdown vs --compare (default: 0.1)')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--min-time', type=float, default=0.2,
+                        help='min duration of each sample in seconds')
+    parser.add_argument('--redis-url', help='use this Redis instead of a fake')
+    parser.add_argument('--page-size', type=int, default=20000)
+    parser.add_argument('--captures', type=int, default=20000,
+                        help='captures per year for the Redis/compress benchmarks')
+    parser.add_argument('--run-captures', type=int, default=200,
+                        help='captures served by the stub WBM for discover_run')
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--hamming-count', type=int, default=10000,
+                        help='simhashes compared N x N by hamming_pairwise')
+    args = parser.parse_args()
+
+    results = {
+        'meta': {
+            'date': datetime.now(timezone.utc).isoformat(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'args': vars(args),
+        },
+        'benchmarks': {},
+    }
+    for name, setup in BENCHMARKS.items():
+        if args.select and args.select not in name:
+            continue
+        with as_context(setup(args)) as func:
+            stats = measure(func, args.repeat, args.min_time)
+        results['benchmarks'][name] = stats
+        print('%-28s %12.6fs (median %.6fs, %d loops)' % (
+            name, stats['min'], stats['median'], stats['loops']), file=sys.stderr)
+
+    if args.output:
+        with open(args.output, 'w') as out:
+            json.dump(results, out, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+
+    if args.compare:
+        with open(args.compare) as base:
+            regressions = compare(results, json.load(base), args.threshold)
+        if regressions:
+            print('regressions: %s' % ', '.join(regressions), file=sys.stderr)
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
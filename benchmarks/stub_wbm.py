@@ -0,0 +1,360 @@
+"""Local stub of the Wayback Machine endpoints used by `Discover`, serving a
+synthetic corpus:
+
+- `/web/timemap` returns one line per capture with the requested CDX fields.
+- `/web/<timestamp>id_/<url>` returns a synthetic HTML page, or a binary
+  payload for captures of other content types.
+
+The corpus is either a fixed list of captures served for any URL or a
+`Corpus` generating the captures of each URL and year on demand, with
+configurable capture counts, digest duplication, content types and payload
+sizes. The server can add latency and fail a fraction of the requests.
+
+Used by the benchmarks and the load test to run the whole capture processing
+pipeline without hitting web.archive.org. It can also run on its own, e.g. for
+workers on other hosts (set their `upstream` endpoints to it):
+
+    python benchmarks/stub_wbm.py --port 8099 --captures 100-1000 \
+        --content-types text/html=0.9,application/pdf=0.1 --latency 0.05
+"""
+import argparse
+import hashlib
+import random
+import threading
+import time
+from datetime import datetime, timedelta
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+from surt import surt
+
+
+WORDS = ['archive', 'wayback', 'machine', 'capture', 'simhash', 'digest',
+         'internet', 'library', 'books', 'music', 'video', 'software',
+         'texts', 'images', 'collection', 'donate', 'search', 'about',
+         'contact', 'blog', 'projects', 'help', 'terms', 'privacy', 'news',
+         'events', 'people', 'web', 'page', 'site', 'link', 'home', 'today',
+         'update', 'version', 'release', 'history', 'world', 'data', 'open']
+
+
+def make_page(seed, size=20000):
+    """Return a synthetic HTML page of about `size` bytes. The same `seed`
+    always produces the same page.
+    """
+    rnd = random.Random(seed)
+    parts = ['<html><head><title>%s</title>' % ' '.join(rnd.choices(WORDS, k=6)),
+             '<script>var x = "%s";</script>' % ' '.join(rnd.choices(WORDS, k=20)),
+             '<style>body { color: #333; }</style></head><body>',
+             '<nav>%s</nav>' % ''.join('<a href="/%s">%s</a>' % (w, w)
+                                      for w in rnd.choices(WORDS, k=10))]
+    length = sum(len(part) for part in parts)
+    while length < size:
+        tag = rnd.choice(['p', 'div', 'span', 'h2', 'li'])
+        part = '<%s>%s</%s>\n' % (tag, ' '.join(rnd.choices(WORDS, k=30)), tag)
+        parts.append(part)
+        length += len(part)
+    parts.append('<footer>%s</footer></body></html>' % ' '.join(rnd.choices(WORDS, k=8)))
+    return ''.join(parts)
+
+
+def make_captures(year, count, duplicates=0.5, seed=0):
+    """Return a list of `(timestamp, digest, page_seed)` for `count` captures
+    spread over `year`. A `duplicates` fraction of captures reuse the digest
+    and content of a previous capture, like unchanged pages in the WBM.
+    """
+    rnd = random.Random(seed)
+    captures = []
+    start = datetime(year, 1, 1)
+    step = 365 * 86400 // max(count, 1)
+    for i in range(count):
+        timestamp = (start + timedelta(seconds=i * step)).strftime('%Y%m%d%H%M%S')
+        if captures and rnd.random() < duplicates:
+            page_seed = rnd.choice(captures)[2]
+        else:
+            page_seed = seed * 1000003 + i
+        digest = hashlib.sha1(str(page_seed).encode()).hexdigest().upper()
+        captures.append((timestamp, digest, page_seed))
+    return captures
+
+
+def parse_weights(value):
+    """Parse `name=weight,...` into a dict, e.g. the content types of a
+    corpus `text/html=0.9,application/pdf=0.1`.
+    """
+    weights = {}
+    for item in value.split(','):
+        if item:
+            name, _, weight = item.partition('=')
+            weights[name.strip()] = float(weight or 1)
+    return weights
+
+
+def url_seed(url):
+    """Return a stable integer seed for `url`.
+    """
+    return int(hashlib.md5(url.encode('utf-8')).hexdigest()[:8], 16)
+
+
+class Corpus:
+    """Synthetic captures of any URL and year. Each URL has between
+    `captures[0]` and `captures[1]` captures per year (or exactly `captures`
+    if it is an int), a `duplicates` fraction of them reuse a previous digest
+    and their content types are drawn from `content_types`, a dict of weights
+    by mimetype. Payloads are `page_size` bytes, or between `page_size[0]`
+    and `page_size[1]`. The same URL and year always produce the same
+    captures.
+    """
+
+    def __init__(self, captures=100, duplicates=0.5, content_types=None,
+                 page_size=20000, seed=0):
+        self.counts = captures if isinstance(captures, (tuple, list)) \
+            else (captures, captures)
+        self.duplicates = duplicates
+        self.content_types = content_types or {'text/html': 1}
+        self.page_sizes = page_size if isinstance(page_size, (tuple, list)) \
+            else (page_size, page_size)
+        self.seed = seed
+
+    def captures(self, url, year):
+        """Return a list of `(timestamp, digest, page_seed, mimetype)`.
+        """
+        # the worker requests the CDX and the captures with different forms
+        # of the URL
+        return self._captures(surt(url), year)
+
+    @lru_cache(maxsize=4096)
+    def _captures(self, urlkey, year):
+        rnd = random.Random(url_seed(urlkey) ^ year ^ self.seed)
+        count = rnd.randint(*self.counts)
+        mimetypes = rnd.choices(list(self.content_types),
+                                list(self.content_types.values()), k=count)
+        # duplicate digests keep the content type of their first capture
+        first = {}
+        return [capture + (first.setdefault(capture[2], mimetype),)
+                for capture, mimetype in zip(
+                    make_captures(year, count, self.duplicates,
+                                  rnd.getrandbits(32)), mimetypes)]
+
+    def capture(self, url, timestamp):
+        """Return the `(page_seed, mimetype)` of the capture of `url` at
+        `timestamp` or None.
+        """
+        for capture in self.captures(url, int(timestamp[:4])):
+            if capture[0] == timestamp:
+                return capture[2:]
+        return None
+
+    def page_size(self, page_seed):
+        """Return the payload size of the capture of `page_seed`.
+        """
+        low, high = self.page_sizes
+        return random.Random(page_seed).randint(low, high)
+
+
+class StaticCorpus(Corpus):
+    """The same list of `(timestamp, digest, page_seed)` text/html captures
+    for every URL and year.
+    """
+
+    def __init__(self, captures, page_size=20000):
+        super().__init__(page_size=page_size)
+        self.static = [capture + ('text/html',) for capture in captures]
+        self.pages = {timestamp: (page_seed, mimetype)
+                      for timestamp, _, page_seed, mimetype in self.static}
+
+    def captures(self, url, year):
+        return self.static
+
+    def capture(self, url, timestamp):
+        return self.pages.get(timestamp)
+
+
+def make_payload(page_seed, size, mimetype):
+    """Return the body of a capture: a synthetic page for text captures, else
+    `size` pseudo-random bytes.
+    """
+    if mimetype.startswith('text/'):
+        return make_page(page_seed, size).encode('utf-8')
+    return random.Random(page_seed).randbytes(size)
+
+
+class StubWBMHandler(BaseHTTPRequestHandler):
+    """Serve the CDX and playback endpoints from `self.server.corpus`.
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        parts = urlsplit(self.path)
+        self.server.delay()
+        if parts.path == '/web/timemap':
+            self.server.count('cdx')
+            self.send_timemap(parse_qs(parts.query))
+        elif parts.path.startswith('/web/') and 'id_/' in parts.path:
+            self.server.count('playback')
+            if self.server.failed():
+                self.server.count('errors')
+                self.send_body(503, 'text/plain', b'service unavailable')
+                return
+            # the captured URL keeps its query string
+            start = self.path.index('id_/')
+            self.send_capture(self.path[start + 4:], self.path[5:start])
+        else:
+            self.send_body(404, 'text/plain', b'not found')
+
+    def send_timemap(self, params):
+        fields = params.get('fl', ['timestamp,digest'])[0].split(',')
+        limit = int(params.get('limit', ['-1'])[0])
+        url = params.get('url', [''])[0]
+        start = params.get('from', ['2019'])[0]
+        end = params.get('to', [start])[0]
+        captures = [capture
+                    for year in range(int(start[:4]), int(end[:4]) + 1)
+                    for capture in self.server.corpus.captures(url, year)
+                    if start <= capture[0][:len(start)] and
+                    capture[0][:len(end)] <= end]
+        if limit != -1:
+            captures = captures[:limit]
+        values = {'statuscode': '200'}
+        lines = []
+        for timestamp, digest, _, mimetype in captures:
+            values.update(timestamp=timestamp, digest=digest, mimetype=mimetype)
+            lines.append(' '.join(values.get(field, '-') for field in fields))
+        self.send_body(200, 'text/plain', '\n'.join(lines).encode('utf-8'))
+
+    def send_capture(self, url, timestamp):
+        capture = self.server.corpus.capture(url, timestamp)
+        if capture is None:
+            self.send_body(404, 'text/plain', b'not found')
+            return
+        page_seed, mimetype = capture
+        if mimetype in ('unk', 'warc/revisit'):
+            # the CDX does not know, the content-type tells
+            mimetype = 'text/html'
+        body = make_payload(page_seed, self.server.corpus.page_size(page_seed),
+                            mimetype)
+        if mimetype.startswith('text/'):
+            mimetype += '; charset=utf-8'
+        self.send_body(200, mimetype, body)
+
+    def send_body(self, status, ctype, body):
+        self.send_response(status)
+        self.send_header('Content-Type', ctype)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        pass
+
+
+class StubWBM(ThreadingHTTPServer):
+    """Stub WBM server running in a background thread. Use as a context
+    manager, the server listens on `self.server_address`.
+
+    `corpus` is a `Corpus` or a list of captures served for any URL. Each
+    request waits `latency` seconds plus up to `jitter` seconds and an
+    `error_rate` fraction of the capture downloads fail with a 503.
+    """
+    daemon_threads = True
+
+    def __init__(self, corpus, page_size=20000, address=('127.0.0.1', 0),
+                 latency=0, jitter=0, error_rate=0):
+        super().__init__(address, StubWBMHandler)
+        if not isinstance(corpus, Corpus):
+            corpus = StaticCorpus(corpus, page_size)
+        self.corpus = corpus
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        # requests served, read by the load test
+        self.stats = {'cdx': 0, 'playback': 0, 'errors': 0}
+        self._lock = threading.Lock()
+        self._random = random.Random(0)
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+
+    def delay(self):
+        """Wait the configured latency.
+        """
+        if self.latency or self.jitter:
+            time.sleep(self.latency + self._random.uniform(0, self.jitter))
+
+    def failed(self):
+        """Return True if the current request should fail.
+        """
+        return self._random.random() < self.error_rate
+
+    def count(self, name):
+        """Count a request in `self.stats`.
+        """
+        with self._lock:
+            self.stats[name] += 1
+
+    def start(self):
+        """Start serving in a background thread.
+        """
+        self._thread.start()
+        return self
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.shutdown()
+        self.server_close()
+
+
+def parse_range(value):
+    """Parse `N` or `LOW-HIGH` into a `(low, high)` tuple of ints.
+    """
+    low, _, high = value.partition('-')
+    return (int(low), int(high or low))
+
+
+def add_corpus_arguments(parser):
+    """Add the options of the corpus and the server to `parser`.
+    """
+    parser.add_argument('--captures', type=parse_range, default=(100, 100),
+                        help='captures per URL and year, N or LOW-HIGH (default: 100)')
+    parser.add_argument('--duplicates', type=float, default=0.5,
+                        help='fraction of captures with the digest of a previous '
+                        'capture (default: 0.5)')
+    parser.add_argument('--content-types', type=parse_weights,
+                        default={'text/html': 1},
+                        help='mimetype weights, e.g. text/html=0.9,application/pdf=0.1')
+    parser.add_argument('--page-size', type=parse_range, default=(20000, 20000),
+                        help='payload bytes, N or LOW-HIGH (default: 20000)')
+    parser.add_argument('--latency', type=float, default=0,
+                        help='seconds added to each request')
+    parser.add_argument('--jitter', type=float, default=0,
+                        help='max random seconds added to the latency')
+    parser.add_argument('--error-rate', type=float, default=0,
+                        help='fraction of capture downloads failing with a 503')
+    parser.add_argument('--seed', type=int, default=0)
+
+
+def server_from_args(args, address=('127.0.0.1', 0)):
+    """Return a `StubWBM` configured by the options of `add_corpus_arguments`.
+    """
+    corpus = Corpus(args.captures, args.duplicates, args.content_types,
+                    args.page_size, args.seed)
+    return StubWBM(corpus, address=address, latency=args.latency,
+                   jitter=args.jitter, error_rate=args.error_rate)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8099)
+    add_corpus_arguments(parser)
+    args = parser.parse_args()
+    server = server_from_args(args, (args.host, args.port))
+    print('serving on http://%s:%d' % server.server_address)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
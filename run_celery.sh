@@ -1,3 +1,3 @@
 #!/usr/bin/env bash
-WAYBACK_DISCOVER_DIFF_CONF=wayback_discover_diff/conf.yml celery -A wayback_discover_diff.application.CELERY worker --without-gossip --without-mingle
+WAYBACK_DISCOVER_DIFF_CONF=wayback_discover_diff/conf.yml celery -A wayback_discover_diff.worker.CELERY worker --without-gossip --without-mingle
 # -l debug
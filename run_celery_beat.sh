@@ -0,0 +1,2 @@
+#!/usr/bin/env bash
+WAYBACK_DISCOVER_DIFF_CONF=wayback_discover_diff/conf.yml celery -A wayback_discover_diff.worker.CELERY beat
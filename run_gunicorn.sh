@@ -10,4 +10,4 @@ OPTS=(
 )
 
 #Run gunicorn
-gunicorn "${OPTS[@]}" wayback_discover_diff.application:APP
+gunicorn "${OPTS[@]}" wayback_discover_diff.wsgi:APP
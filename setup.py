@@ -30,6 +30,12 @@ setup(
         'statsd',
         'surt'
         ],
+    extras_require={
+        # brotli compression of responses
+        'brotli': ['brotli'],
+        # bulk Hamming distances, see hamming.py
+        'hamming': ['numpy'],
+        },
     tests_require=[
         'pytest',
         'mock'
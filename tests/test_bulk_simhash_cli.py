@@ -0,0 +1,115 @@
+import base64
+import gzip
+import mock
+import pytest
+from test_util import StubRedis
+from wayback_discover_diff.bulk_simhash_cli import (iter_warc_records,
+    html_payload, warc_timestamp, dechunk, main)
+
+
+def warc_record(uri, date, http_headers, body, digest, warc_type='response'):
+    block = ('HTTP/1.1 200 OK\r\n%s\r\n\r\n' % '\r\n'.join(http_headers)).encode() + body
+    headers = ('WARC/1.0\r\nWARC-Type: %s\r\nWARC-Target-URI: %s\r\n'
+               'WARC-Date: %s\r\nWARC-Payload-Digest: %s\r\n'
+               'Content-Type: application/http; msgtype=response\r\n'
+               'Content-Length: %d\r\n\r\n' % (warc_type, uri, date, digest,
+                                               len(block)))
+    return headers.encode() + block + b'\r\n\r\n'
+
+
+RECORDS = [
+    warc_record('http://example.com/', '2019-01-03T13:35:11Z',
+                ['Content-Type: text/html'], b'<html><p>hello world</p></html>',
+                'sha1:AAA'),
+    warc_record('http://example.com/logo.png', '2019-01-03T13:35:12Z',
+                ['Content-Type: image/png'], b'\x89PNG', 'sha1:BBB'),
+    warc_record('http://example.com/', '2019-02-03T13:35:11Z',
+                ['Content-Type: text/html; charset=utf-8',
+                 'Transfer-Encoding: chunked'],
+                b'5\r\n<p>hi\r\n5\r\nthere\r\n0\r\n\r\n', 'sha1:CCC'),
+    warc_record('http://example.com/', '2019-03-03T13:35:11Z',
+                ['Content-Type: text/html'], b'<html><p>hello world</p></html>',
+                'sha1:AAA'),
+]
+
+
+@pytest.fixture(params=['plain', 'gz'])
+def warc(request, tmp_path):
+    if request.param == 'gz':
+        path = tmp_path / 'test.warc.gz'
+        path.write_bytes(b''.join(gzip.compress(r) for r in RECORDS))
+    else:
+        path = tmp_path / 'test.warc'
+        path.write_bytes(b''.join(RECORDS))
+    return str(path)
+
+
+def test_iter_warc_records(warc):
+    records = list(iter_warc_records(warc))
+    assert [h['warc-date'] for _, h, _ in records] == [
+        '2019-01-03T13:35:11Z', '2019-01-03T13:35:12Z',
+        '2019-02-03T13:35:11Z', '2019-03-03T13:35:11Z']
+    payloads = [html_payload(h, b) for _, h, b in records]
+    assert payloads[0] == b'<html><p>hello world</p></html>'
+    assert payloads[1] is None
+    assert payloads[2] == b'<p>hithere'
+    # resume from the offset of the third record
+    resumed = list(iter_warc_records(warc, records[2][0]))
+    assert [h['warc-date'] for _, h, _ in resumed] == [
+        '2019-02-03T13:35:11Z', '2019-03-03T13:35:11Z']
+
+
+def test_helpers():
+    assert warc_timestamp('2019-01-03T13:35:11Z') == '20190103133511'
+    assert dechunk(b'3\r\nabc\r\n0\r\n\r\n') == b'abc'
+
+
+def test_main(warc, tmp_path):
+    output = tmp_path / 'out.txt'
+    checkpoint = tmp_path / 'cp.json'
+    args = ['--output', str(output), '--checkpoint', str(checkpoint),
+            '--processes', '1', '--batch-size', '2', warc]
+    main(args)
+    lines = output.read_text().splitlines()
+    assert [line.split(' ')[:2] for line in lines] == [
+        ['com,example)/', '20190103133511'],
+        ['com,example)/', '20190203133511'],
+        ['com,example)/', '20190303133511']]
+    # identical payloads have the same simhash
+    assert lines[0].split(' ')[2] == lines[2].split(' ')[2]
+    # everything is already processed
+    main(args)
+    assert output.read_text().splitlines() == lines
+
+
+@mock.patch('wayback_discover_diff.bulk_simhash_cli.load_config')
+@mock.patch('wayback_discover_diff.bulk_simhash_cli.get_redis')
+def test_main_redis_conf(Redis, load_config, warc):
+    redis = StubRedis()
+    redis.clear()
+    redis.close = mock.Mock()
+    Redis.return_value = redis
+    load_config.return_value = {'redis': {'nodes': ['redis://a', 'redis://b']},
+                                'simhash': {'size': 128, 'extra_sizes': [64]}}
+    main(['--redis-conf', '--processes', '1', warc])
+    # the storage of conf.yml, e.g. sharded nodes
+    Redis.assert_called_once_with({'redis': {'nodes': ['redis://a',
+                                                       'redis://b']}})
+    assert sorted(redis.hkeys('com,example)/')) == [
+        '20190103133511', '20190203133511', '20190303133511']
+    meta = redis.hgetall('{com,example)/}:meta')
+    assert meta['extractor'] == 'unigram:1' and str(meta['size']) == '128'
+    assert meta['extra_sizes'] == '64'
+    # the extra sizes of conf.yml are written as well
+    assert sorted(redis.hkeys('{com,example)/}:64')) == [
+        '20190103133511', '20190203133511', '20190303133511']
+    simhash = redis.hget('com,example)/', '20190103133511')
+    assert len(base64.b64decode(simhash)) == 16
+    extra = redis.hget('{com,example)/}:64', '20190103133511')
+    assert base64.b64decode(extra) == base64.b64decode(simhash)[:8]
+    redis.close.assert_called_once_with()
+
+    # the workers would consider simhashes of other settings stale
+    with pytest.raises(SystemExit):
+        main(['--redis-conf', '--simhash-size', '256', '--processes', '1',
+              warc])
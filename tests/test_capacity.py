@@ -0,0 +1,103 @@
+import json
+import mock
+from amqp.exceptions import ChannelError
+from werkzeug.test import Client
+from werkzeug.wrappers import Response
+from test_util import StubRedis
+
+from wayback_discover_diff.capacity import (Capacity, WorkerStats,
+                                            captures_remaining, get_snapshot,
+                                            job_finished, job_started)
+from wayback_discover_diff.util import progress_key
+from wayback_discover_diff.web import get_app
+
+
+CFG = {
+    'redis': {'url': 'redis://localhost:6379/1', 'decode_responses': True},
+    'celery': {'task_default_queue': 'wayback_discover_diff'},
+    'capacity': {'queues': ['prewarm']},
+    }
+
+
+def test_worker_stats():
+    redis = StubRedis()
+    stats = WorkerStats(threads=8)
+    with stats.downloading():
+        with stats.downloading():
+            assert stats.downloads == 2
+        stats.captures += 10
+        stats.flush(redis)
+    assert stats.downloads == 0
+    values = redis.hgetall('capacity:worker:%s' % stats.name)
+    assert float(values['captures_per_sec']) > 0
+    assert int(values['downloads']) == 1
+    assert int(values['threads']) == 8
+
+
+def test_captures_remaining():
+    redis = StubRedis()
+    pipe = redis.pipeline()
+    job_started(pipe, 'a')
+    job_started(pipe, 'b')
+    job_started(pipe, 'c')
+    pipe.execute()
+    redis.hmset(progress_key('a'), {'total': 100, 'cached': 10, 'hashed': 30,
+                                    'failed': 5})
+    redis.hmset(progress_key('b'), {'total': 20})
+    # c has not loaded its captures yet
+    assert captures_remaining(redis, 3600) == (3, 75)
+    pipe = redis.pipeline()
+    job_finished(pipe, 'a')
+    pipe.execute()
+    assert captures_remaining(redis, 3600) == (2, 20)
+
+
+@mock.patch('wayback_discover_diff.capacity.get_redis')
+def test_capacity(Redis):
+    redis = StubRedis()
+    Redis.return_value = redis
+    pipe = redis.pipeline()
+    job_started(pipe, 'a')
+    pipe.execute()
+    redis.hmset(progress_key('a'), {'total': 100, 'hashed': 40})
+    stats = WorkerStats(threads=4)
+    stats.flush(redis)
+    redis.hmset('capacity:worker:%s' % stats.name, {'captures_per_sec': 2.0})
+
+    def queue_declare(queue, passive):
+        if queue == 'prewarm':
+            raise ChannelError('NOT_FOUND')
+        return (queue, 12, 3)
+
+    task = Capacity(CFG)
+    with mock.patch.object(Capacity, 'app') as app:
+        conn = app.connection_for_read.return_value.__enter__.return_value
+        conn.default_channel.queue_declare.side_effect = queue_declare
+        inspect = app.control.inspect.return_value
+        inspect.active.return_value = {'w1': [{'name': 'Discover'}]}
+        inspect.reserved.return_value = {'w1': [{'name': 'Discover'},
+                                                {'name': 'DiscoverChunk'}]}
+        snapshot = task.run()
+    assert snapshot['queues'] == {
+        'wayback_discover_diff': {'messages': 12, 'consumers': 3},
+        'prewarm': {'messages': 0, 'consumers': 0}}
+    assert snapshot['tasks'] == {'active': {'Discover': 1},
+                                 'reserved': {'Discover': 1, 'DiscoverChunk': 1}}
+    assert snapshot['running_jobs'] == 1
+    assert snapshot['captures_remaining'] == 60
+    assert snapshot['captures_per_sec'] == 2.0
+    assert snapshot['download_threads'] == 4
+    assert snapshot['backlog_seconds'] == 30
+    assert get_snapshot(redis) == snapshot
+
+
+def test_capacity_endpoint():
+    app = get_app({'redis_uri': 'redis://localhost/9'})
+    app.redis = StubRedis()
+    client = Client(app, response_wrapper=Response)
+    data = json.loads(client.get('/capacity').data.decode('utf-8'))
+    assert data == {'status': 'error',
+                    'info': 'capacity metrics are not available.'}
+    app.redis.set('capacity:snapshot', json.dumps({'running_jobs': 2}))
+    data = json.loads(client.get('/capacity').data.decode('utf-8'))
+    assert data == {'running_jobs': 2}
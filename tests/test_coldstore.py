@@ -0,0 +1,104 @@
+import base64
+import pytest
+from test_util import StubRedis
+from wayback_discover_diff.coldstore import ColdStore
+from wayback_discover_diff.util import (range_simhash, simhash_meta,
+                                        timestamp_simhash, year_simhash)
+
+
+def simhash(i):
+    return base64.b64encode(i.to_bytes(8, 'little')).decode('ascii')
+
+
+@pytest.fixture
+def store(tmp_path):
+    return ColdStore(str(tmp_path), 64)
+
+
+def test_append_compact_lookup(store):
+    store.append('com,example)/', {'20140101000000': simhash(1),
+                                   '20150101000000': simhash(2)})
+    store.append('com,other)/', {'2014': None})
+    # many URLs to use more than one block of the sparse index
+    for i in range(1000):
+        store.append('com,example)/%d' % i, {'2014%010d' % i: simhash(i)})
+
+    def check():
+        year = store.year('com,example)/', 2014)
+        assert {k: bytes(v) for k, v in year.items()} == {
+            '20140101000000': (1).to_bytes(8, 'little')}
+        assert store.year('com,other)/', 2014) == {'2014': None}
+        assert store.year('com,other)/', 2015) == {}
+        for i in (0, 255, 256, 999):
+            assert list(store.year('com,example)/%d' % i, 2014)) == ['2014%010d' % i]
+        return year
+
+    year = check()
+    # records appended after a lookup are indexed
+    store.append('com,late)/', {'20140201000000': simhash(4)})
+    assert list(store.year('com,late)/', 2014)) == ['20140201000000']
+    store.append('com,late)/', {'20140201000000': simhash(5)})
+    assert bytes(store.year('com,late)/', 2014)['20140201000000']) == \
+        (5).to_bytes(8, 'little')
+    assert store.compact() == 1004
+    # slices of the previous mapping are still valid
+    assert bytes(year['20140101000000']) == (1).to_bytes(8, 'little')
+    check()
+    # newer appended records override the sorted ones
+    store.append('com,example)/', {'20140101000000': simhash(3)})
+    assert bytes(store.year('com,example)/', 2014)['20140101000000']) == \
+        (3).to_bytes(8, 'little')
+
+
+def test_promote_on_redis_miss(store):
+    store.append('com,cold)/', {'20140101000000': simhash(1),
+                                '20140201000000': simhash(2)})
+    store.append('com,cold)/', {'2015': None})
+    redis = StubRedis()
+    res = year_simhash(redis, 'http://cold.com', 2014, cold=store)
+    assert sorted(res[0]) == [['20140101000000', simhash(1)],
+                              ['20140201000000', simhash(2)]]
+    assert redis.hget('com,cold)/', '20140201000000') == simhash(2)
+    assert year_simhash(redis, 'http://cold.com', 2015, cold=store) == \
+        {'status': 'error', 'message': 'NO_CAPTURES'}
+    assert timestamp_simhash(StubRedis(), 'http://cold.com', '20140101000000',
+                             cold=store) == {'simhash': simhash(1)}
+    assert range_simhash(StubRedis(), 'http://cold.com', '20140115000000',
+                         '20159999999999', 10, cold=store) == \
+        ([['20140201000000', simhash(2)]], None)
+    assert range_simhash(StubRedis(), 'http://cold.com', '20160000000000',
+                         '20169999999999', 10, cold=store) == \
+        {'status': 'error', 'message': 'NOT_CAPTURED'}
+
+
+def test_extractor_signature(tmp_path):
+    meta = simhash_meta({'simhash': {'size': 64}})
+    store = ColdStore(str(tmp_path), 64, meta=meta)
+    store.append('com,cold)/', {'20140101000000': simhash(1)})
+    redis = StubRedis()
+    assert timestamp_simhash(redis, 'http://cold.com', '20140101000000',
+                             cold=store, meta=meta) == {'simhash': simhash(1)}
+    assert redis.hgetall('{com,cold)/}:meta') == meta
+    # simhashes of another extractor are not promoted
+    shingle = simhash_meta({'simhash': {'size': 64, 'extractor': 'shingle'}})
+    store = ColdStore(str(tmp_path), 64, meta=shingle)
+    assert store.year('com,cold)/', 2014) == {}
+    assert year_simhash(StubRedis(), 'http://cold.com', 2014, cold=store,
+                        meta=shingle) == \
+        {'status': 'error', 'message': 'NOT_CAPTURED'}
+
+
+def test_promote_extra_sizes(tmp_path):
+    meta = simhash_meta({'simhash': {'size': 64, 'extra_sizes': [32, 128]}})
+    store = ColdStore(str(tmp_path), 64, meta=meta)
+    store.append('com,cold)/', {'20140101000000': simhash(2 ** 40 + 1)})
+    redis = StubRedis()
+    assert year_simhash(redis, 'http://cold.com', 2014, cold=store,
+                        meta=meta)[0] == [['20140101000000',
+                                           simhash(2 ** 40 + 1)]]
+    # the lower bits of the stored simhash
+    assert redis.hget('{com,cold)/}:32', '20140101000000') == \
+        base64.b64encode((1).to_bytes(4, 'little')).decode('ascii')
+    assert '{com,cold)/}:128' not in redis
+    # the metadata lists the sizes which were restored
+    assert redis.hgetall('{com,cold)/}:meta')['extra_sizes'] == '32'
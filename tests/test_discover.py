@@ -1,8 +1,17 @@
 # -*- coding: utf-8 -*-
+import base64
+import json
+import os
+import sys
 import mock
-from test_util import StubRedis
+import pytest
+from test_util import SAMPLE_META, StubRedis
 from wayback_discover_diff.discover import (extract_html_features,
-    calculate_simhash, custom_hash_function, pack_simhash_to_bytes, Discover)
+    calculate_simhash, custom_hash_function, pack_simhash_to_bytes,
+    split_captures, encode_simhash, Discover, DiscoverChunk, DiscoverFailed,
+    DiscoverFinalize)
+from wayback_discover_diff.prewarm import budget_key, today
+from wayback_discover_diff.util import simhash_meta, year_simhash
 
 
 def test_extract_html_features():
@@ -102,7 +111,7 @@ CFG = {
         }
     }
 
-@mock.patch('wayback_discover_diff.discover.StrictRedis')
+@mock.patch('wayback_discover_diff.discover.get_redis')
 def test_worker_download(Redis):
     Redis.return_value = StubRedis()
     task = Discover(CFG)
@@ -209,3 +218,322 @@ def test_simhash_256():
     assert h.bit_length() == h_size
     h_bytes = pack_simhash_to_bytes(h, h_size)
     assert len(h_bytes) == h_size // 8
+
+
+@mock.patch('wayback_discover_diff.discover.get_redis')
+def test_job_heartbeat(Redis):
+    cfg = dict(CFG, simhash=dict(CFG['simhash'], pending_expire=60))
+    task = Discover(cfg)
+    task.job_id = 'job1'
+    pipe = Redis.return_value.pipeline.return_value
+    task.mark_pending('com,example)/', 2019, 5)
+    # a killed worker does not block new jobs until `job_expire`
+    pipe.set.assert_called_once_with('{com,example)/}:2019:job', 'job1',
+                                     ex=60)
+    pipe.reset_mock()
+    # refreshed even if there is nothing to flush
+    assert task.flush_results('com,example)/', 2019, {}) == 0
+    pipe.expire.assert_any_call('{com,example)/}:2019:job', 60)
+    pipe.expire.assert_any_call('{com,example)/}:2019:pending', 60)
+    pipe.execute.assert_called_once_with()
+
+
+@mock.patch('wayback_discover_diff.discover.get_redis')
+def test_flush_results(Redis):
+    redis = StubRedis()
+    Redis.return_value = redis
+    cfg = dict(CFG, simhash=dict(CFG['simhash'], flush_every=2))
+    task = Discover(cfg)
+    captures = ['2019010%d000000 DIGEST%d' % (i, i) for i in range(1, 6)]
+    html = b'<html><body>some text</body></html>'
+    flushes = []
+
+    def flush_results(urlkey, year, results, extra=None):
+        # the job is pending until the final flush
+        assert redis.hget('{com,example)/}:2019:pending', 'job_id') == 'job1'
+        flushes.append(dict(results))
+        return Discover.flush_results(task, urlkey, year, results, extra)
+
+    with mock.patch.object(task, 'fetch_cdx',
+                           return_value={'status': 'success', 'captures': captures}), \
+            mock.patch.object(task, 'download_capture', return_value=html), \
+            mock.patch.object(task, 'update_state'), \
+            mock.patch.object(task, 'flush_results', side_effect=flush_results), \
+            mock.patch.object(Discover, 'request', mock.Mock(id='job1')):
+        task.run('http://example.com', 2019, 0)
+
+    assert [len(batch) for batch in flushes] == [2, 2, 1]
+    stored = redis.hgetall('com,example)/')
+    assert all(ts in stored for ts, _ in (c.split(' ') for c in captures))
+    # time-ordered index of range queries
+    assert redis.zrangebyscore('{com,example)/}:ts', 20190101000000,
+                               20191231235959) == [c[:14] for c in captures]
+    assert '{com,example)/}:2019:pending' not in redis
+    progress = redis.hgetall('job:job1:progress')
+    assert progress['state'] == 'SUCCESS'
+    assert [int(progress[k]) for k in ('total', 'fetched', 'hashed')] == \
+        [5, 5, 5]
+    # compressed captures are stored when the job is finished
+    compressed = redis.hgetall('{com,example)/}:2019:compressed')
+    assert compressed['total_captures'] == 5
+    assert len(json.loads(compressed['captures'])[0]) == 2
+
+
+@mock.patch('wayback_discover_diff.discover.get_redis')
+def test_failed_run(Redis):
+    redis = StubRedis()
+    Redis.return_value = redis
+    task = Discover(CFG)
+    captures = ['2019010%d000000 DIGEST%d' % (i, i) for i in range(1, 3)]
+    with mock.patch.object(task, 'fetch_cdx',
+                           return_value={'status': 'success', 'captures': captures}), \
+            mock.patch.object(task, 'process_captures',
+                              side_effect=RuntimeError('time limit')), \
+            mock.patch.object(Discover, 'request', mock.Mock(id='job6')):
+        with pytest.raises(RuntimeError):
+            task.run('http://example.com', 2019, 0)
+    progress = redis.hgetall('job:job6:progress')
+    assert progress['state'] == 'error'
+    assert progress['info'] == 'RuntimeError: time limit'
+    assert '{com,example)/}:2019:pending' not in redis
+    assert '{com,example)/}:2019:job' not in redis
+
+
+@mock.patch('wayback_discover_diff.discover.get_redis')
+def test_prewarm_run(Redis):
+    redis = StubRedis()
+    redis['{com,example)/}:meta'] = dict(SAMPLE_META)
+    Redis.return_value = redis
+    task = Discover(CFG)
+    redis.hmset('com,example)/', {'20190101000000': 'STORED'})
+    captures = ['2019010%d000000 DIGEST%d' % (i, i) for i in range(1, 4)]
+    html = b'<html><body>some text</body></html>'
+    with mock.patch.object(task, 'fetch_cdx',
+                           return_value={'status': 'success', 'captures': captures}), \
+            mock.patch.object(task, 'download_capture', return_value=html) as download, \
+            mock.patch.object(Discover, 'request', mock.Mock(id='job2')):
+        task.run('http://example.com', 2019, 0, prewarm=True)
+    # stored captures are not recalculated
+    assert sorted(call[0][0] for call in download.call_args_list) == \
+        ['20190102000000', '20190103000000']
+    assert redis.hget('com,example)/', '20190101000000') == 'STORED'
+    assert int(redis.get(budget_key(today()))) == 2
+
+
+@mock.patch('wayback_discover_diff.discover.get_redis')
+def test_check_extractor(Redis):
+    redis = StubRedis()
+    redis['{com,example)/}:meta'] = dict(SAMPLE_META)
+    Redis.return_value = redis
+    task = Discover(CFG)
+    task.url = 'http://example.com'
+    task.check_extractor('com,example)/')
+    assert 'com,example)/' in redis
+    assert redis.hgetall('{com,example)/}:meta') == {'extractor': 'unigram:1',
+                                                   'size': 256}
+    # simhashes of another extractor are discarded
+    task = Discover(dict(CFG, simhash=dict(CFG['simhash'], extractor='shingle')))
+    task.url = 'http://example.com'
+    task.check_extractor('com,example)/')
+    assert 'com,example)/' not in redis
+    assert redis.hget('{com,example)/}:meta', 'extractor') == 'shingle:1:{"k":3}'
+    # simhashes without metadata are discarded
+    redis.hset('com,example)/', '20140101000000', 'og2jGKWHsy4=')
+    redis.delete('{com,example)/}:meta')
+    task.check_extractor('com,example)/')
+    assert 'com,example)/' not in redis
+
+
+def test_split_captures():
+    captures = [str(i) for i in range(10)]
+    assert [len(chunk) for chunk in split_captures(captures, 4)] == [4, 4, 2]
+    assert [len(chunk) for chunk in split_captures(captures, 5)] == [5, 5]
+    assert sum(split_captures(captures, 3), []) == captures
+    assert split_captures([], 3) == []
+
+
+@mock.patch('wayback_discover_diff.discover.get_redis')
+def test_chunked_run(Redis):
+    redis = StubRedis()
+    Redis.return_value = redis
+    cfg = dict(CFG, simhash=dict(CFG['simhash'], chunk_size=2))
+    task = Discover(cfg)
+    captures = ['2019010%d000000 DIGEST%d' % (i, i) for i in range(1, 6)]
+    html = b'<html><body>some text</body></html>'
+    with mock.patch.object(task, 'fetch_cdx',
+                           return_value={'status': 'success', 'captures': captures}), \
+            mock.patch('wayback_discover_diff.discover.chord') as chord, \
+            mock.patch.object(Discover, 'request', mock.Mock(id='job3')):
+        assert task.run('http://example.com', 2019, 0) == {'chunks': 3}
+    (header,) = chord.call_args[0]
+    (callback,) = chord.return_value.call_args[0]
+    assert [sig.task for sig in header] == ['DiscoverChunk'] * 3
+    assert callback.task == 'DiscoverFinalize'
+    (errback,) = callback.options['link_error']
+    assert errback['task'] == 'DiscoverFailed'
+    assert redis.hget('{com,example)/}:2019:pending', 'job_id') == 'job3'
+
+    # run the chord
+    chunk = DiscoverChunk(cfg)
+    with mock.patch.object(chunk, 'download_capture', return_value=html):
+        stored = [chunk.run(*sig.args, **sig.kwargs) for sig in header]
+    assert stored == [2, 2, 1]
+    assert redis.hget('job:job3:progress', 'state') == 'PENDING'
+    DiscoverFinalize(cfg).run(stored, *callback.args)
+    assert '{com,example)/}:2019:pending' not in redis
+    stored = redis.hgetall('com,example)/')
+    assert all(ts in stored for ts, _ in (c.split(' ') for c in captures))
+    progress = redis.hgetall('job:job3:progress')
+    assert progress['state'] == 'SUCCESS'
+    assert [int(progress[k]) for k in ('total', 'fetched', 'hashed')] == \
+        [5, 5, 5]
+    assert redis.hget('{com,example)/}:2019:compressed', 'total_captures') == 5
+    # capacity metrics are not configured
+    assert 'capacity:jobs' not in redis
+    assert 'capacity:workers' not in redis
+
+
+@mock.patch('wayback_discover_diff.discover.get_redis')
+def test_chunk_failed(Redis):
+    redis = StubRedis()
+    Redis.return_value = redis
+    cfg = dict(CFG, simhash=dict(CFG['simhash'], chunk_size=2))
+    task = Discover(cfg)
+    captures = ['2019010%d000000 DIGEST%d' % (i, i) for i in range(1, 6)]
+    with mock.patch.object(task, 'fetch_cdx',
+                           return_value={'status': 'success', 'captures': captures}), \
+            mock.patch('wayback_discover_diff.discover.chord') as chord, \
+            mock.patch.object(Discover, 'request', mock.Mock(id='job4')):
+        task.run('http://example.com', 2019, 0)
+    (callback,) = chord.return_value.call_args[0]
+    (errback,) = callback.options['link_error']
+    # Celery calls the errback with the id of the callback
+    DiscoverFailed(cfg).run('callback-id', *errback['args'])
+    assert '{com,example)/}:2019:pending' not in redis
+    assert '{com,example)/}:2019:job' not in redis
+    progress = redis.hgetall('job:job4:progress')
+    assert progress['state'] == 'error'
+    assert progress['info'].startswith('ChordError')
+
+
+@mock.patch('wayback_discover_diff.discover.get_redis')
+def test_negative_cache(Redis):
+    redis = StubRedis()
+    Redis.return_value = redis
+    task = Discover(CFG)
+    task.url = 'http://example.com'
+    cdx = ('20190101000000 DIGEST1 text/html\n20190102000000 DIGEST2 image/png\n'
+           '20190103000000 DIGEST3 application/pdf\n20190104000000 DIGEST4 warc/revisit\n')
+    captures = task.text_captures(cdx)
+    assert captures == ['20190101000000 DIGEST1', '20190104000000 DIGEST4']
+
+    pdf = mock.Mock(status=200, headers={'content-type': 'application/pdf'})
+    html = mock.Mock(status=200, headers={'content-type': 'text/html'})
+    html.read.return_value = b'<html><body>some text</body></html>'
+    task.playback = mock.Mock()
+    task.playback.request.side_effect = \
+        lambda method, path, **kw: pdf if '20190101' in path else html
+    task.progress = mock.Mock()
+    assert task.process_captures('com,example)/', 2019, captures) == 1
+    # the body is not downloaded
+    assert not pdf.read.called
+    assert redis.get('neg:DIGEST1') == 'mimetype:application/pdf'
+
+    # known bad digests are not downloaded again
+    task.playback.request.reset_mock()
+    task.process_captures('com,example)/', 2019, captures[:1])
+    assert not task.playback.request.called
+
+    # error pages are download errors, not simhashes
+    error = mock.Mock(status=503, headers={'content-type': 'text/plain'})
+    task.playback.request.side_effect = None
+    task.playback.request.return_value = error
+    assert task.process_captures('com,example)/', 2019,
+                                 ['20190105000000 DIGEST5']) == 0
+    assert not error.read.called
+    assert task.download_errors == 1
+    assert redis.get('neg:DIGEST5') == 'status:503'
+    task.cdx = mock.Mock()
+    task.cdx.request.return_value = error
+    assert task.fetch_cdx('http://example.com', 2019) == {
+        'status': 'error', 'info': 'CDX query failed with status 503'}
+
+
+@mock.patch('wayback_discover_diff.discover.get_redis')
+def test_extra_sizes(Redis):
+    redis = StubRedis()
+    Redis.return_value = redis
+    features = {'some': 1, 'text': 2, 'words': 1}
+    simhash = calculate_simhash(features, 512, custom_hash_function)
+    for size in (64, 128, 256):
+        assert encode_simhash(simhash, size) == base64.b64encode(
+            pack_simhash_to_bytes(calculate_simhash(features, size,
+                                                    custom_hash_function), size))
+
+    cfg = dict(CFG, simhash=dict(CFG['simhash'], extra_sizes=[64, 256]))
+    task = Discover(cfg)
+    assert task.extra_sizes == [64]
+    captures = ['2019010%d000000 DIGEST%d' % (i, i) for i in range(1, 3)]
+    html = b'<html><body>some text</body></html>'
+    with mock.patch.object(task, 'fetch_cdx',
+                           return_value={'status': 'success', 'captures': captures}), \
+            mock.patch.object(task, 'download_capture', return_value=html), \
+            mock.patch.object(Discover, 'request', mock.Mock(id='job5')):
+        task.run('http://example.com', 2019, 0)
+    data = year_simhash(redis, 'example.com', 2019, size=64)
+    assert [len(base64.b64decode(simhash)) for _, simhash in data[0]] == [8, 8]
+    assert redis.hget('{com,example)/}:meta', 'extra_sizes') == '64'
+
+
+@mock.patch('wayback_discover_diff.discover.get_redis')
+def test_capacity_tracking(Redis):
+    redis = StubRedis()
+    Redis.return_value = redis
+    task = Discover(dict(CFG, capacity={'worker_expire': 30}))
+    task.job_id = 'job5'
+    task.url = 'http://example.com'
+    task.mark_pending('com,example)/', 2019, 10)
+    assert 'job5' in redis.get('capacity:jobs')
+    task.clear_pending('com,example)/', 2019)
+    assert 'job5' not in redis.get('capacity:jobs')
+    assert task.worker_stats.expire == 30
+
+
+@mock.patch('wayback_discover_diff.discover.get_redis')
+def test_stub_wbm_errors(Redis):
+    # the WBM emulator of the load test, see benchmarks/stub_wbm.py
+    sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'benchmarks'))
+    from stub_wbm import StubWBM, make_captures
+    redis = StubRedis()
+    Redis.return_value = redis
+    captures = make_captures(2019, 8, duplicates=0)
+    with StubWBM(captures, page_size=1000, error_rate=0.5) as server:
+        stub = 'http://%s:%d' % server.server_address
+        task = Discover(dict(CFG, upstream={'playback': {'endpoints': [stub]}}))
+        task.url = 'http://example.com'
+        downloaded = [task.download_capture(timestamp, digest)
+                      for timestamp, digest, _ in captures]
+    # every 503 is a download error and is remembered in the negative cache
+    assert 0 < server.stats['errors'] < len(captures)
+    assert task.download_errors == server.stats['errors']
+    assert downloaded.count(None) == server.stats['errors']
+    assert sum(1 for _, digest, _ in captures
+               if redis.get('neg:%s' % digest) == 'status:503') == \
+        server.stats['errors']
+
+
+@mock.patch('wayback_discover_diff.discover.get_redis')
+def test_no_captures(Redis):
+    redis = StubRedis()
+    redis.clear()
+    Redis.return_value = redis
+    task = Discover(CFG)
+    task.cdx = mock.Mock()
+    task.cdx.request.return_value = mock.Mock(status=200, data=b'')
+    with mock.patch.object(Discover, 'request', mock.Mock(id='job6')):
+        res = task.run('http://nocaptures.com', 2015, 0)
+    assert res['status'] == 'error'
+    # the web app reads the marker with the metadata of its config
+    assert year_simhash(redis, 'http://nocaptures.com', 2015,
+                        meta=simhash_meta(CFG)) == \
+        {'status': 'error', 'message': 'NO_CAPTURES'}
@@ -0,0 +1,53 @@
+import pytest
+from wayback_discover_diff.extractors import Extractor, get_extractor
+
+
+HTML = """<html><head><title>Big news</title><style>p {}</style></head>
+<body><nav>home about</nav>
+<h1>Big news today</h1>
+<p>the news of the day</p>
+<footer>copyright</footer>
+</body></html>"""
+
+
+def test_unigram():
+    assert get_extractor()(HTML) == {
+        'big': 2, 'news': 3, 'home': 1, 'about': 1, 'today': 1, 'the': 2,
+        'of': 1, 'day': 1, 'copyright': 1}
+
+
+def test_shingle():
+    features = get_extractor({'name': 'shingle', 'k': 2})('a b c a b')
+    assert features == {'a b': 2, 'b c': 1, 'c a': 1}
+    assert get_extractor('shingle')('a b') == {'a b': 1}
+
+
+def test_tag_weighted():
+    extractor = get_extractor({'name': 'tag_weighted',
+                               'weights': {'title': 3, 'h1': 2}})
+    features = extractor(HTML)
+    # title: 3, h1: 2, p: 1
+    assert features['news'] == 6
+    assert features['big'] == 5
+    assert features['today'] == 2
+    assert features['day'] == 1
+
+
+def test_boilerplate():
+    assert get_extractor('boilerplate')(HTML) == {
+        'big': 2, 'news': 3, 'today': 1, 'the': 2, 'of': 1, 'day': 1}
+
+
+def test_signature():
+    assert get_extractor().signature == 'unigram:1'
+    assert get_extractor({'name': 'shingle', 'k': 4}).signature == \
+        'shingle:1:{"k":4}'
+    with pytest.raises(ValueError):
+        get_extractor('unknown')
+    with pytest.raises(ValueError):
+        get_extractor({'name': 'shingle', 'size': 4})
+
+
+def test_abstract_extractor():
+    with pytest.raises(TypeError):
+        Extractor()
@@ -0,0 +1,50 @@
+import base64
+import random
+import mock
+import pytest
+
+# optional dependency, `pip install wayback-discover-diff[hamming]`
+np = pytest.importorskip('numpy')
+from wayback_discover_diff import hamming  # pylint: disable=wrong-import-position
+
+
+def random_hashes(count, size, seed=1):
+    rnd = random.Random(seed)
+    return [rnd.getrandbits(size) for _ in range(count)]
+
+
+def encode(values, size):
+    return [base64.b64encode(v.to_bytes(size // 8, 'little')).decode('ascii')
+            for v in values]
+
+
+@pytest.mark.parametrize('size', [64, 128, 256, 512, 72])
+def test_distances(size):
+    values = random_hashes(20, size)
+    hashes = hamming.decode_simhashes(encode(values, size))
+    assert hashes.shape == (20, size // 8)
+    expected = [[bin(a ^ b).count('1') for b in values] for a in values]
+    assert hamming.pairwise(hashes).tolist() == expected
+    assert hamming.consecutive(hashes).tolist() == \
+        [expected[i][i + 1] for i in range(19)]
+    assert hamming.one_to_many(hashes[3], hashes).tolist() == expected[3]
+    # in blocks of a few rows
+    with mock.patch.object(hamming, 'BLOCK_WORDS', 3 * hashes.size // 8):
+        assert hamming.pairwise(hashes[:5], hashes).tolist() == expected[:5]
+
+
+def test_lookup_table():
+    words = np.array([0, 1, 255, 2**64 - 1], dtype=np.uint64)
+    assert hamming.lookup_popcount(words).tolist() == [0, 1, 8, 64]
+    values = random_hashes(10, 256)
+    hashes = hamming.decode_simhashes(encode(values, 256))
+    with mock.patch.object(hamming, '_popcount', hamming.lookup_popcount):
+        assert hamming.consecutive(hashes).tolist() == \
+            [bin(a ^ b).count('1') for a, b in zip(values, values[1:])]
+        assert hamming.pairwise(hashes)[0].tolist() == \
+            [bin(values[0] ^ b).count('1') for b in values]
+
+
+def test_decode_different_sizes():
+    with pytest.raises(ValueError):
+        hamming.decode_simhashes(encode([1], 64) + encode([1], 128))
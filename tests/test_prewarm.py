@@ -0,0 +1,56 @@
+import mock
+from test_util import StubRedis
+from wayback_discover_diff.prewarm import (DownloadBudget, Prewarm,
+                                           top_requested, track_request)
+
+
+CFG = {
+    'simhash': {'size': 256, 'expire_after': 86400},
+    'redis': {'url': 'redis://localhost:6379/1', 'decode_responses': True},
+    'prewarm': {'top': 2, 'download_budget': 100},
+    }
+
+
+def test_top_requested():
+    redis = StubRedis()
+    for url, year, count in (('example.com', 2019, 2), ('other.com', 2018, 2),
+                             ('popular.com', 2019, 5),
+                             ('http://www.example.com/', 2019, 1)):
+        for _ in range(count):
+            track_request(redis, url, year, 86400)
+    # variants of a URL count together
+    assert top_requested(redis, 2, 7) == [('popular.com', 2019),
+                                          ('http://www.example.com/', 2019)]
+
+
+def test_download_budget():
+    redis = StubRedis()
+    budget = DownloadBudget(redis, 8, batch=4)
+    assert all(budget.spend() for _ in range(7))
+    # the 8th download brings the shared counter to the limit
+    assert not budget.spend()
+    assert not budget.spend()
+    assert DownloadBudget(redis, 8).spent() == 8
+
+
+@mock.patch('wayback_discover_diff.prewarm.get_redis')
+def test_prewarm(Redis):
+    redis = StubRedis()
+    Redis.return_value = redis
+    # example.com 2014 is stored without expiration, not 2016
+    redis['{com,example)/}:ts'] = {'20140202131837': 20140202131837}
+    track_request(redis, 'example.com', 2014, 86400)
+    track_request(redis, 'example.com', 2016, 86400)
+    track_request(redis, 'popular.com', 2019, 86400)
+    task = Prewarm(dict(CFG, prewarm=dict(CFG['prewarm'], top=3)))
+    with mock.patch.object(Prewarm, 'app') as app:
+        started = task.run()
+        assert len(started) == 2
+        app.send_task.assert_any_call(
+            'Discover', args=['popular.com', 2019, mock.ANY],
+            kwargs={'prewarm': True}, task_id=mock.ANY)
+        app.send_task.assert_any_call(
+            'Discover', args=['example.com', 2016, mock.ANY],
+            kwargs={'prewarm': True}, task_id=mock.ANY)
+        # the job is running
+        assert task.run() == []
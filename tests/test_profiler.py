@@ -0,0 +1,48 @@
+import os
+import signal
+import time
+import pytest
+from wayback_discover_diff.profiler import (SamplingProfiler, collapse_stack,
+    install_signal_handler, private_dir, signal_processes)
+
+
+def test_collapse_stack():
+    def inner():
+        import sys
+        return collapse_stack(sys._getframe())
+    stack = inner().split(';')
+    assert stack[-1].startswith('inner (')
+    assert stack[-2].startswith('test_collapse_stack (')
+
+
+def test_signal_profile(tmp_path):
+    profiler = SamplingProfiler(output_dir=str(tmp_path), interval=0.001,
+                                label=lambda: 'job1')
+    previous = signal.getsignal(signal.SIGUSR2)
+    try:
+        install_signal_handler(profiler)
+        assert signal_processes(profiler, [os.getpid()], 0.05) == [os.getpid()]
+        time.sleep(0.01)
+        assert profiler.running
+        # only one profile at a time
+        assert profiler.start() is None
+        profiler._thread.join()
+    finally:
+        signal.signal(signal.SIGUSR2, previous)
+    files = [name for name in os.listdir(tmp_path) if name.endswith('.collapsed')]
+    assert len(files) == 1 and '-job1-' in files[0]
+    # the request file has been consumed
+    assert os.listdir(tmp_path / 'requests') == []
+    assert 'test_signal_profile' in (tmp_path / files[0]).read_text()
+
+
+def test_private_dir(tmp_path):
+    path = str(tmp_path / 'profiles')
+    assert private_dir(path) == path
+    assert os.stat(path).st_mode & 0o777 == 0o700
+    os.symlink(path, str(tmp_path / 'link'))
+    with pytest.raises(OSError):
+        private_dir(str(tmp_path / 'link'))
+    os.chmod(path, 0o755)
+    with pytest.raises(OSError):
+        private_dir(path)
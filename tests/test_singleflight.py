@@ -0,0 +1,46 @@
+import threading
+import mock
+import pytest
+from wayback_discover_diff.singleflight import SingleFlight
+
+
+@mock.patch('wayback_discover_diff.singleflight.statsd_incr')
+def test_single_flight(statsd_incr):
+    flight = SingleFlight('coalesced')
+    waiting = threading.Semaphore(0)
+    statsd_incr.side_effect = lambda metric: waiting.release()
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def fetch(value):
+        calls.append(value)
+        started.set()
+        release.wait(5)
+        return [value]
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(flight.do('k', fetch, 1)))]
+    threads[0].start()
+    started.wait(5)
+    for _ in range(3):
+        threads.append(threading.Thread(
+            target=lambda: results.append(flight.do('k', fetch, 2))))
+        threads[-1].start()
+    # release the first call once the others wait for it
+    for _ in range(3):
+        assert waiting.acquire(timeout=5)
+    release.set()
+    for thread in threads:
+        thread.join(5)
+    assert calls == [1]
+    assert results == [[1]] * 4
+    # the next call is not coalesced
+    assert flight.do('k', lambda: 3) == 3
+
+
+def test_single_flight_error():
+    flight = SingleFlight()
+    with pytest.raises(ValueError):
+        flight.do('k', int, 'invalid')
+    assert flight.do('k', int, '1') == 1
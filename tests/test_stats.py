@@ -0,0 +1,25 @@
+from wayback_discover_diff import stats
+
+
+def test_timing_histogram(monkeypatch):
+    monkeypatch.setattr(stats, 'REGISTRY', stats.Registry())
+    monkeypatch.setattr(stats, 'SAMPLE_RATE', 1.0)
+    with stats.timing('parse'):
+        pass
+    stats.statsd_timing('parse', 0.3)
+    stats.statsd_incr('download-error')
+    stats.statsd_gauge('captures-remaining', 42)
+    text = stats.REGISTRY.render()
+    assert 'wayback_discover_diff_stage_seconds_bucket{stage="parse",le="0.001"} 1' in text
+    assert 'wayback_discover_diff_stage_seconds_bucket{stage="parse",le="0.5"} 2' in text
+    assert 'wayback_discover_diff_stage_seconds_count{stage="parse"} 2' in text
+    assert 'wayback_discover_diff_events_total{event="download-error"} 1' in text
+    assert 'wayback_discover_diff_gauge{name="captures-remaining"} 42' in text
+
+
+def test_timing_sampling(monkeypatch):
+    monkeypatch.setattr(stats, 'REGISTRY', stats.Registry())
+    monkeypatch.setattr(stats, 'SAMPLE_RATE', 0.0)
+    with stats.timing('parse'):
+        pass
+    assert stats.REGISTRY.histograms == {}
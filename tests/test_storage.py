@@ -0,0 +1,106 @@
+import mock
+from test_util import StubRedis
+
+from wayback_discover_diff.storage import (HashRing, ShardedRedis, key_tag,
+                                           rebalance)
+from wayback_discover_diff.util import (compressed_key, job_key, meta_key,
+                                        pending_key, year_simhash)
+
+
+class NodeRedis(StubRedis):
+    """Empty StubRedis node which supports SCAN and MIGRATE.
+    """
+    def __init__(self, port, registry):
+        super().__init__()
+        self.clear()
+        self.connection_pool = mock.Mock(connection_kwargs={'port': port})
+        self.registry = registry
+        registry[port] = self
+
+    def scan_iter(self, count=None):
+        return iter(list(self))
+
+    def migrate(self, host, port, keys, destination_db, timeout, replace=False,
+                auth=None):
+        target = self.registry[port]
+        for key in keys:
+            target[key] = self.pop(key)
+
+
+def make_nodes(count, registry=None, start=0):
+    registry = {} if registry is None else registry
+    return {'redis://node%d:%d/1' % (i, 6380 + i): NodeRedis(6380 + i, registry)
+            for i in range(start, count)}
+
+
+def test_key_tag():
+    urlkey = 'com,example)/'
+    assert key_tag(urlkey) == urlkey
+    for key in (pending_key(urlkey, 2019), job_key(urlkey, 2019),
+                compressed_key(urlkey, 2019), meta_key(urlkey)):
+        assert key_tag(key) == urlkey
+    assert key_tag('{}:x') == '{}:x'
+
+
+def test_hash_ring():
+    names = ['a', 'b', 'c']
+    ring = HashRing(names)
+    keys = ['org,example%d)/' % i for i in range(3000)]
+    owners = {key: ring.get(key) for key in keys}
+    counts = [list(owners.values()).count(name) for name in names]
+    assert min(counts) > 700
+    # a new node only takes keys from the others
+    bigger = HashRing(names + ['d'])
+    moved = [key for key in keys if bigger.get(key) != owners[key]]
+    assert all(bigger.get(key) == 'd' for key in moved)
+    assert 500 < len(moved) < 1000
+
+
+def test_sharded_redis():
+    nodes = make_nodes(3)
+    redis = ShardedRedis(nodes)
+    urlkeys = ['org,example%d)/' % i for i in range(30)]
+    pipe = redis.pipeline(transaction=False)
+    for i, urlkey in enumerate(urlkeys):
+        pipe.hmset(urlkey, {'20190101000000': 'SIMHASH%d' % i})
+        pipe.hmset(meta_key(urlkey), {'size': 256})
+    pipe.execute()
+    assert all(len(node) > 0 for node in nodes.values())
+    for urlkey in urlkeys:
+        # the keys of a URL are on the same node
+        assert meta_key(urlkey) in redis.node(urlkey)
+
+    # batch reads return results in order
+    pipe = redis.pipeline(transaction=False)
+    for urlkey in urlkeys:
+        pipe.hget(urlkey, '20190101000000')
+    assert pipe.execute() == ['SIMHASH%d' % i for i in range(30)]
+
+    assert redis.delete(*urlkeys[:10]) == 10
+    pipe = redis.pipeline(transaction=False)
+    pipe.delete(*urlkeys[10:20])
+    pipe.hget(urlkeys[20], '20190101000000')
+    assert pipe.execute() == [10, 'SIMHASH20']
+
+    redis.hmset('com,example)/', {'20190101000000': 'og2jGKWHsy4='})
+    data = year_simhash(redis, 'example.com', 2019)
+    assert data == [[['20190101000000', 'og2jGKWHsy4=']], 1]
+
+
+def test_rebalance():
+    registry = {}
+    nodes = make_nodes(2, registry)
+    redis = ShardedRedis(nodes)
+    urlkeys = ['org,example%d)/' % i for i in range(100)]
+    for urlkey in urlkeys:
+        redis.hmset(urlkey, {'20190101000000': urlkey})
+        redis.hmset(pending_key(urlkey, 2019), {'total': 1})
+    nodes.update(make_nodes(3, registry, start=2))
+    bigger = ShardedRedis(nodes)
+    missing = [urlkey for urlkey in urlkeys if urlkey not in bigger.node(urlkey)]
+    assert missing
+    assert rebalance(bigger, batch=7) == 2 * len(missing)
+    for urlkey in urlkeys:
+        assert bigger.hget(urlkey, '20190101000000') == urlkey
+        assert pending_key(urlkey, 2019) in bigger.node(urlkey)
+    assert rebalance(bigger) == 0
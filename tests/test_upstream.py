@@ -0,0 +1,69 @@
+import mock
+import pytest
+from urllib3.exceptions import MaxRetryError
+from wayback_discover_diff.upstream import UpstreamPool, get_upstreams
+
+
+def make_pool(count, **kwargs):
+    pool = UpstreamPool(['http://replica%d:8080/prefix' % i for i in range(count)],
+                        **kwargs)
+    for endpoint in pool.endpoints:
+        endpoint.pool = mock.Mock()
+        endpoint.pool.request.return_value = mock.Mock(status=200)
+    return pool
+
+
+def test_round_robin():
+    pool = make_pool(3)
+    picked = [pool.pick().url for _ in range(4)]
+    assert picked == ['http://replica0:8080/prefix', 'http://replica1:8080/prefix',
+                      'http://replica2:8080/prefix', 'http://replica0:8080/prefix']
+    pool.request('GET', '/web/timemap', fields={'url': 'example.com'})
+    pool.endpoints[1].pool.request.assert_called_once_with(
+        'GET', '/prefix/web/timemap', fields={'url': 'example.com'})
+
+
+def test_failover_and_ejection():
+    pool = make_pool(2, fail_threshold=2, eject_seconds=60)
+    bad = pool.endpoints[0]
+    bad.pool.request.side_effect = MaxRetryError(None, '/')
+    for _ in range(4):
+        assert pool.request('GET', '/').status == 200
+    # ejected after 2 failures, all requests then go to the healthy replica
+    assert bad.pool.request.call_count == 2
+    assert bad.ejected_until > 0
+    assert pool.endpoints[1].pool.request.call_count == 4
+
+
+def test_retry_server_errors():
+    pool = make_pool(2, fail_threshold=5)
+    error = mock.Mock(status=503)
+    pool.endpoints[0].pool.request.return_value = error
+    assert pool.request('GET', '/').status == 200
+    # the connection of the error response is released
+    error.release_conn.assert_called_once_with()
+    assert pool.endpoints[0].failures == 1
+    # the last error response is returned if all replicas fail
+    pool.endpoints[1].pool.request.return_value = mock.Mock(status=502)
+    assert pool.request('GET', '/').status in (502, 503)
+
+
+def test_all_failing():
+    pool = make_pool(2)
+    for endpoint in pool.endpoints:
+        endpoint.pool.request.side_effect = MaxRetryError(None, '/')
+    with pytest.raises(MaxRetryError):
+        pool.request('GET', '/')
+
+
+def test_get_upstreams():
+    cfg = {'upstream': {'maxsize': 4, 'timeout': 5,
+                        'cdx': {'endpoints': ['http://cdx1', 'http://cdx2']},
+                        'playback': {'timeout': 30}}}
+    (cdx, playback) = get_upstreams(cfg)
+    assert [e.url for e in cdx.endpoints] == ['http://cdx1', 'http://cdx2']
+    assert [e.url for e in playback.endpoints] == ['http://web.archive.org']
+    assert playback.endpoints[0].pool.timeout.read_timeout == 30
+    assert cdx.endpoints[0].pool.timeout.read_timeout == 5
+    (cdx, playback) = get_upstreams({})
+    assert cdx.endpoints[0].pool.host == 'web.archive.org'
@@ -1,7 +1,11 @@
 import pytest
 
 from wayback_discover_diff.util import (url_is_valid, year_simhash,
-                                        timestamp_simhash)
+                                        timestamp_simhash, pending_job,
+                                        compress_captures, claim_job,
+                                        range_simhash, timestamp_bound,
+                                        timestamps_key, job_expire,
+                                        simhash_meta)
 
 
 SAMPLE_REDIS_CONTENT = {
@@ -20,11 +24,22 @@ SAMPLE_REDIS_CONTENT = {
 }
 
 
+# simhash metadata of the default extractor and size, see `simhash_meta`
+SAMPLE_META = {'extractor': 'unigram:1', 'size': '256'}
+
+
 class StubRedis(dict):
     """Mock Redis connection for unit tests.
     """
     def __init__(self, *args, **kwargs):
-        self.update(SAMPLE_REDIS_CONTENT)
+        self.update({key: dict(value) for key, value in SAMPLE_REDIS_CONTENT.items()})
+
+    def set(self, key, value, nx=False, ex=None):
+        # `get` is inherited from dict
+        if nx and key in self:
+            return None
+        self[key] = value
+        return True
 
     def hset(self, key, hkey, hval):
         e = self.get(key)
@@ -32,7 +47,10 @@ class StubRedis(dict):
             self[key] = e = {}
         else:
             assert isinstance(e, dict)
-        e[hkey] = hval
+        # like Redis with decode_responses=True
+        if isinstance(hval, bytes):
+            hval = hval.decode('utf-8')
+        e[str(hkey)] = hval
 
     def hget(self, key, hkey):
         e = self.get(key)
@@ -40,20 +58,126 @@ class StubRedis(dict):
         assert isinstance(e, dict)
         return e.get(hkey)
 
+    def hexists(self, key, hkey):
+        return str(hkey) in self.get(key, {})
+
     def hkeys(self, key):
         e = self.get(key)
         if e is None: return {}
         assert isinstance(e, dict)
         return self.get(key).keys()
 
+    def hscan_iter(self, key):
+        return iter(self.get(key, {}).items())
+
     def hmget(self, key, hkeys):
         e = self.get(key)
-        if e is None: return None
+        if e is None: return [None] * len(hkeys)
         assert isinstance(e, dict)
-        out = {}
-        for hkey in hkeys:
-            out[hkey] = e.get(hkey)
-        return out
+        return [e.get(hkey) for hkey in hkeys]
+
+    def hgetall(self, key):
+        e = self.get(key)
+        if e is None: return {}
+        assert isinstance(e, dict)
+        return dict(e)
+
+    def hmset(self, key, mapping):
+        for hkey, hval in mapping.items():
+            self.hset(key, hkey, hval)
+
+    def hincrby(self, key, hkey, amount=1):
+        value = int(self.hget(key, hkey) or 0) + amount
+        self.hset(key, hkey, str(value))
+        return value
+
+    def expire(self, key, seconds):
+        return key in self
+
+    def delete(self, *keys):
+        return sum(1 for key in keys if self.pop(key, None) is not None)
+
+    def incrby(self, key, amount=1):
+        value = int(self.get(key) or 0) + amount
+        self[key] = str(value)
+        return value
+
+    def ttl(self, key):
+        return -1 if key in self else -2
+
+    def zincrby(self, key, amount, member):
+        e = self.setdefault(key, {})
+        e[member] = e.get(member, 0) + amount
+        return e[member]
+
+    def zunionstore(self, dest, keys):
+        union = {}
+        for key in keys:
+            for member, score in self.get(key, {}).items():
+                union[member] = union.get(member, 0) + score
+        self[dest] = union
+        return len(union)
+
+    def zadd(self, key, mapping):
+        e = self.setdefault(key, {})
+        added = sum(1 for member in mapping if member not in e)
+        e.update(mapping)
+        return added
+
+    def zrangebyscore(self, key, low, high, start=None, num=None):
+        exclusive = str(low).startswith('(')
+        low = float(str(low).lstrip('('))
+        members = sorted(self.get(key, {}).items(), key=lambda e: e[1])
+        members = [member for member, score in members
+                   if (score > low if exclusive else score >= low) and
+                   score <= float(high)]
+        if start is not None:
+            members = members[start:start + num]
+        return members
+
+    def zscore(self, key, member):
+        return self.get(key, {}).get(member)
+
+    def zrem(self, key, *members):
+        e = self.get(key, {})
+        return sum(1 for member in members if e.pop(member, None) is not None)
+
+    def zremrangebyscore(self, key, low, high):
+        e = self.get(key, {})
+        removed = [member for member, score in e.items()
+                   if float(low) <= score <= float(high)]
+        for member in removed:
+            del e[member]
+        return len(removed)
+
+    def exists(self, *keys):
+        return sum(1 for key in keys if key in self)
+
+    def zrevrange(self, key, start, end):
+        members = sorted(self.get(key, {}).items(), key=lambda e: -e[1])
+        return [member for member, _ in members[start:end + 1]]
+
+    def pipeline(self, transaction=True):
+        return StubPipeline(self)
+
+
+class StubPipeline:
+    """Mock Redis pipeline which buffers commands until `execute`.
+    """
+    def __init__(self, redis):
+        self.redis = redis
+        self.commands = []
+
+    def __getattr__(self, name):
+        method = getattr(self.redis, name)
+        def buffered(*args, **kwargs):
+            self.commands.append((method, args, kwargs))
+            return self
+        return buffered
+
+    def execute(self):
+        commands, self.commands = self.commands, []
+        return [method(*args, **kwargs) for method, args, kwargs in commands]
 
 
 @pytest.fixture
@@ -106,3 +230,105 @@ def test_year_simhash(url, year, count, redis):
             assert res == {'status': 'error', 'message': 'NOT_CAPTURED'}
     if count:
         assert len(res[0]) == count
+
+
+def test_stale_simhashes(redis):
+    meta = simhash_meta({'simhash': {'size': 256}})
+    redis['{com,example)/}:meta'] = dict(SAMPLE_META)
+    assert len(year_simhash(redis, 'http://example.com', 2014, meta=meta)[0]) == 3
+    shingle = simhash_meta({'simhash': {'size': 256, 'extractor': 'shingle'}})
+    assert year_simhash(redis, 'http://example.com', 2014, meta=shingle) == \
+        {'status': 'error', 'message': 'NOT_CAPTURED'}
+    assert timestamp_simhash(redis, 'http://example.com', '20141021062411',
+                             meta=shingle) == \
+        {'status': 'error', 'message': 'CAPTURE_NOT_FOUND'}
+    assert range_simhash(redis, 'http://example.com', '20140000000000',
+                         '20149999999999', 10, meta=shingle) == \
+        {'status': 'error', 'message': 'NOT_CAPTURED'}
+    # simhashes without metadata are stale too
+    del redis['{com,example)/}:meta']
+    assert year_simhash(redis, 'http://example.com', 2014, meta=meta) == \
+        {'status': 'error', 'message': 'NOT_CAPTURED'}
+    # but not the markers of years without captures
+    assert year_simhash(redis, 'http://other.com', 2014, meta=meta) == \
+        {'status': 'error', 'message': 'NO_CAPTURES'}
+
+
+def test_pending_job(redis):
+    assert pending_job(redis, 'http://example.com', 2014) is None
+    redis['{com,example)/}:2014:pending'] = {'job_id': 'abc', 'total': '10',
+                                            'stored': '4'}
+    assert pending_job(redis, 'http://example.com', 2014) == {
+        'job_id': 'abc', 'total': 10, 'stored': 4}
+
+
+def test_compress_captures():
+    captures = [['20130603143716', 'NRyJrLc2FWA='],
+                ['20130402202841', 'FT6d7Jc3vWA='],
+                ['20130603150000', 'FT6d7Jc3vWA='],
+                ['20140101000000', 'NRyJrLc2FWA=']]
+    assert compress_captures(captures) == (
+        [[2013, [4, [2, ['202841', 0]]],
+                [6, [3, ['143716', 1], ['150000', 0]]]],
+         [2014, [1, [1, ['000000', 1]]]]],
+        ['FT6d7Jc3vWA=', 'NRyJrLc2FWA='])
+    # paginated captures
+    (paged, _) = compress_captures(captures[:2] + [['pages', 3]])
+    assert paged == [['pages', 3],
+                     [2013, [4, [2, ['202841', 0]]], [6, [3, ['143716', 1]]]]]
+
+
+def test_claim_job(redis):
+    assert claim_job(redis, 'http://example.com', 2019, 'job1', 600) is None
+    assert claim_job(redis, 'http://example.com', 2019, 'job2', 600) == 'job1'
+    assert claim_job(redis, 'http://example.com', 2018, 'job3', 600) is None
+    # the key of the worker, which normalizes the URL with `url_fix`
+    assert claim_job(redis, 'http://example.com/a b', 2019, 'job4', 600) is None
+    assert redis.get('{com,example)/a%20b}:2019:job') == 'job4'
+    assert job_expire({'simhash': {'queue_timeout': 600},
+                       'celery': {'task_soft_time_limit': 3600}}) == 4200
+
+
+def test_timestamp_bound():
+    assert timestamp_bound('2019') == '20190000000000'
+    assert timestamp_bound('201912', upper=True) == '20191299999999'
+    assert timestamp_bound('20191231235959') == '20191231235959'
+    for value in ('', '2019-12', '201912312359590'):
+        with pytest.raises(ValueError):
+            timestamp_bound(value)
+
+
+def test_range_simhash(redis):
+    # the index of simhashes stored before it existed is built on first use
+    (captures, cursor) = range_simhash(redis, 'http://example.com',
+                                       '20140800000000', '20169999999999', 2)
+    assert captures == [['20140824062257', 'o52jPP0Hg2o='],
+                        ['20141021062411', 'o52rOf0Hi2o=']]
+    assert cursor == '20141021062411'
+    assert timestamps_key('com,example)/') in redis
+    # captures added before the cursor do not change the next page
+    redis.hset('com,example)/', '20140901000000', 'NEW')
+    redis.zadd(timestamps_key('com,example)/'), {'20140901000000': 20140901000000})
+    (captures, cursor) = range_simhash(redis, 'http://example.com',
+                                       '20140800000000', '20169999999999', 2,
+                                       cursor)
+    assert captures == [['20160824062257', 'o52jPP0Hg2o=']]
+    assert cursor is None
+    assert range_simhash(redis, 'http://other.com', '20140000000000',
+                         '20149999999999', 2) == ([], None)
+    assert range_simhash(redis, 'http://nonexistingdomain.com', '20140000000000',
+                         '20149999999999', 2) == \
+        {'status': 'error', 'message': 'NOT_CAPTURED'}
+
+
+def test_range_simhash_backfill(redis):
+    # the first flush after the index was introduced creates it with only
+    # the new captures
+    redis.hset('com,example)/', '20190101000000', 'NEW')
+    redis.zadd(timestamps_key('com,example)/'), {'20190101000000': 20190101000000})
+    (captures, _) = range_simhash(redis, 'http://example.com',
+                                  '20140000000000', '20149999999999', 10)
+    assert len(captures) == 3
+    (captures, _) = range_simhash(redis, 'http://example.com',
+                                  '20190000000000', '20199999999999', 10)
+    assert captures == [['20190101000000', 'NEW']]
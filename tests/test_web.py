@@ -1,11 +1,17 @@
 """Test web endpoints.
 """
+import gzip
 import json
+import os
+import subprocess
+import sys
+import mock
 import pytest
 from werkzeug.test import Client
 from werkzeug.wrappers import Response
-from test_util import StubRedis
+from test_util import SAMPLE_META, StubRedis
 
+from wayback_discover_diff import columnar, web
 from wayback_discover_diff.web import get_app
 
 
@@ -16,6 +22,7 @@ def app():
         )
     web_app = get_app(cfg)
     web_app.redis = StubRedis()
+    web_app.redis['{com,example)/}:meta'] = dict(SAMPLE_META)
     return web_app
 
 # TODO we must mock Celery task
@@ -121,3 +128,188 @@ def test_job_params(app):
     resp = client.get('/job')
     data = json.loads(resp.data.decode('utf-8'))
     assert data == dict(status='error', info='job_id param is required.')
+
+
+def test_job_progress(app):
+    app.redis['job:abc:progress'] = {'state': 'PENDING', 'info': '',
+                                     'total': '10', 'fetched': '5',
+                                     'cached': '2', 'hashed': '5',
+                                     'failed': '1'}
+    app.celery = mock.Mock()
+    client = Client(app, response_wrapper=Response)
+    with mock.patch('wayback_discover_diff.web.AsyncResult') as result:
+        resp = client.get('/job?job_id=abc')
+    assert not result.called
+    data = json.loads(resp.data.decode('utf-8'))
+    assert data == dict(status='PENDING', job_id='abc',
+                        info='Processed 8 out of 10 captures.', total=10,
+                        fetched=5, cached=2, hashed=5, failed=1)
+
+    # the task failed without writing its progress
+    with mock.patch('wayback_discover_diff.web.AsyncResult') as result:
+        result.return_value.state = 'FAILURE'
+        result.return_value.id = 'xyz'
+        resp = client.get('/job?job_id=xyz')
+    data = json.loads(resp.data.decode('utf-8'))
+    assert data == dict(status='error', job_id='xyz', info='Job failure.')
+
+    app.redis['job:abc:progress'].update(state='SUCCESS', duration='12')
+    resp = client.get('/job/stream?job_id=abc')
+    assert resp.mimetype == 'text/event-stream'
+    (retry, event) = resp.data.decode('utf-8').split('\n\n', 1)
+    assert retry == 'retry: 1000'
+    assert event.startswith('data: ') and event.endswith('\n\n')
+    assert json.loads(event[6:]) == dict(status='SUCCESS', job_id='abc',
+                                         duration='12')
+
+
+def test_metrics(app):
+    client = Client(app, response_wrapper=Response)
+    resp = client.get('/metrics')
+    assert resp.status_code == 404
+
+
+def test_simhash_columnar(app):
+    client = Client(app, response_wrapper=Response)
+    resp = client.get('/simhash?url=example.com&year=2014',
+                      headers={'Accept': columnar.MIMETYPE})
+    assert resp.mimetype == columnar.MIMETYPE
+    assert resp.headers['X-Total-Captures'] == '3'
+    assert resp.headers['X-Status'] == 'COMPLETE'
+    (year, captures) = columnar.decode_captures(resp.data)
+    assert year == 2014
+    assert captures == [['20140202131837', 'og2jGKWHsy4='],
+                        ['20140824062257', 'o52jPP0Hg2o='],
+                        ['20141021062411', 'o52rOf0Hi2o=']]
+
+    # JSON remains the default
+    resp = client.get('/simhash?url=example.com&year=2014',
+                      headers={'Accept': '*/*', 'Accept-Encoding': 'gzip'})
+    assert resp.mimetype == 'application/json'
+    # too small to compress
+    assert 'Content-Encoding' not in resp.headers
+
+
+def test_compress_response(app, monkeypatch):
+    monkeypatch.setattr(web, 'MIN_COMPRESS_SIZE', 10)
+    client = Client(app, response_wrapper=Response)
+    resp = client.get('/simhash?url=example.com&year=2014',
+                      headers={'Accept-Encoding': 'gzip'})
+    assert resp.headers['Content-Encoding'] == 'gzip'
+    data = json.loads(gzip.decompress(resp.data).decode('utf-8'))
+    assert data['total_captures'] == 3
+
+
+def test_simhash_compressed(app):
+    client = Client(app, response_wrapper=Response)
+    resp = client.get('/simhash?url=example.com&year=2014&compress=1')
+    data = json.loads(resp.data.decode('utf-8'))
+    assert data['hashes'] == ['og2jGKWHsy4=', 'o52jPP0Hg2o=', 'o52rOf0Hi2o=']
+
+    # served as stored by the worker
+    app.redis['{com,example)/}:2014:compressed'] = {
+        'captures': json.dumps(data['captures']),
+        'hashes': json.dumps(data['hashes']), 'total_captures': '3'}
+    resp = client.get('/simhash?url=example.com&year=2014&compress=1')
+    assert json.loads(resp.data.decode('utf-8')) == data
+
+    # paginated, not the stored year
+    app.config['snapshots'] = {'number_per_page': 2}
+    resp = client.get('/simhash?url=example.com&year=2014&page=1&compress=1')
+    paged = json.loads(resp.data.decode('utf-8'))
+    assert paged['captures'][0] == ['pages', 2]
+    assert len(paged['hashes']) == 2
+
+    # not served if calculated with another extractor
+    app.redis['{com,example)/}:meta'] = {'extractor': 'shingle:1:{"k":3}',
+                                        'size': '256'}
+    resp = client.get('/simhash?url=example.com&year=2014&compress=1')
+    assert json.loads(resp.data.decode('utf-8')) == {
+        'status': 'error', 'message': 'NOT_CAPTURED'}
+
+
+def test_calculate_simhash_single_job(app):
+    app.celery = mock.Mock()
+    client = Client(app, response_wrapper=Response)
+    resp = client.get('/calculate-simhash?url=example.com&year=2019')
+    data = json.loads(resp.data.decode('utf-8'))
+    assert data['status'] == 'started'
+    app.celery.send_task.assert_called_once()
+    assert app.celery.send_task.call_args[1]['task_id'] == data['job_id']
+
+    # concurrent requests get the same job
+    resp = client.get('/calculate-simhash?url=example.com&year=2019')
+    assert json.loads(resp.data.decode('utf-8')) == dict(status='PENDING',
+                                                         job_id=data['job_id'])
+    app.celery.send_task.assert_called_once()
+
+
+@mock.patch.dict(web.APP.config, simhash={'size': 256, 'extra_sizes': [64]})
+def test_simhash_size(app):
+    app.redis['{com,example)/}:64'] = {'20140202131837': 'og2jGKWHsy4='}
+    client = Client(app, response_wrapper=Response)
+    resp = client.get('/simhash?url=example.com&year=2014&size=64')
+    data = json.loads(resp.data.decode('utf-8'))
+    assert data['captures'] == [['20140202131837', 'og2jGKWHsy4=']]
+    resp = client.get('/simhash?url=example.com&timestamp=20140202131837&size=64')
+    assert json.loads(resp.data.decode('utf-8')) == {'simhash': 'og2jGKWHsy4='}
+    # the default size
+    resp = client.get('/simhash?url=example.com&year=2014&size=256')
+    assert json.loads(resp.data.decode('utf-8'))['total_captures'] == 3
+    resp = client.get('/simhash?url=example.com&year=2014&size=12')
+    assert json.loads(resp.data.decode('utf-8')) == dict(
+        status='error', info='invalid size param.')
+    # sizes which are not calculated by the workers
+    resp = client.get('/simhash?url=example.com&year=2014&size=128')
+    assert json.loads(resp.data.decode('utf-8')) == dict(
+        status='error', info='invalid size param.')
+
+
+def test_simhash_range(app):
+    client = Client(app, response_wrapper=Response)
+    resp = client.get('/simhash?url=example.com&from=201408&to=2016&limit=2')
+    data = json.loads(resp.data.decode('utf-8'))
+    assert data == dict(captures=[['20140824062257', 'o52jPP0Hg2o='],
+                                  ['20141021062411', 'o52rOf0Hi2o=']],
+                        total_captures=2, status='COMPLETE',
+                        cursor='20141021062411')
+    resp = client.get('/simhash?url=example.com&from=201408&to=2016&limit=2'
+                      '&cursor=20141021062411')
+    data = json.loads(resp.data.decode('utf-8'))
+    assert data['captures'] == [['20160824062257', 'o52jPP0Hg2o=']]
+    assert 'cursor' not in data
+    resp = client.get('/simhash?url=example.com&from=2016&to=2014')
+    assert json.loads(resp.data.decode('utf-8')) == dict(
+        status='error', info='invalid from, to or cursor param.')
+    # a job of the same range is running
+    app.redis['{com,example)/}:20140800000000-20169999999999:pending'] = {
+        'job_id': 'abc', 'total': '10', 'stored': '3'}
+    resp = client.get('/simhash?url=example.com&from=201408&to=2016')
+    assert json.loads(resp.data.decode('utf-8'))['status'] == 'PENDING'
+
+
+def test_calculate_simhash_range(app):
+    app.celery = mock.Mock()
+    client = Client(app, response_wrapper=Response)
+    resp = client.get('/calculate-simhash?url=example.com&from=20191201&to=202002')
+    data = json.loads(resp.data.decode('utf-8'))
+    assert data['status'] == 'started'
+    app.celery.send_task.assert_called_once_with(
+        'Discover', args=['example.com', '20191201000000-20200299999999', mock.ANY],
+        kwargs={'from_ts': '20191201000000', 'to_ts': '20200299999999'},
+        task_id=data['job_id'])
+
+
+def test_web_imports():
+    # the web entry point does not load the worker libraries
+    script = ('import sys, wayback_discover_diff.wsgi; '
+              'print(" ".join(sorted(sys.modules)))')
+    env = dict(os.environ, WAYBACK_DISCOVER_DIFF_CONF=os.path.join(
+        os.path.dirname(__file__), '..', 'wayback_discover_diff',
+        'conf.yml.example'))
+    modules = subprocess.run([sys.executable, '-c', script], env=env,
+                             check=True, capture_output=True,
+                             text=True).stdout.split()
+    for module in ('selectolax', 'simhash', 'tldextract', 'numpy',
+                   'wayback_discover_diff.discover'):
+        assert module not in modules
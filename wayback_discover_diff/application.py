@@ -1,13 +1,16 @@
-"""application.py -- top-level web application for wayback-discover-diff.
+"""application.py -- shared initialization of wayback-discover-diff web and
+worker processes: configuration, logging, statsd and profiler.
+
+Each process type has its own entry point which only builds what it needs:
+
+- `wayback_discover_diff.wsgi:APP`: Flask web application,
+- `wayback_discover_diff.worker.CELERY`: Celery app with the Discover task.
 """
 import logging.config
-import os
-from celery import Celery
-from flask_cors import CORS
-from redis import StrictRedis, BlockingConnectionPool
 from wayback_discover_diff import stats
+from wayback_discover_diff.profiler import (SamplingProfiler,
+    install_signal_handler)
 from wayback_discover_diff.util import load_config
-from wayback_discover_diff.discover import Discover
 
 # Init config
 CFG = load_config()
@@ -21,30 +24,26 @@ if logconf:
 stats_conf = CFG.get('statsd')
 if isinstance(stats_conf, dict):
     stats.configure(**stats_conf)
-
-# Init Celery app
-CELERY = Celery(**CFG['celery'])
-CELERY.register_task(Discover(CFG))
-
-# Init Flask app
-from . import web
-APP = web.get_app(CFG)
-
-# Initialize CORS support
-cors = CFG.get('cors')
-if cors:
-    CORS(APP, origins=cors)
-
-# Initialize Celery and Redis
-APP.celery = CELERY
-APP.redis = StrictRedis(
-    connection_pool=BlockingConnectionPool.from_url(
-        **CFG.get('redis')
-        )
-    )
-
-# ensure  the instance folder exists
-try:
-    os.makedirs(APP.instance_path)
-except OSError:
-    pass
+metrics_conf = CFG.get('metrics')
+if isinstance(metrics_conf, dict):
+    stats.configure_metrics(**metrics_conf)
+
+# Init on-demand profiler, see profiler.py
+profiler_conf = dict(CFG.get('profiler') or {})
+profiler_signal = profiler_conf.pop('signal', 'SIGUSR2')
+admin_token = profiler_conf.pop('admin_token', None)
+PROFILER = SamplingProfiler(**profiler_conf)
+install_signal_handler(PROFILER, profiler_signal)
+
+
+def __getattr__(name):
+    """Keep `application.APP` and `application.CELERY` working, importing only
+    the requested entry point.
+    """
+    if name == 'APP':
+        from wayback_discover_diff.wsgi import APP
+        return APP
+    if name == 'CELERY':
+        from wayback_discover_diff.worker import CELERY
+        return CELERY
+    raise AttributeError('module %r has no attribute %r' % (__name__, name))
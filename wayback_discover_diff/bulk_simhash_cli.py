@@ -0,0 +1,409 @@
+#!/usr/bin/env python
+"""Calculate simhashes of the text/html responses stored in local WARC or
+WARC.gz files.
+
+Records are streamed from the files and hashed by a pool of processes.
+Results are written in batches either to Redis, using the same layout as
+`Discover.run` (a hash per SURT with `{timestamp: simhash}`), or to a text
+file with lines `SURT TIMESTAMP SIMHASH`.
+
+    python -m wayback_discover_diff.bulk_simhash_cli --redis redis://localhost:6379/1 \\
+        --checkpoint progress.json *.warc.gz
+
+`--redis-conf` writes to the Redis storage configured in conf.yml
+(`WAYBACK_DISCOVER_DIFF_CONF`) instead, e.g. sharded nodes or a Redis Cluster,
+with the extractor and simhash sizes of its `simhash` section, including
+`extra_sizes`, so that the workers do not consider the results stale.
+
+With `--checkpoint`, the offset of the next record to process is saved per
+file after each batch, so that an interrupted run resumes where it stopped.
+"""
+import argparse
+import json
+import logging
+import os
+import re
+import zlib
+from multiprocessing import Pool
+from surt import surt
+
+from .discover import calculate_simhash, custom_hash_function, encode_simhash
+from .extractors import get_extractor
+from .storage import get_redis
+from .util import (load_config, meta_key, meta_sizes, simhash_key,
+                   simhash_meta, timestamps_key)
+
+
+CHUNK_SIZE = 1024 * 1024
+# Max number of payload digests remembered to skip identical captures.
+MAX_SEEN = 1000000
+
+_logger = logging.getLogger('wayback_discover_diff.bulk')
+
+
+def parse_warc_records(data):
+    """Parse WARC records in `data`. Yield `(headers, block)` for each one.
+    Header names are lowercase.
+    """
+    pos = 0
+    while pos < len(data):
+        end = data.find(b'\r\n\r\n', pos)
+        if end == -1:
+            if data[pos:].strip():
+                raise ValueError('truncated WARC record header')
+            return
+        lines = data[pos:end].decode('utf-8', 'replace').split('\r\n')
+        if not lines[0].startswith('WARC/'):
+            raise ValueError('invalid WARC record: %s' % lines[0][:50])
+        headers = {}
+        for line in lines[1:]:
+            name, _, value = line.partition(':')
+            headers[name.strip().lower()] = value.strip()
+        length = int(headers.get('content-length', 0))
+        block = data[end + 4:end + 4 + length]
+        if len(block) < length:
+            raise ValueError('truncated WARC record block')
+        yield headers, block
+        pos = end + 4 + length
+        # each record is followed by two CRLF
+        while data[pos:pos + 2] == b'\r\n':
+            pos += 2
+
+
+def iter_gzip_members(fileobj, offset=0):
+    """Decompress gzip members from `fileobj` starting at compressed `offset`.
+    Yield `(offset, data)` for each member. WARC.gz files have one record per
+    member so offsets can be used to resume reading.
+    """
+    fileobj.seek(offset)
+    buf = b''
+    while True:
+        decomp = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        start = offset
+        chunks = []
+        while not decomp.eof:
+            if not buf:
+                buf = fileobj.read(CHUNK_SIZE)
+                if not buf:
+                    if chunks:
+                        raise ValueError('truncated gzip member at %d' % start)
+                    return
+            chunks.append(decomp.decompress(buf))
+            if decomp.eof:
+                offset += len(buf) - len(decomp.unused_data)
+                buf = decomp.unused_data
+            else:
+                offset += len(buf)
+                buf = b''
+        yield start, b''.join(chunks)
+
+
+def iter_plain_records(fileobj, offset=0):
+    """Read uncompressed WARC records from `fileobj` starting at `offset`.
+    Yield `(offset, data)` for each record.
+    """
+    fileobj.seek(offset)
+    while True:
+        start = fileobj.tell()
+        lines = []
+        length = 0
+        while True:
+            line = fileobj.readline()
+            if not line:
+                if any(l.strip() for l in lines):
+                    raise ValueError('truncated WARC record at %d' % start)
+                return
+            if line == b'\r\n':
+                if lines:
+                    break
+                # skip blank lines between records
+                start = fileobj.tell()
+                continue
+            lines.append(line)
+            if line.lower().startswith(b'content-length:'):
+                length = int(line.split(b':', 1)[1])
+        block = fileobj.read(length)
+        yield start, b''.join(lines) + b'\r\n' + block
+
+
+def iter_warc_records(path, offset=0):
+    """Read WARC or WARC.gz file `path` starting at `offset`. Yield
+    `(offset, headers, block)` for each record, where `offset` is the position
+    to resume reading from this record.
+    """
+    with open(path, 'rb') as fileobj:
+        if path.endswith('.gz'):
+            members = iter_gzip_members(fileobj, offset)
+        else:
+            members = iter_plain_records(fileobj, offset)
+        for start, data in members:
+            for headers, block in parse_warc_records(data):
+                yield start, headers, block
+
+
+def dechunk(body):
+    """Decode HTTP chunked transfer encoding.
+    """
+    out = []
+    pos = 0
+    while True:
+        end = body.find(b'\r\n', pos)
+        if end == -1:
+            break
+        size = int(body[pos:end].split(b';')[0] or b'0', 16)
+        if size == 0:
+            break
+        out.append(body[end + 2:end + 2 + size])
+        pos = end + 2 + size + 2
+    return b''.join(out)
+
+
+def html_payload(headers, block):
+    """Return the HTTP body of a WARC response record if its a successful
+    text/html response, else None.
+    """
+    if headers.get('warc-type') != 'response':
+        return None
+    if not headers.get('content-type', '').startswith('application/http'):
+        return None
+    end = block.find(b'\r\n\r\n')
+    if end == -1:
+        return None
+    head = block[:end].decode('iso-8859-1').split('\r\n')
+    status = head[0].split(' ')
+    if len(status) < 2 or status[1] != '200':
+        return None
+    http_headers = {}
+    for line in head[1:]:
+        name, _, value = line.partition(':')
+        http_headers[name.strip().lower()] = value.strip().lower()
+    if 'text/html' not in http_headers.get('content-type', ''):
+        return None
+    body = block[end + 4:]
+    if 'chunked' in http_headers.get('transfer-encoding', ''):
+        body = dechunk(body)
+    return body
+
+
+DIGITS_RE = re.compile(r'\D')
+
+
+def warc_timestamp(warc_date):
+    """Convert WARC-Date `2019-01-03T13:35:11Z` to `20190103133511`.
+    """
+    return DIGITS_RE.sub('', warc_date)[:14]
+
+
+def simhash_payload(args):
+    """Return the base64 encoded simhashes of HTML `payload` for each of
+    `sizes` or None. Runs in the process pool.
+    """
+    (payload, sizes, extractor) = args
+    features = get_extractor(extractor)(payload)
+    if not features:
+        return None
+    # smaller simhashes are truncated from the largest, see `encode_simhash`
+    simhash = calculate_simhash(features, max(sizes),
+                                hashfunc=custom_hash_function)
+    return tuple(encode_simhash(simhash, size).decode('ascii')
+                 for size in sizes)
+
+
+class RedisWriter:
+    """Write simhashes to Redis in the layout used by `Discover.run`, on the
+    storage configured by the `redis` section `redis_cfg`, see storage.py.
+    """
+    def __init__(self, redis_cfg, expire, meta):
+        self.redis = get_redis({'redis': redis_cfg})
+        self.expire = expire
+        # extractor signature and simhash sizes, see `Discover.check_extractor`
+        self.meta = meta
+        self.extra_sizes = meta_sizes(meta)[1:]
+
+    def write(self, results):
+        """Write `[(urlkey, timestamp, simhashes)]` using a single pipeline.
+        `simhashes` has one simhash per size of `meta`.
+        """
+        grouped = {}
+        for urlkey, timestamp, simhashes in results:
+            grouped.setdefault(urlkey, {})[timestamp] = simhashes
+        pipe = self.redis.pipeline(transaction=False)
+        for urlkey, mapping in grouped.items():
+            for i, size in enumerate([None] + self.extra_sizes):
+                pipe.hmset(simhash_key(urlkey, size),
+                           {timestamp: simhashes[i]
+                            for timestamp, simhashes in mapping.items()})
+                pipe.expire(simhash_key(urlkey, size), self.expire)
+            pipe.zadd(timestamps_key(urlkey),
+                      {timestamp: int(timestamp) for timestamp in mapping})
+            pipe.expire(timestamps_key(urlkey), self.expire)
+            pipe.hmset(meta_key(urlkey), self.meta)
+            pipe.expire(meta_key(urlkey), self.expire)
+        pipe.execute()
+
+    def close(self):
+        self.redis.close()
+
+
+class FileWriter:
+    """Append simhashes to a text file, one `SURT TIMESTAMP SIMHASH` per line.
+    """
+    def __init__(self, path):
+        self.out = open(path, 'a')
+
+    def write(self, results):
+        # only the default simhash size
+        self.out.writelines('%s %s %s\n' % (urlkey, timestamp, simhashes[0])
+                            for urlkey, timestamp, simhashes in results)
+        self.out.flush()
+
+    def close(self):
+        self.out.close()
+
+
+class Checkpoint:
+    """Offsets of the next record to process per WARC file, saved as JSON.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.offsets = {}
+        if path and os.path.exists(path):
+            with open(path) as cp:
+                self.offsets = json.load(cp)
+
+    def get(self, warc):
+        return self.offsets.get(os.path.abspath(warc), 0)
+
+    def save(self, warc, offset):
+        self.offsets[os.path.abspath(warc)] = offset
+        if self.path:
+            tmp = self.path + '.tmp'
+            with open(tmp, 'w') as cp:
+                json.dump(self.offsets, cp)
+            os.replace(tmp, self.path)
+
+
+def process_batch(pool, batch, seen, sizes, extractor=None):
+    """Calculate simhashes of `[(urlkey, timestamp, digest, payload)]` for
+    each of `sizes`. Only payloads with a digest not seen before are hashed.
+    Return `[(urlkey, timestamp, simhashes)]`.
+    """
+    if len(seen) > MAX_SEEN:
+        seen.clear()
+    todo = {}
+    for _, _, digest, payload in batch:
+        if digest not in seen and digest not in todo:
+            todo[digest] = payload
+    hashes = pool.map(simhash_payload,
+                      [(payload, sizes, extractor)
+                       for payload in todo.values()],
+                      chunksize=16)
+    seen.update(zip(todo.keys(), hashes))
+    return [(urlkey, timestamp, seen[digest])
+            for urlkey, timestamp, digest, _ in batch if seen[digest]]
+
+
+def process_warc(path, pool, writer, checkpoint, args, seen):
+    """Process WARC file `path` from its checkpoint offset. Return the number
+    of simhashes written.
+    """
+    offset = checkpoint.get(path)
+    size = os.path.getsize(path)
+    if offset >= size:
+        _logger.info('skipping already processed %s', path)
+        return 0
+    written = 0
+    batch = []
+    for record_offset, headers, block in iter_warc_records(path, offset):
+        if len(batch) >= args.batch_size and record_offset != offset:
+            results = process_batch(pool, batch, seen, args.sizes,
+                                    args.extractor)
+            writer.write(results)
+            written += len(results)
+            # resume from the first record not yet written
+            checkpoint.save(path, record_offset)
+            batch = []
+        offset = record_offset
+        payload = html_payload(headers, block)
+        if payload is None:
+            continue
+        uri = headers.get('warc-target-uri', '')
+        try:
+            urlkey = surt(uri)
+        except ValueError:
+            _logger.warning('invalid URL %s in %s', uri, path)
+            continue
+        digest = headers.get('warc-payload-digest') or hash(payload)
+        batch.append((urlkey, warc_timestamp(headers.get('warc-date', '')),
+                      digest, payload))
+    if batch:
+        results = process_batch(pool, batch, seen, args.sizes,
+                                args.extractor)
+        writer.write(results)
+        written += len(results)
+    checkpoint.save(path, size)
+    _logger.info('%d simhashes from %s', written, path)
+    return written
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('warcs', nargs='+', help='WARC or WARC.gz files')
+    output = parser.add_mutually_exclusive_group(required=True)
+    output.add_argument('--redis', help='write results to this Redis URL')
+    output.add_argument('--redis-conf', action='store_true',
+                        help='write results to the Redis storage of conf.yml')
+    output.add_argument('--output', help='append results to this file')
+    parser.add_argument('--checkpoint', help='JSON file to save progress')
+    parser.add_argument('--simhash-size', type=int,
+                        help='simhash size, 256 by default or the one of '
+                             'conf.yml with --redis-conf')
+    parser.add_argument('--extractor',
+                        help='feature extractor, see extractors.py, unigram '
+                             'by default or the one of conf.yml with '
+                             '--redis-conf')
+    parser.add_argument('--expire', type=int, default=86400,
+                        help='expiration of Redis keys in seconds')
+    parser.add_argument('--processes', type=int, default=os.cpu_count())
+    parser.add_argument('--batch-size', type=int, default=1000)
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+
+    if args.redis_conf:
+        cfg = load_config()
+        meta = simhash_meta(cfg)
+        # the workers would consider simhashes of other settings stale
+        if ((args.simhash_size is not None and
+             args.simhash_size != int(meta['size'])) or
+                (args.extractor is not None and
+                 get_extractor(args.extractor).signature != meta['extractor'])):
+            parser.error('--simhash-size and --extractor must match the '
+                         'simhash section of conf.yml with --redis-conf')
+        args.extractor = (cfg.get('simhash') or {}).get('extractor')
+    else:
+        meta = simhash_meta({'simhash': {'size': args.simhash_size or 256,
+                                         'extractor': args.extractor}})
+    args.sizes = meta_sizes(meta)
+    if args.redis_conf:
+        writer = RedisWriter(cfg['redis'], args.expire, meta)
+    elif args.redis:
+        writer = RedisWriter({'url': args.redis, 'decode_responses': True},
+                             args.expire, meta)
+    else:
+        writer = FileWriter(args.output)
+    checkpoint = Checkpoint(args.checkpoint)
+    # payload digest -> simhash, to skip identical captures
+    seen = {}
+    total = 0
+    try:
+        with Pool(args.processes) as pool:
+            for path in args.warcs:
+                total += process_warc(path, pool, writer, checkpoint, args, seen)
+    finally:
+        writer.close()
+    _logger.info('%d simhashes written', total)
+
+
+if __name__ == '__main__':
+    main()
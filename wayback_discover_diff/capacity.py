@@ -0,0 +1,237 @@
+"""Capacity metrics used to scale workers on the capture backlog.
+
+If the `capacity` section of conf.yml is set, workers record the jobs they run
+in the `capacity:jobs` sorted set and their throughput (captures per second)
+and downloads in progress in a `capacity:worker:<host>-<pid>` hash refreshed
+with the job progress, which expires after `worker_expire` seconds. The
+`Capacity` task, run periodically by Celery beat, collects:
+
+- the number of messages waiting in each Celery queue,
+- the active and reserved tasks of the workers (`celery inspect`),
+- the captures remaining in running jobs, from their progress counters,
+- the throughput and download concurrency of each worker,
+
+sends them to statsd as gauges and stores them in `capacity:snapshot`, which
+the web app serves on `/capacity`.
+"""
+import json
+import logging
+import os
+import socket
+import threading
+from contextlib import contextmanager
+from time import time
+from celery import Task
+from kombu.exceptions import OperationalError
+from amqp.exceptions import ChannelError
+from redis.exceptions import RedisError
+
+from .stats import statsd_gauge
+from .storage import get_redis
+from .util import progress_key
+
+
+_logger = logging.getLogger('wayback_discover_diff.capacity')
+
+JOBS_KEY = 'capacity:jobs'
+WORKERS_KEY = 'capacity:workers'
+SNAPSHOT_KEY = 'capacity:snapshot'
+
+
+def worker_key(name):
+    """Redis key of the stats of worker process `name`.
+    """
+    return 'capacity:worker:%s' % name
+
+
+class WorkerStats:
+    """Captures processed and downloads in progress in a worker process.
+    Downloads are counted by the download threads, captures by the job loop.
+    """
+
+    def __init__(self, threads, expire=60):
+        self.threads = threads
+        self.expire = expire
+        self.captures = 0
+        self.downloads = 0
+        self.last_flush = time()
+        self.last_captures = 0
+        self._lock = threading.Lock()
+
+    @property
+    def name(self):
+        # after the fork of Celery worker processes
+        return '%s-%d' % (socket.gethostname(), os.getpid())
+
+    @contextmanager
+    def downloading(self):
+        """Count a download in progress.
+        """
+        with self._lock:
+            self.downloads += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.downloads -= 1
+
+    def flush(self, redis):
+        """Write the captures per second since the last flush and the current
+        downloads.
+        """
+        now = time()
+        rate = (self.captures - self.last_captures) / max(now - self.last_flush,
+                                                          0.001)
+        name = self.name
+        pipe = redis.pipeline(transaction=False)
+        pipe.hmset(worker_key(name), {'captures_per_sec': round(rate, 2),
+                                      'downloads': self.downloads,
+                                      'threads': self.threads})
+        pipe.expire(worker_key(name), self.expire)
+        pipe.zadd(WORKERS_KEY, {name: now})
+        pipe.execute()
+        self.last_flush = now
+        self.last_captures = self.captures
+
+
+def job_started(pipe, job_id):
+    """Add a running job to pipeline `pipe`.
+    """
+    pipe.zadd(JOBS_KEY, {job_id: time()})
+
+
+def job_finished(pipe, job_id):
+    """Remove a finished job in pipeline `pipe`.
+    """
+    pipe.zrem(JOBS_KEY, job_id)
+
+
+def captures_remaining(redis, max_age):
+    """Return the number of running jobs started in the last `max_age`
+    seconds and their captures not processed yet.
+    """
+    redis.zremrangebyscore(JOBS_KEY, 0, time() - max_age)
+    jobs = redis.zrangebyscore(JOBS_KEY, time() - max_age, '+inf')
+    pipe = redis.pipeline(transaction=False)
+    for job_id in jobs:
+        pipe.hmget(progress_key(job_id), ['total', 'cached', 'hashed', 'failed'])
+    remaining = 0
+    for counters in pipe.execute():
+        (total, cached, hashed, failed) = [int(value or 0) for value in counters]
+        remaining += max(total - cached - hashed - failed, 0)
+    return (len(jobs), remaining)
+
+
+def worker_stats(redis, max_age):
+    """Return the stats of the worker processes updated in the last `max_age`
+    seconds.
+    """
+    redis.zremrangebyscore(WORKERS_KEY, 0, time() - max_age)
+    names = redis.zrangebyscore(WORKERS_KEY, time() - max_age, '+inf')
+    pipe = redis.pipeline(transaction=False)
+    for name in names:
+        pipe.hgetall(worker_key(name))
+    workers = {}
+    for name, stats in zip(names, pipe.execute()):
+        if stats:
+            workers[name] = {'captures_per_sec': float(stats.get('captures_per_sec', 0)),
+                             'downloads': int(stats.get('downloads', 0)),
+                             'threads': int(stats.get('threads', 0))}
+    return workers
+
+
+def count_tasks(replies):
+    """Return the number of tasks by name in `celery inspect` replies.
+    """
+    counts = {}
+    for tasks in (replies or {}).values():
+        for task in tasks:
+            name = task.get('name') or task.get('type')
+            counts[name] = counts.get(name, 0) + 1
+    return counts
+
+
+class Capacity(Task):
+    """Celery beat task publishing capacity metrics.
+    """
+    name = 'Capacity'
+
+    def __init__(self, cfg):
+        conf = cfg.get('capacity') or {}
+        celery_conf = cfg.get('celery') or {}
+        self.queues = [celery_conf.get('task_default_queue', 'celery')] + \
+            [queue for queue in conf.get('queues', [])
+             if queue != celery_conf.get('task_default_queue')]
+        self.inspect_timeout = conf.get('inspect_timeout', 1)
+        self.expire = conf.get('expire', 300)
+        self.worker_expire = conf.get('worker_expire', 60)
+        # jobs are not running anymore after the task time limit
+        self.job_max_age = celery_conf.get('task_soft_time_limit', 7200)
+        self.redis = get_redis(cfg)
+
+    def run(self):
+        """Collect, publish and return a capacity snapshot.
+        """
+        snapshot = {'time': int(time()), 'queues': self.queue_depths()}
+        inspect = self.app.control.inspect(timeout=self.inspect_timeout)
+        snapshot['tasks'] = {'active': count_tasks(inspect.active()),
+                             'reserved': count_tasks(inspect.reserved())}
+        try:
+            (jobs, remaining) = captures_remaining(self.redis, self.job_max_age)
+            workers = worker_stats(self.redis, self.worker_expire)
+        except (RedisError, ValueError):
+            _logger.error('cannot load capacity metrics', exc_info=1)
+            return None
+        rate = sum(worker['captures_per_sec'] for worker in workers.values())
+        snapshot.update(
+            running_jobs=jobs, captures_remaining=remaining,
+            captures_per_sec=round(rate, 2),
+            downloads=sum(worker['downloads'] for worker in workers.values()),
+            download_threads=sum(worker['threads'] for worker in workers.values()),
+            # time to process the backlog of running jobs at the current rate
+            backlog_seconds=int(remaining / rate) if rate else None,
+            workers=workers)
+        self.publish(snapshot)
+        return snapshot
+
+    def queue_depths(self):
+        """Return the number of messages and consumers of each queue.
+        """
+        depths = {}
+        try:
+            with self.app.connection_for_read() as conn:
+                for queue in self.queues:
+                    try:
+                        (_, messages, consumers) = conn.default_channel.queue_declare(
+                            queue=queue, passive=True)
+                    except ChannelError:
+                        # the queue does not exist until a task is sent to it
+                        (messages, consumers) = (0, 0)
+                    depths[queue] = {'messages': messages,
+                                     'consumers': consumers}
+        except OperationalError:
+            _logger.error('cannot get Celery queue depths', exc_info=1)
+        return depths
+
+    def publish(self, snapshot):
+        """Send the snapshot gauges to statsd and store it for `/capacity`.
+        """
+        for queue, depth in snapshot['queues'].items():
+            statsd_gauge('queue-depth.%s' % queue, depth['messages'])
+        for state, counts in snapshot['tasks'].items():
+            statsd_gauge('tasks-%s' % state, sum(counts.values()))
+        for metric in ('running_jobs', 'captures_remaining', 'captures_per_sec',
+                       'downloads'):
+            statsd_gauge(metric.replace('_', '-'), snapshot[metric])
+        try:
+            self.redis.set(SNAPSHOT_KEY, json.dumps(snapshot), ex=self.expire)
+        except RedisError:
+            _logger.error('cannot store capacity snapshot', exc_info=1)
+
+
+def get_snapshot(redis):
+    """Return the last capacity snapshot published by the `Capacity` task or
+    None.
+    """
+    snapshot = redis.get(SNAPSHOT_KEY)
+    return json.loads(snapshot) if snapshot else None
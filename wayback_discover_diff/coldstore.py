@@ -0,0 +1,370 @@
+"""On-disk cold tier of simhash data behind Redis.
+
+Simhashes expire from Redis after `simhash.expire_after`. Workers also append
+them to a cold store so that they can be promoted back into Redis on a miss
+instead of being recomputed by re-downloading every capture.
+
+A store is a directory with two files of fixed size records:
+
+- `simhash.dat`: records sorted by URL key and timestamp, followed by a sparse
+  index of every `INDEX_STRIDE`-th record key. It is memory-mapped, lookups
+  bisect the sparse index then the records of one block, and simhashes are
+  returned as zero-copy slices of the mapping.
+- `simhash.log`: records appended by the workers, unsorted. Each process
+  keeps an in-memory index of the log offsets of every URL key hash, updated
+  with the records appended since the last lookup.
+
+Both files start with a header `magic, version, simhash bytes, record count,
+index offset`. Records are `blake2b(signature, urlkey)[:16], timestamp
+(uint64 big endian), simhash`. The extractor signature in the URL key hash
+keeps simhashes calculated with other extractors out of lookups, they are
+never promoted after a configuration change. A record with a 4 digit
+timestamp (the year) and an empty simhash marks a year without captures.
+Only the default simhash size is stored, the extra sizes which are not larger
+are truncated from it on promotion, see `discover.encode_simhash`.
+
+`compact` merges the log into the sorted file. It is meant to run offline,
+e.g. from cron: `python -m wayback_discover_diff.coldstore compact PATH`.
+"""
+import argparse
+import base64
+import fcntl
+import hashlib
+import logging
+import mmap
+import os
+import struct
+from bisect import bisect_right
+
+from .util import (meta_key, meta_sizes, simhash_key, simhash_meta,
+                   timestamps_key)
+
+
+HEADER = struct.Struct('>4sBBxxQQ')
+MAGIC = b'WDDC'
+VERSION = 1
+KEY_SIZE = 24
+INDEX_STRIDE = 256
+SORTED_FILE = 'simhash.dat'
+LOG_FILE = 'simhash.log'
+
+_logger = logging.getLogger('wayback_discover_diff.coldstore')
+
+
+def url_hash(urlkey, signature=None):
+    """Return the 16 byte hash of a SURT URL key and extractor `signature`
+    used in records.
+    """
+    if signature:
+        urlkey = '%s %s' % (signature, urlkey)
+    return hashlib.blake2b(urlkey.encode('utf-8'), digest_size=16).digest()
+
+
+def record_key(keyhash, timestamp):
+    """Return the sort key of a record, `timestamp` can be a year.
+    """
+    return keyhash + int(timestamp).to_bytes(8, 'big')
+
+
+class ColdStore:
+    """Reader and appender of a cold store directory `path`. `expire` is the
+    expiration of entries promoted into Redis. `meta` is the extractor
+    signature and simhash sizes of the simhashes, see `simhash_meta`.
+    """
+
+    def __init__(self, path, simhash_size, expire=86400, meta=None):
+        self.path = path
+        self.meta = meta
+        self.signature = meta['extractor'] if meta else None
+        self.simhash_bytes = simhash_size // 8
+        self.record_size = KEY_SIZE + self.simhash_bytes
+        self.expire = expire
+        self._sorted = None
+        self._log = None
+        # log file inode, number of indexed records, {keyhash: [offsets]}
+        self._log_index = (None, 0, {})
+        os.makedirs(path, exist_ok=True)
+
+    def _open(self, name):
+        """Map file `name`. Return `(stat, mmap, count, index)` or None if it
+        does not exist.
+        """
+        filename = os.path.join(self.path, name)
+        try:
+            fd = os.open(filename, os.O_RDONLY)
+        except FileNotFoundError:
+            return None
+        try:
+            stat = os.fstat(fd)
+            if stat.st_size <= HEADER.size:
+                return (stat, None, 0, [])
+            mapping = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+        finally:
+            os.close(fd)
+        (magic, _, simhash_bytes, count, index_offset) = HEADER.unpack_from(mapping)
+        if magic != MAGIC or simhash_bytes != self.simhash_bytes:
+            mapping.close()
+            raise ValueError('%s is not a cold store of %d bit simhashes' % (
+                filename, self.simhash_bytes * 8))
+        index = []
+        if index_offset:
+            index = [mapping[pos:pos + KEY_SIZE]
+                     for pos in range(index_offset, len(mapping), KEY_SIZE)]
+        else:
+            count = (stat.st_size - HEADER.size) // self.record_size
+        return (stat, mapping, count, index)
+
+    def _current(self, attr, name):
+        """Return the mapping of file `name`, remap it if it has been replaced
+        by `compact` or if records have been appended.
+        """
+        current = getattr(self, attr)
+        try:
+            stat = os.stat(os.path.join(self.path, name))
+        except FileNotFoundError:
+            return None
+        if (current is None or current[0].st_ino != stat.st_ino or
+                current[0].st_size != stat.st_size):
+            # The previous mapping is closed once the simhash slices returned
+            # by lookups are released.
+            current = self._open(name)
+            setattr(self, attr, current)
+        return current
+
+    def _sorted_range(self, start_key, end_key):
+        """Yield `(key, simhash)` slices of sorted records with
+        `start_key <= key <= end_key`.
+        """
+        current = self._current('_sorted', SORTED_FILE)
+        if not current or not current[2]:
+            return
+        (_, mapping, count, index) = current
+        size = self.record_size
+        # the first block which may contain start_key
+        block = max(bisect_right(index, start_key) - 1, 0)
+        low, high = block * INDEX_STRIDE, min((block + 1) * INDEX_STRIDE, count)
+        while low < high:
+            mid = (low + high) // 2
+            pos = HEADER.size + mid * size
+            if mapping[pos:pos + KEY_SIZE] < start_key:
+                low = mid + 1
+            else:
+                high = mid
+        view = memoryview(mapping)
+        pos = HEADER.size + low * size
+        end = HEADER.size + count * size
+        while pos < end:
+            key = mapping[pos:pos + KEY_SIZE]
+            if key > end_key:
+                break
+            yield key, view[pos + KEY_SIZE:pos + size]
+            pos += size
+
+    def _log_range(self, keyhash, start_key, end_key):
+        """Yield `(key, simhash)` slices of appended records for `keyhash` with
+        `start_key <= key <= end_key`, in append order.
+        """
+        current = self._current('_log', LOG_FILE)
+        if not current or not current[2]:
+            return
+        mapping = current[1]
+        size = self.record_size
+        view = memoryview(mapping)
+        for pos in self._log_offsets(current).get(keyhash, ()):
+            key = mapping[pos:pos + KEY_SIZE]
+            if start_key <= key <= end_key:
+                yield key, view[pos + KEY_SIZE:pos + size]
+
+    def _log_offsets(self, current):
+        """Return `{keyhash: [offsets]}` of the records of the log mapping
+        `current`. Only the records appended since the last call are read,
+        the index is rebuilt when `compact` has replaced the log.
+        """
+        (stat, mapping, count, _) = current
+        (ino, indexed, offsets) = self._log_index
+        if ino != stat.st_ino or indexed > count:
+            (indexed, offsets) = (0, {})
+        size = self.record_size
+        for pos in range(HEADER.size + indexed * size,
+                         HEADER.size + count * size, size):
+            offsets.setdefault(mapping[pos:pos + 16], []).append(pos)
+        self._log_index = (stat.st_ino, count, offsets)
+        return offsets
+
+    def year(self, urlkey, year):
+        """Return `{timestamp: simhash bytes}` of `urlkey` captures in `year`.
+        A year marked without captures returns `{year: None}`. Return an
+        empty dict if nothing is stored.
+        """
+        return self.range(urlkey, '%s0000000000' % year, '%s9999999999' % year)
+
+    def range(self, urlkey, start, end):
+        """Return `{timestamp: simhash bytes}` of `urlkey` captures from `start`
+        to `end` (14 digit timestamps) and `{year: None}` for the years of
+        the range marked without captures.
+        """
+        keyhash = url_hash(urlkey, self.signature)
+        results = {}
+        for start_key, end_key in (
+                (record_key(keyhash, start[:4]), record_key(keyhash, end[:4])),
+                (record_key(keyhash, start), record_key(keyhash, end))):
+            # appended records are newer than sorted ones
+            for key, simhash in self._sorted_range(start_key, end_key):
+                results[key] = simhash
+            for key, simhash in self._log_range(keyhash, start_key, end_key):
+                results[key] = simhash
+        output = {}
+        for key, simhash in results.items():
+            timestamp = str(int.from_bytes(key[16:], 'big'))
+            output[timestamp] = simhash if len(timestamp) > 4 else None
+        return output
+
+    def append(self, urlkey, results):
+        """Append `{timestamp: base64 simhash}` of `urlkey` to the log. A
+        `{year: None}` entry marks a year without captures.
+        """
+        keyhash = url_hash(urlkey, self.signature)
+        empty = bytes(self.simhash_bytes)
+        records = b''.join(
+            record_key(keyhash, timestamp) +
+            (base64.b64decode(simhash) if simhash else empty)
+            for timestamp, simhash in results.items())
+        filename = os.path.join(self.path, LOG_FILE)
+        while True:
+            fd = os.open(filename, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                # retry if `compact` has replaced the log meanwhile
+                if os.fstat(fd).st_ino != os.stat(filename).st_ino:
+                    continue
+                if os.fstat(fd).st_size == 0:
+                    os.write(fd, HEADER.pack(MAGIC, VERSION, self.simhash_bytes, 0, 0))
+                os.write(fd, records)
+                return
+            finally:
+                os.close(fd)
+
+    def promote_year(self, redis, urlkey, year):
+        """Copy `urlkey` captures of `year` from the cold store into Redis,
+        with the metadata of the store. Return True if there were any.
+        """
+        return self._promote(redis, urlkey, self.year(urlkey, year))
+
+    def promote(self, redis, urlkey, start, end):
+        """Copy `urlkey` captures from `start` to `end` (14 digit timestamps)
+        from the cold store into Redis. Return True if there were any.
+        """
+        return self._promote(redis, urlkey, self.range(urlkey, start, end))
+
+    def _promote(self, redis, urlkey, results):
+        """Write `results` and the extra simhash sizes which can be truncated
+        from them to Redis, with metadata listing the sizes written. Extra
+        sizes larger than the stored simhashes are not restored, the
+        metadata then does not match the configuration and the simhashes
+        are recalculated.
+        """
+        if not results:
+            return False
+        meta = dict(self.meta) if self.meta else None
+        sizes = [None]
+        if meta:
+            extra_sizes = [size for size in meta_sizes(meta)[1:]
+                           if size <= self.simhash_bytes * 8]
+            meta.pop('extra_sizes', None)
+            if extra_sizes:
+                meta['extra_sizes'] = ','.join(map(str, extra_sizes))
+            sizes += extra_sizes
+        pipe = redis.pipeline(transaction=False)
+        for size in sizes:
+            # the lower bits of a little endian simhash are its first bytes
+            length = size // 8 if size else self.simhash_bytes
+            mapping = {}
+            for timestamp, simhash in results.items():
+                if simhash is None:
+                    mapping[timestamp] = -1
+                else:
+                    mapping[timestamp] = base64.b64encode(
+                        simhash[:length]).decode('ascii')
+            pipe.hmset(simhash_key(urlkey, size), mapping)
+            pipe.expire(simhash_key(urlkey, size), self.expire)
+        timestamps = {timestamp: int(timestamp) for timestamp in results
+                      if len(timestamp) == 14}
+        if timestamps:
+            pipe.zadd(timestamps_key(urlkey), timestamps)
+            pipe.expire(timestamps_key(urlkey), self.expire)
+        if meta:
+            pipe.hmset(meta_key(urlkey), meta)
+            pipe.expire(meta_key(urlkey), self.expire)
+        pipe.execute()
+        return True
+
+    def compact(self):
+        """Merge appended records into the sorted file. Both files are
+        replaced, not modified, so that readers keep working on their current
+        mappings during compaction. Return the number of records in the
+        sorted file.
+        """
+        size = self.record_size
+        log_name = os.path.join(self.path, LOG_FILE)
+        sorted_name = os.path.join(self.path, SORTED_FILE)
+        fd = os.open(log_name, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            # block appends until the log is replaced
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            records = {}
+            current = self._open(SORTED_FILE)
+            if current and current[2]:
+                mapping = current[1]
+                for pos in range(HEADER.size, HEADER.size + current[2] * size, size):
+                    records[mapping[pos:pos + KEY_SIZE]] = mapping[pos + KEY_SIZE:pos + size]
+                mapping.close()
+            current = self._open(LOG_FILE)
+            if current and current[2]:
+                mapping = current[1]
+                for pos in range(HEADER.size, HEADER.size + current[2] * size, size):
+                    records[mapping[pos:pos + KEY_SIZE]] = mapping[pos + KEY_SIZE:pos + size]
+                mapping.close()
+            keys = sorted(records)
+            index_offset = HEADER.size + len(keys) * size
+            tmp_name = sorted_name + '.tmp'
+            with open(tmp_name, 'wb') as out:
+                out.write(HEADER.pack(MAGIC, VERSION, self.simhash_bytes,
+                                      len(keys), index_offset))
+                for key in keys:
+                    out.write(key)
+                    out.write(records[key])
+                out.writelines(keys[::INDEX_STRIDE])
+                out.flush()
+                os.fsync(out.fileno())
+            os.replace(tmp_name, sorted_name)
+            with open(log_name + '.tmp', 'wb') as out:
+                out.write(HEADER.pack(MAGIC, VERSION, self.simhash_bytes, 0, 0))
+            os.replace(log_name + '.tmp', log_name)
+        finally:
+            os.close(fd)
+        _logger.info('compacted %d records in %s', len(keys), self.path)
+        return len(keys)
+
+
+def get_coldstore(cfg):
+    """Return the cold store configured in `cfg` or None.
+    """
+    path = (cfg.get('coldstore') or {}).get('path')
+    if not path:
+        return None
+    return ColdStore(path, cfg['simhash']['size'],
+                     cfg['simhash']['expire_after'], simhash_meta(cfg))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Maintain a simhash cold store.')
+    parser.add_argument('command', choices=['compact'])
+    parser.add_argument('path', help='cold store directory')
+    parser.add_argument('--simhash-size', type=int, default=256)
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+    ColdStore(args.path, args.simhash_size).compact()
+
+
+if __name__ == '__main__':
+    main()
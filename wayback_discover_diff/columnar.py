@@ -0,0 +1,90 @@
+"""Columnar binary encoding of the captures of a year returned by `/simhash`
+when the client sends `Accept: application/x-simhash-columnar`.
+
+All integers are little endian:
+
+- header: magic `WDDS`, version (uint8), simhash bytes (uint8), year (uint16),
+  capture count (uint32),
+- capture times: one uint32 per capture, seconds since the start of the year
+  for the first capture then since the previous capture (captures are sorted),
+- simhashes: raw simhash bytes of each capture, in the same order.
+
+Captures without a simhash are omitted.
+"""
+import base64
+import struct
+import sys
+from array import array
+from binascii import a2b_base64
+from datetime import date
+
+
+MIMETYPE = 'application/x-simhash-columnar'
+HEADER = struct.Struct('<4sBBHI')
+MAGIC = b'WDDS'
+VERSION = 1
+# Seconds of the `HHMM` and `SS` parts of timestamps, faster than int().
+_HOUR_MINUTE = {'%02d%02d' % (hour, minute): hour * 3600 + minute * 60
+                for hour in range(100) for minute in range(100)}
+_SECOND = {'%02d' % second: second for second in range(100)}
+
+
+def encode_captures(captures, year):
+    """Encode `[[timestamp, base64 simhash]]` captures of `year`.
+    """
+    year_start = date(year, 1, 1).toordinal()
+    # 14 digit timestamps sort like the times they represent
+    rows = sorted(capture for capture in captures
+                  if capture[1] is not None and capture[0] != 'pages')
+    day_seconds = {}
+    deltas = array('I')
+    previous = 0
+    try:
+        for timestamp, _ in rows:
+            day = timestamp[0:8]
+            seconds = day_seconds.get(day)
+            if seconds is None:
+                seconds = day_seconds[day] = (date(
+                    int(day[0:4]), int(day[4:6]), int(day[6:8])).toordinal() -
+                    year_start) * 86400
+            seconds += _HOUR_MINUTE[timestamp[8:12]] + _SECOND[timestamp[12:14]]
+            deltas.append(seconds - previous)
+            previous = seconds
+    except (KeyError, OverflowError) as exc:
+        raise ValueError('invalid capture timestamp of year %s' % year) from exc
+    if sys.byteorder == 'big':
+        deltas.byteswap()
+    hashes = [a2b_base64(simhash) for _, simhash in rows]
+    simhash_bytes = len(hashes[0]) if hashes else 0
+    if any(len(simhash) != simhash_bytes for simhash in hashes):
+        raise ValueError('simhashes of different sizes')
+    return b''.join((HEADER.pack(MAGIC, VERSION, simhash_bytes, year, len(rows)),
+                     deltas.tobytes(), b''.join(hashes)))
+
+
+def decode_captures(data):
+    """Decode `encode_captures` output. Return `(year, [[timestamp, base64
+    simhash]])`.
+    """
+    (magic, version, simhash_bytes, year, count) = HEADER.unpack_from(data)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError('invalid columnar captures data')
+    pos = HEADER.size
+    deltas = array('I')
+    deltas.frombytes(data[pos:pos + count * 4])
+    if sys.byteorder == 'big':
+        deltas.byteswap()
+    pos += count * 4
+    year_start = date(year, 1, 1).toordinal()
+    captures = []
+    seconds = 0
+    for i, delta in enumerate(deltas):
+        seconds += delta
+        (days, rest) = divmod(seconds, 86400)
+        day = date.fromordinal(year_start + days)
+        timestamp = '%04d%02d%02d%02d%02d%02d' % (
+            day.year, day.month, day.day, rest // 3600, rest // 60 % 60,
+            rest % 60)
+        simhash = data[pos + i * simhash_bytes:pos + (i + 1) * simhash_bytes]
+        captures.append([timestamp, base64.b64encode(simhash).decode('ascii')])
+    return (year, captures)
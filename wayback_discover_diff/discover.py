@@ -2,55 +2,68 @@
 """
 from concurrent.futures import ThreadPoolExecutor
 import hashlib
+import json
 import logging
-import string
 from time import time
-from datetime import datetime
-import cProfile
 import base64
-from itertools import groupby
-from celery import Task
+from threading import Lock
+from celery import Task, chord
+from celery.exceptions import ChordError
 import urllib3
 from urllib3.exceptions import HTTPError
-from redis import StrictRedis, BlockingConnectionPool
 from redis.exceptions import RedisError
 from simhash import Simhash
 from surt import surt
-from selectolax.parser import HTMLParser
 from werkzeug.urls import url_fix
 
-from .stats import statsd_incr, statsd_timing
+from .capacity import WorkerStats, job_finished, job_started
+from .coldstore import get_coldstore
+from .extractors import UnigramExtractor, get_extractor
+from .prewarm import DownloadBudget
+from .stats import statsd_incr, statsd_timing, timing
+from .storage import get_redis
+from .upstream import get_upstreams
+from .util import (pending_key, progress_key, compressed_key, compress_captures,
+                   job_key, job_expire, meta_key, negative_key, simhash_key,
+                   simhash_meta, stale_simhashes, timestamps_key,
+                   year_timestamps)
 
 # https://urllib3.readthedocs.io/en/latest/advanced-usage.html#ssl-warnings
 urllib3.disable_warnings()
 
 
-TRANSLATOR = str.maketrans(string.punctuation, ' '*len(string.punctuation))
+UNIGRAM = UnigramExtractor()
+
+# CDX mimetypes of captures which may be HTML, e.g. revisit records.
+UNKNOWN_MIMETYPES = frozenset(('-', 'unk', 'warc/revisit'))
+
+
+def is_text_mimetype(mimetype):
+    """Return True if captures of `mimetype` may be text or HTML, like the
+    content-type check of `Discover.download_capture`.
+    """
+    mimetype = mimetype.lower()
+    return ('text' in mimetype or 'html' in mimetype or
+            mimetype in UNKNOWN_MIMETYPES)
 
 
 def extract_html_features(html):
-    """Process HTML document and get key features as text. Steps:
-    kill all script and style elements
-    get lowercase text
-    remove all punctuation
-    break into lines and remove leading and trailing space on each
-    break multi-headlines into a line each
-    drop blank lines
-    return a dict with features and their weights
+    """Process HTML document and get key features as text: the count of
+    each lowercase word of the visible text without punctuation. See
+    extractors.py for the other feature extractors.
+    """
+    return UNIGRAM(html)
+
+
+def split_captures(captures, size):
+    """Split `captures` in consecutive chunks of at most `size` captures and
+    about the same length.
     """
-    try:
-        tree = HTMLParser(html)
-        tree.strip_tags(['script', 'style'])
-        text = tree.root.text(separator=' ')
-        if not text:
-            return {}
-    except UnicodeDecodeError:
-        return {}
-    text = text.lower().translate(TRANSLATOR)
-    lines = (line.strip() for line in text.splitlines())
-    chunks = (phrase.strip() for line in lines for phrase in line.split("  "))
-    text = '\n'.join(chunk for chunk in chunks if chunk)
-    return {k: sum(1 for _ in g) for k, g in groupby(sorted(text.split()))}
+    if not captures:
+        return []
+    count = -(-len(captures) // size)
+    length = -(-len(captures) // count)
+    return [captures[i:i + length] for i in range(0, len(captures), length)]
 
 
 def custom_hash_function(x):
@@ -68,6 +81,16 @@ def calculate_simhash(features_dict, simhash_size, hashfunc=None):
     return Simhash(features_dict, simhash_size).value
 
 
+def encode_simhash(simhash, simhash_size):
+    """Return the base64 encoded `simhash_size` bits simhash of a larger
+    simhash. The bits of a simhash only depend on the same bits of the
+    feature hashes, so a simhash truncated to its `simhash_size` lower bits
+    is the simhash of that size.
+    """
+    simhash &= (1 << simhash_size) - 1
+    return base64.b64encode(pack_simhash_to_bytes(simhash, simhash_size))
+
+
 def pack_simhash_to_bytes(simhash, simhash_size=None):
     # simhash_value = simhash.value
     if simhash_size is None:
@@ -77,12 +100,64 @@ def pack_simhash_to_bytes(simhash, simhash_size=None):
     return simhash.to_bytes(size_in_bytes, byteorder='little')
 
 
+class JobProgress:
+    """Job progress counters (fetched, cached, hashed, failed, total) kept in
+    a small Redis hash which `/job` reads directly. Counters are incremented
+    locally by the download threads and written with pipelined HINCRBY at most
+    every `interval` seconds, so the number of Redis writes per job does not
+    depend on the number of captures.
+    """
+    fields = ('fetched', 'cached', 'hashed', 'failed')
+
+    def __init__(self, redis, job_id, interval, expire):
+        self.redis = redis
+        self.key = progress_key(job_id)
+        self.interval = interval
+        self.expire = expire
+        self.counters = dict.fromkeys(self.fields, 0)
+        self.last_flush = time()
+        self._lock = Lock()
+
+    def incr(self, field):
+        """Increment a local counter. Thread-safe.
+        """
+        with self._lock:
+            self.counters[field] += 1
+
+    def update(self, **fields):
+        """Set job info fields (e.g. state, total) and write pending counters.
+        """
+        pipe = self.redis.pipeline(transaction=False)
+        if fields:
+            pipe.hmset(self.key, fields)
+        self.flush(pipe)
+
+    def due(self):
+        """Return True if `interval` seconds have passed since the last write.
+        """
+        return time() - self.last_flush >= self.interval
+
+    def flush(self, pipe):
+        """Add counter increments to pipeline `pipe` and execute it.
+        """
+        with self._lock:
+            counters = self.counters
+            self.counters = dict.fromkeys(self.fields, 0)
+        for field, value in counters.items():
+            if value:
+                pipe.hincrby(self.key, field, value)
+        pipe.expire(self.key, self.expire)
+        pipe.execute()
+        self.last_flush = time()
+
+
 class Discover(Task):
     """Custom Celery Task class.
     http://docs.celeryproject.org/en/latest/userguide/tasks.html#custom-task-classes
     """
     name = 'Discover'
     task_id = None
+    job_id = None
     # If a simhash calculation for a URL & year does more than
     # `max_download_errors`, stop it to avoid pointless requests. The captures
     # are not text/html or there is a problem with the WBM.
@@ -92,8 +167,18 @@ class Discover(Task):
     def __init__(self, cfg):
         self.simhash_size = cfg['simhash']['size']
         self.simhash_expire = cfg['simhash']['expire_after']
-        if self.simhash_size > 512:
+        # Other simhash sizes derived from the same feature hashes and stored
+        # side by side, see `simhash_key`.
+        self.extra_sizes = sorted(set(cfg['simhash'].get('extra_sizes') or [])
+                                  - {self.simhash_size})
+        self.hash_size = max([self.simhash_size] + self.extra_sizes)
+        if self.hash_size > 512:
             raise Exception('do not support simhash longer than 512')
+        if any(size % 8 for size in [self.simhash_size] + self.extra_sizes):
+            raise Exception('simhash sizes must be multiples of 8')
+        self.extractor = get_extractor(cfg['simhash'].get('extractor'))
+        # stored with the simhashes, see `check_extractor`
+        self.meta = simhash_meta(cfg)
 
         headers = {'User-Agent': 'wayback-discover-diff',
                    'Accept-Encoding': 'gzip,deflate',
@@ -102,51 +187,126 @@ class Discover(Task):
         if cdx_auth_token:
             headers['cookie'] = 'cdx_auth_token=%s' % cdx_auth_token
 
-        self.http = urllib3.HTTPConnectionPool('web.archive.org', maxsize=50,
-                                               retries=2, timeout=20,
-                                               headers=headers)
-        self.redis = StrictRedis(
-            connection_pool=BlockingConnectionPool.from_url(
-                **cfg['redis']
-                )
-            )
+        # CDX queries and capture downloads are balanced over the replicas
+        # configured in `upstream`, see upstream.py.
+        (self.cdx, self.playback) = get_upstreams(cfg, headers)
+        self.redis = get_redis(cfg)
         self.tpool = ThreadPoolExecutor(max_workers=cfg['threads'])
+        # Throughput and downloads in progress, see capacity.py. They are
+        # only written to Redis if the `Capacity` task prunes them.
+        capacity_conf = cfg.get('capacity')
+        self.track_capacity = bool(capacity_conf)
+        self.worker_stats = WorkerStats(
+            cfg['threads'], (capacity_conf or {}).get('worker_expire', 60))
         self.snapshots_number = cfg['snapshots']['number_per_year']
+        # Results are written to Redis in batches of `flush_every` simhashes
+        # or every `flush_interval` seconds, whichever comes first, so that
+        # partial results are visible while the job is running.
+        self.flush_every = cfg['simhash'].get('flush_every', 500)
+        self.flush_interval = cfg['simhash'].get('flush_interval', 10)
+        # The job pending marker expires if it is not refreshed by a flush,
+        # e.g. when the worker has crashed.
+        self.pending_expire = cfg['simhash'].get('pending_expire', 600)
+        # The job key deduplicates jobs while they are queued or running.
+        # Once the job runs, it expires `pending_expire` seconds after the
+        # last flush, so that a killed worker does not block new jobs.
+        self.job_expire = job_expire(cfg)
+        self.heartbeat_expire = self.pending_expire
+        self.progress_interval = cfg['simhash'].get('progress_interval', 2)
+        # Digests of captures which are not text are remembered for
+        # `negative_expire` seconds and download errors for
+        # `negative_error_expire` seconds, so that jobs skip them.
+        self.negative_expire = cfg['simhash'].get('negative_expire', 604800)
+        self.negative_error_expire = cfg['simhash'].get('negative_error_expire',
+                                                        3600)
+        self.negative = {}
+        # Years with more than `chunk_size` captures are calculated by a chord
+        # of `DiscoverChunk` tasks, spread over all workers. 0 disables it.
+        self.chunk_size = cfg['simhash'].get('chunk_size', 0)
+        # Simhashes are also appended to the on-disk cold store, if any.
+        self.coldstore = get_coldstore(cfg)
+        self.progress = None
+        # Daily download limit of prewarm jobs, see prewarm.py.
+        self.download_budget = (cfg.get('prewarm') or {}).get('download_budget',
+                                                             100000)
+        self.budget = None
         self.download_errors = 0
         # Initialize logger
         self._log = logging.getLogger('wayback_discover_diff.worker')
 
-    def download_capture(self, ts):
+    def download_capture(self, ts, digest=None):
         """Download capture data from the WBM and update job status. Return
-        data only when its text or html. On download error, increment download_errors
-        which will stop the task after 10 errors. Fetch data up to a limit
-        to avoid getting too much (which is unnecessary) and have a consistent
-        operation time.
+        data only when its text or html. On download error or error status,
+        increment download_errors which will stop the task after 10 errors.
+        Fetch data up to a limit to avoid getting too much (which is
+        unnecessary) and have a consistent operation time. Captures which are
+        not text and download errors are added to the negative cache if
+        `digest` is given.
         """
         try:
             statsd_incr('download-capture')
             self._log.info('fetching capture %s %s', ts, self.url)
-            res = self.http.request('GET', '/web/{}id_/{}'.format(ts, self.url),
-                                    preload_content=False)
-            data = res.read(self.max_capture_download)
-            ctype = res.headers.get('content-type')
+            # The request returns once the headers are received, the body is
+            # read afterwards.
+            with timing('download-ttfb'):
+                res = self.playback.request('GET', '/web/{}id_/{}'.format(ts, self.url),
+                                        preload_content=False)
+            if not 200 <= res.status < 300:
+                # error page of the WBM or of all the playback replicas
+                res.drain_conn()
+                res.release_conn()
+                self.download_errors += 1
+                statsd_incr('download-error')
+                self._log.error('cannot fetch capture %s %s, status %d', ts,
+                                self.url, res.status)
+                self.add_negative(digest, 'status:%d' % res.status,
+                                  self.negative_error_expire)
+                return None
+            ctype = (res.headers.get('content-type') or '').lower()
+            if "text" not in ctype and "html" not in ctype:
+                # do not download the body of other captures
+                res.close()
+                res.release_conn()
+                self.add_negative(digest, 'mimetype:%s' % ctype,
+                                  self.negative_expire)
+                return None
+            with timing('download-body'):
+                data = res.read(self.max_capture_download)
             res.release_conn()
-            if ctype:
-                ctype = ctype.lower()
-                if "text" in ctype or "html" in ctype:
-                    return data
+            return data
         except HTTPError:
             self.download_errors += 1
             statsd_incr('download-error')
             self._log.error('cannot fetch capture %s %s', ts, self.url, exc_info=1)
+            self.add_negative(digest, 'error', self.negative_error_expire)
         return None
 
-    def start_profiling(self, snapshot, index):
-        """Used for performance testing only.
+    def load_negative(self, captures):
+        """Load the negative cache entries of the digests of `captures` with
+        a single pipeline.
+        """
+        self.negative = {}
+        digests = list({capture.split(' ')[1] for capture in captures})
+        try:
+            pipe = self.redis.pipeline(transaction=False)
+            for digest in digests:
+                pipe.get(negative_key(digest))
+            self.negative = {digest: reason for digest, reason
+                             in zip(digests, pipe.execute()) if reason}
+        except RedisError:
+            self._log.error('cannot load negative cache for URL %s',
+                            self.url, exc_info=1)
+
+    def add_negative(self, digest, reason, expire):
+        """Remember that captures with `digest` have no simhash.
         """
-        cProfile.runctx('self.get_calc(snapshot, index)',
-                        globals=globals(), locals=locals(),
-                        filename='profile.prof')
+        if digest is None:
+            return
+        try:
+            self.redis.set(negative_key(digest), reason, ex=expire)
+        except RedisError:
+            self._log.error('cannot update negative cache for URL %s',
+                            self.url, exc_info=1)
 
     def get_calc(self, capture):
         """if a capture with an equal digest has been already processed,
@@ -155,95 +315,435 @@ class Discover(Task):
         If there are already too many download failures, return None without
         any processing to avoid pointless requests.
         Return None if any problem occurs (e.g. HTTP error or cannot calculate)
+        else `(timestamp, simhash, {extra size: simhash})`.
         """
         (timestamp, digest) = capture.split(' ')
-        simhash_enc = self.seen.get(digest)
-        if simhash_enc:
+        seen = self.seen.get(digest)
+        if seen:
             self._log.info("already seen %s", digest)
-            return (timestamp, simhash_enc)
+            self.progress.incr('cached')
+            return (timestamp,) + seen
 
         if self.download_errors >= self.max_download_errors:
             statsd_incr('multiple-consecutive-errors')
             self._log.error('%d consecutive download errors fetching %s captures',
                             self.download_errors, self.url)
+            self.progress.incr('failed')
             return None
 
-        response_data = self.download_capture(timestamp)
+        if digest in self.negative:
+            statsd_incr('download-skipped')
+            self.progress.incr('failed')
+            return None
+
+        if self.budget is not None and not self.budget.spend():
+            self.progress.incr('failed')
+            return None
+
+        with self.worker_stats.downloading():
+            response_data = self.download_capture(timestamp, digest)
         if response_data:
-            data = extract_html_features(response_data)
+            self.progress.incr('fetched')
+            data = self.extractor(response_data)
             if data:
                 statsd_incr('calculate-simhash')
                 self._log.info("calculating simhash")
-                simhash = calculate_simhash(data, self.simhash_size,
-                                            hashfunc=custom_hash_function)
+                with timing('hash'):
+                    simhash = calculate_simhash(data, self.hash_size,
+                                                hashfunc=custom_hash_function)
                 # This encoding is necessary to store simhash data in Redis.
-                simhash_enc = base64.b64encode(
-                    pack_simhash_to_bytes(simhash, self.simhash_size)
-                    )
-                self.seen[digest] = simhash_enc
-                return (timestamp, simhash_enc)
+                simhash_enc = encode_simhash(simhash, self.simhash_size)
+                extra = {size: encode_simhash(simhash, size)
+                         for size in self.extra_sizes}
+                self.seen[digest] = (simhash_enc, extra)
+                self.progress.incr('hashed')
+                return (timestamp, simhash_enc, extra)
+        self.progress.incr('failed')
         return None
 
-    def run(self, url, year, created):
-        """Run Celery Task.
+    def run(self, url, year, created, prewarm=False, from_ts=None, to_ts=None):
+        """Run Celery Task. Prewarm jobs only process the captures which are
+        not stored yet and count their downloads against the prewarm budget.
+        Range jobs process the captures from `from_ts` to `to_ts` instead of a
+        year, `year` is then the `FROM-TO` label of their job keys.
+        Years with more than `chunk_size` captures are split in chunks
+        calculated in parallel by `DiscoverChunk` tasks.
         """
         self.job_id = self.request.id
         self.url = url_fix(url)
-        time_started = datetime.now()
+        started = time()
         self._log.info('Start calculating simhashes.')
-        self.download_errors = 0
 
-        statsd_timing('task-wait', time() - created)
+        statsd_timing('task-wait', started - created)
         if not self.url:
             self._log.error('did not give url parameter')
             return {'status': 'error', 'info': 'URL is required.'}
         if not year:
             self._log.error('did not give year parameter')
             return {'status': 'error', 'info': 'Year is required.'}
+        self.progress = JobProgress(self.redis, self.job_id,
+                                    self.progress_interval, self.simhash_expire)
+        try:
+            return self.calculate(url, year, started, prewarm, from_ts, to_ts)
+        except Exception as exc:
+            # e.g. `task_soft_time_limit`, otherwise `/job` would report the
+            # job as PENDING until its progress expires
+            self.fail(surt(self.url), year, exc)
+            raise
+
+    def calculate(self, url, year, started, prewarm=False, from_ts=None,
+                  to_ts=None):
+        """Fetch the captures of the job and calculate their simhashes, or
+        start the chunks which calculate them.
+        """
         # fetch captures
-        self.update_state(state='PENDING',
-                          meta={'info': 'Fetching {} captures for year {}'.format(
-                                url, year)})
-        resp = self.fetch_cdx(url, year)
+        self.update_progress(
+            state='PENDING',
+            info='Fetching {} captures for year {}'.format(url, year))
+        resp = self.fetch_cdx(url, year, from_ts, to_ts)
         if resp.get('status') == 'error':
+            self.update_progress(state='error', info=resp.get('info'))
+            self.clear_pending(surt(self.url), year)
             return resp
         captures = resp.get('captures')
+        urlkey = surt(self.url)
+        self.check_extractor(urlkey)
+        if prewarm:
+            captures = self.new_captures(urlkey, year, captures)
         total = len(captures)
+        self.mark_pending(urlkey, year, total)
+        self.update_progress(total=total, info='')
+        if self.chunk_size and total > self.chunk_size:
+            return self.dispatch_chunks(url, year, captures, started, prewarm)
+        stored = self.process_captures(urlkey, year, captures, prewarm)
+        return self.finish(urlkey, year, stored, started)
+
+    def process_captures(self, urlkey, year, captures, prewarm=False):
+        """Calculate the simhashes of `captures` in parallel and write them to
+        Redis in batches. Return the number of simhashes written.
+        """
         self.seen = dict()
-        # calculate simhashes in parallel
-        i = 0
-        final_results = {}
-        for res in self.tpool.map(self.get_calc, captures):
-            if not res:
-                continue
-            (timestamp, simhash) = res
-            if simhash:
-                final_results[timestamp] = simhash
-            if i % 10 == 0:
-                self.update_state(
-                    state='PENDING',
-                    meta={'info': 'Processed %d out of %d captures.' % (i, total)}
-                )
-            i += 1
+        self.download_errors = 0
+        self.load_negative(captures)
+        self.budget = None
+        if prewarm:
+            self.budget = DownloadBudget(self.redis, self.download_budget)
+        stored = 0
+        results = {}
+        extra = {size: {} for size in self.extra_sizes}
+        last_flush = time()
+        try:
+            for res in self.tpool.map(self.get_calc, captures):
+                self.worker_stats.captures += 1
+                if res:
+                    (timestamp, simhash, extra_simhashes) = res
+                    if simhash:
+                        results[timestamp] = simhash
+                        for size, extra_simhash in extra_simhashes.items():
+                            extra[size][timestamp] = extra_simhash
+                if (len(results) >= self.flush_every or
+                        time() - last_flush >= self.flush_interval):
+                    stored += self.flush_results(urlkey, year, results, extra)
+                    results = {}
+                    extra = {size: {} for size in self.extra_sizes}
+                    last_flush = time()
+                if self.progress.due():
+                    self.update_progress()
+        finally:
+            # Keep what has been calculated so far even if the task is
+            # interrupted, e.g. by `task_soft_time_limit`.
+            stored += self.flush_results(urlkey, year, results, extra)
+            if self.budget is not None:
+                self.flush_budget(urlkey)
+        return stored
+
+    def dispatch_chunks(self, url, year, captures, started, prewarm=False):
+        """Start a Celery chord of `DiscoverChunk` tasks, one per chunk of
+        captures, and a `DiscoverFinalize` callback which finishes the job
+        when all chunks are done, or `DiscoverFailed` if one fails. Progress
+        counters and the pending marker are shared by the chunks through the
+        job id.
+        """
+        chunks = split_captures(captures, self.chunk_size)
+        header = [self.app.signature('DiscoverChunk',
+                                     args=[url, year, self.job_id, chunk],
+                                     kwargs={'prewarm': prewarm})
+                  for chunk in chunks]
+        callback = self.app.signature('DiscoverFinalize',
+                                      args=[url, year, self.job_id, started])
+        # the callback does not run if a chunk fails
+        callback.link_error(self.app.signature(
+            'DiscoverFailed', args=[url, year, self.job_id]))
+        chord(header)(callback)
+        self.refresh_pending(surt(self.url), year)
+        statsd_incr('discover-chunks', len(chunks))
+        self._log.info('split %d captures of %s for year %s in %d chunks',
+                       len(captures), self.url, year, len(chunks))
+        return {'chunks': len(chunks)}
+
+    def finish(self, urlkey, year, stored, started):
+        """Remove the job pending marker, store the compressed captures of the
+        year and set the job state to SUCCESS.
+        """
+        self.clear_pending(urlkey, year)
+        self.store_compressed(urlkey, year)
 
         self._log.info('%d final results for %s and year %s.',
-                       len(final_results), self.url, year)
-        if final_results:
-            try:
-                urlkey = surt(self.url)
-                self.redis.hmset(urlkey, final_results)
-                self.redis.expire(urlkey, self.simhash_expire)
-            except RedisError as exc:
-                self._log.error('cannot write simhashes to Redis for URL %s',
-                                self.url, exc_info=1)
-
-        duration = (datetime.now() - time_started).seconds
+                       stored, self.url, year)
+
+        duration = int(time() - started)
         statsd_timing('task-duration', duration)
         self._log.info('Simhash calculation finished in %.2fsec.', duration)
+        self.update_progress(state='SUCCESS', duration=duration)
         return {'duration': str(duration)}
 
-    def fetch_cdx(self, url, year):
-        """Make a CDX query for timestamp and digest for a specific year.
+    def fail(self, urlkey, year, exc):
+        """Set the job state to error and remove its pending marker after an
+        unexpected exception.
+        """
+        self._log.error('simhash calculation of %s for year %s failed',
+                        self.url, year, exc_info=exc)
+        statsd_incr('task-failed')
+        self.update_progress(state='error',
+                             info='{}: {}'.format(type(exc).__name__, exc))
+        self.clear_pending(urlkey, year)
+
+    def check_extractor(self, urlkey):
+        """Delete the simhashes of the URL if they have been calculated with
+        another extractor or simhash size, or have no metadata, then record
+        the current ones.
+        """
+        try:
+            pipe = self.redis.pipeline(transaction=False)
+            if stale_simhashes(self.redis, urlkey, self.meta):
+                stored = self.redis.hgetall(meta_key(urlkey))
+                self._log.info('discarding simhashes of %s calculated with %s',
+                               self.url, stored or 'unknown extractor')
+                # the other years are calculated again when requested
+                years = {timestamp[:4] for timestamp in self.redis.hkeys(urlkey)}
+                sizes = {int(size) for size
+                         in (stored.get('extra_sizes') or '').split(',') if size}
+                pipe.delete(urlkey, timestamps_key(urlkey),
+                            *(compressed_key(urlkey, year) for year in years),
+                            *(simhash_key(urlkey, size)
+                              for size in sizes.union(self.extra_sizes)))
+                pipe.delete(meta_key(urlkey))
+            pipe.hmset(meta_key(urlkey), self.meta)
+            pipe.expire(meta_key(urlkey), self.simhash_expire)
+            pipe.execute()
+        except (RedisError, ValueError):
+            self._log.error('cannot check simhash metadata for URL %s',
+                            self.url, exc_info=1)
+
+    def new_captures(self, urlkey, year, captures):
+        """Return the captures of the year which are not stored in Redis.
+        """
+        try:
+            stored = set(year_timestamps(self.redis, urlkey, year) or [])
+        except RedisError:
+            self._log.error('cannot load stored simhashes for URL %s',
+                            self.url, exc_info=1)
+            return captures
+        return [capture for capture in captures
+                if capture.split(' ')[0] not in stored]
+
+    def flush_budget(self, urlkey):
+        """Count the last downloads of a prewarm job and keep the stored
+        simhashes which have not been recalculated.
+        """
+        try:
+            self.budget.flush()
+            pipe = self.redis.pipeline(transaction=False)
+            for size in [None] + self.extra_sizes:
+                pipe.expire(simhash_key(urlkey, size), self.simhash_expire)
+            pipe.expire(timestamps_key(urlkey), self.simhash_expire)
+            pipe.execute()
+        except RedisError:
+            self._log.error('cannot update prewarm budget for URL %s',
+                            self.url, exc_info=1)
+
+    def update_progress(self, **fields):
+        """Update job progress info read by `/job` and the worker stats.
+        """
+        try:
+            self.progress.update(**fields)
+            if self.track_capacity:
+                self.worker_stats.flush(self.redis)
+        except RedisError:
+            self._log.error('cannot update job progress in Redis for URL %s',
+                            self.url, exc_info=1)
+
+    def mark_pending(self, urlkey, year, total):
+        """Mark the job for URL & year as incomplete until the final flush.
+        `/simhash` uses this marker to report PENDING status and partial
+        results.
+        """
+        try:
+            key = pending_key(urlkey, year)
+            pipe = self.redis.pipeline(transaction=False)
+            pipe.delete(key, compressed_key(urlkey, year))
+            pipe.hmset(key, {'job_id': self.job_id, 'total': total,
+                             'stored': 0})
+            pipe.expire(key, self.pending_expire)
+            pipe.set(job_key(urlkey, year), self.job_id,
+                     ex=self.heartbeat_expire)
+            if self.track_capacity:
+                job_started(pipe, self.job_id)
+            pipe.execute()
+        except RedisError:
+            self._log.error('cannot mark job pending in Redis for URL %s',
+                            self.url, exc_info=1)
+
+    def refresh_pending(self, urlkey, year):
+        """Keep the job pending marker and job id until the queued chunks of
+        the job run.
+        """
+        try:
+            pipe = self.redis.pipeline(transaction=False)
+            pipe.expire(pending_key(urlkey, year), self.job_expire)
+            pipe.expire(job_key(urlkey, year), self.job_expire)
+            pipe.execute()
+        except RedisError:
+            self._log.error('cannot refresh job pending marker in Redis for URL %s',
+                            self.url, exc_info=1)
+
+    def heartbeat(self, urlkey, year):
+        """Refresh the job pending marker and job key of a running job which
+        has no simhashes to flush, e.g. while its downloads are slow.
+        """
+        try:
+            pipe = self.redis.pipeline(transaction=False)
+            pipe.expire(pending_key(urlkey, year), self.pending_expire)
+            pipe.expire(job_key(urlkey, year), self.heartbeat_expire)
+            pipe.execute()
+        except RedisError:
+            self._log.error('cannot refresh job pending marker in Redis for URL %s',
+                            self.url, exc_info=1)
+
+    def clear_pending(self, urlkey, year):
+        """Remove the job pending marker and job id after the final flush.
+        """
+        try:
+            pipe = self.redis.pipeline(transaction=False)
+            pipe.delete(pending_key(urlkey, year), job_key(urlkey, year))
+            if self.track_capacity:
+                job_finished(pipe, self.job_id)
+            pipe.execute()
+        except RedisError:
+            self._log.error('cannot clear job pending marker in Redis for URL %s',
+                            self.url, exc_info=1)
+
+    def flush_results(self, urlkey, year, results, extra=None):
+        """Write a batch of simhashes, and the simhashes of the extra sizes
+        in `extra`, to Redis using a single pipeline and refresh the job
+        pending marker and job key. Return the number of simhashes written.
+        """
+        if not results:
+            self.heartbeat(urlkey, year)
+            return 0
+        try:
+            key = pending_key(urlkey, year)
+            pipe = self.redis.pipeline(transaction=False)
+            pipe.hmset(urlkey, results)
+            pipe.expire(urlkey, self.simhash_expire)
+            for size, simhashes in (extra or {}).items():
+                if simhashes:
+                    pipe.hmset(simhash_key(urlkey, size), simhashes)
+                    pipe.expire(simhash_key(urlkey, size), self.simhash_expire)
+            pipe.zadd(timestamps_key(urlkey),
+                      {timestamp: int(timestamp) for timestamp in results})
+            pipe.expire(timestamps_key(urlkey), self.simhash_expire)
+            pipe.expire(meta_key(urlkey), self.simhash_expire)
+            # the compressed captures are outdated
+            pipe.delete(*(compressed_key(urlkey, timestamp_year)
+                          for timestamp_year in {timestamp[:4]
+                                                 for timestamp in results}))
+            pipe.hincrby(key, 'stored', len(results))
+            pipe.expire(key, self.pending_expire)
+            pipe.expire(job_key(urlkey, year), self.heartbeat_expire)
+            with timing('redis-write'):
+                pipe.execute()
+        except RedisError:
+            self._log.error('cannot write simhashes to Redis for URL %s',
+                            self.url, exc_info=1)
+            return 0
+        self.append_cold(urlkey, results)
+        return len(results)
+
+    def store_compressed(self, urlkey, year):
+        """Store the compressed captures of the year returned by
+        `/simhash?compress=1`, so that the web app does not compute them on
+        every request. The data of a finished year do not change. Range jobs
+        (`year` is `FROM-TO`) only cover part of a year.
+        """
+        if not str(year).isdigit():
+            return
+        try:
+            timestamps = year_timestamps(self.redis, urlkey, year)
+            if not timestamps:
+                return
+            with timing('compress'):
+                simhashes = self.redis.hmget(urlkey, timestamps)
+                (captures, hashes) = compress_captures(zip(timestamps, simhashes))
+                key = compressed_key(urlkey, year)
+                pipe = self.redis.pipeline(transaction=False)
+                pipe.hmset(key, {
+                    'captures': json.dumps(captures, separators=(',', ':')),
+                    'hashes': json.dumps(hashes, separators=(',', ':')),
+                    'total_captures': len(timestamps)})
+                pipe.expire(key, self.simhash_expire)
+                pipe.execute()
+        except RedisError:
+            self._log.error('cannot store compressed simhashes in Redis for URL %s',
+                            self.url, exc_info=1)
+
+    def append_cold(self, urlkey, results):
+        """Append simhashes to the cold store if there is one.
+        """
+        if self.coldstore is None:
+            return
+        try:
+            with timing('cold-write'):
+                self.coldstore.append(urlkey, results)
+        except (OSError, ValueError):
+            self._log.error('cannot write simhashes to cold store for URL %s',
+                            self.url, exc_info=1)
+
+    def mark_no_captures(self, urlkey, year):
+        """Record that URL has no captures in `year`, with the simhash
+        metadata so that the marker is not stale.
+        """
+        self.check_extractor(urlkey)
+        pipe = self.redis.pipeline(transaction=False)
+        for size in [None] + self.extra_sizes:
+            pipe.hset(simhash_key(urlkey, size), year, -1)
+            pipe.expire(simhash_key(urlkey, size), self.simhash_expire)
+        pipe.execute()
+        self.append_cold(urlkey, {year: None})
+
+    def text_captures(self, cdx):
+        """Return the `timestamp digest` of the CDX lines `timestamp digest
+        mimetype` of captures which may be text or HTML.
+        """
+        captures = []
+        skipped = 0
+        for line in cdx.strip().split('\n'):
+            fields = line.split(' ')
+            if len(fields) < 2:
+                continue
+            if len(fields) > 2 and not is_text_mimetype(fields[2]):
+                skipped += 1
+                continue
+            captures.append('%s %s' % (fields[0], fields[1]))
+        if skipped:
+            statsd_incr('cdx-skipped-mimetype', skipped)
+            self._log.info('skipped %d captures of %s which are not text',
+                           skipped, self.url)
+        return captures
+
+    def fetch_cdx(self, url, year, from_ts=None, to_ts=None):
+        """Make a CDX query for timestamp and digest for a specific year, or
+        from `from_ts` to `to_ts`.
         """
         try:
             self._log.info('fetching CDX of %s for year %s', url, year)
@@ -252,27 +752,29 @@ class Discover(Task):
             # Its necessary to reduce the huge number of captures some websites
             # (e.g. twitter.com has 167k captures for 2018. Get only 2xx captures.
             fields = {'url': url, 'from': year, 'to': year,
-                      'statuscode': 200, 'fl': 'timestamp,digest',
+                      'statuscode': 200, 'fl': 'timestamp,digest,mimetype',
                       'collapse': 'timestamp:9'}
+            if from_ts and to_ts:
+                fields.update({'from': from_ts, 'to': to_ts})
             if self.snapshots_number != -1:
                 fields['limit'] = self.snapshots_number
-            response = self.http.request('GET', '/web/timemap', fields=fields)
+            with timing('cdx-fetch'):
+                response = self.cdx.request('GET', '/web/timemap', fields=fields)
             self._log.info('finished fetching timestamps of %s for year %s',
                            self, year)
             if response.status == 200:
-                if not response.data:
+                captures = self.text_captures(response.data.decode('utf-8'))
+                if not captures:
                     self._log.info('no captures found for %s %s', self, year)
-                    urlkey = surt(url)
-                    self.redis.hset(urlkey, year, -1)
-                    self.redis.expire(urlkey, self.simhash_expire)
+                    if not from_ts:
+                        self.mark_no_captures(surt(url), year)
                     return {'status': 'error',
                             'info': 'No captures of {} for year {}'.format(url, year)}
-                captures_txt = response.data.decode('utf-8')
-                captures = captures_txt.strip().split("\n")
-                if captures:
-                    return {'status': 'success', 'captures': captures}
-                return {'status': 'error',
-                        'info': 'No captures of {} for year {}'.format(url, year)}
+                return {'status': 'success', 'captures': captures}
+            self._log.error('CDX query for %s %s failed with status %d', url,
+                            year, response.status)
+            return {'status': 'error',
+                    'info': 'CDX query failed with status {}'.format(response.status)}
         except (ValueError, HTTPError) as exc:
             self._log.error('invalid CDX query response for %s %s', url, year,
                             exc_info=1)
@@ -281,3 +783,58 @@ class Discover(Task):
             self._log.error('error connecting with Redis for url %s year %s',
                             url, year, exc_info=1)
             return {'status': 'error', 'info': str(exc)}
+
+
+class DiscoverChunk(Discover):
+    """Calculate the simhashes of a chunk of the captures of a `Discover` job.
+    """
+    name = 'DiscoverChunk'
+
+    def __init__(self, cfg):
+        super().__init__(cfg)
+        # The other chunks of the job may wait in the queue meanwhile, the
+        # pending marker must outlive them.
+        self.pending_expire = self.job_expire
+
+    def run(self, url, year, job_id, captures, prewarm=False):
+        """Return the number of simhashes written.
+        """
+        self.job_id = job_id
+        self.url = url_fix(url)
+        self.progress = JobProgress(self.redis, job_id, self.progress_interval,
+                                    self.simhash_expire)
+        stored = self.process_captures(surt(self.url), year, captures, prewarm)
+        self.update_progress()
+        return stored
+
+
+class DiscoverFinalize(Discover):
+    """Chord callback finishing a `Discover` job split in chunks.
+    """
+    name = 'DiscoverFinalize'
+
+    def run(self, stored, url, year, job_id, started):
+        """`stored` is the list of results of the `DiscoverChunk` tasks.
+        """
+        self.job_id = job_id
+        self.url = url_fix(url)
+        self.progress = JobProgress(self.redis, job_id, self.progress_interval,
+                                    self.simhash_expire)
+        return self.finish(surt(self.url), year, sum(stored), started)
+
+
+class DiscoverFailed(Discover):
+    """Error callback of `DiscoverFinalize`, run when a chunk of a `Discover`
+    job failed.
+    """
+    name = 'DiscoverFailed'
+
+    def run(self, task_id, url, year, job_id):
+        """`task_id` is the id of the chord callback which did not run.
+        """
+        self.job_id = job_id
+        self.url = url_fix(url)
+        self.progress = JobProgress(self.redis, job_id, self.progress_interval,
+                                    self.simhash_expire)
+        self.fail(surt(self.url), year,
+                  ChordError('a chunk of job {} failed'.format(job_id)))
@@ -0,0 +1,177 @@
+"""Feature extractors turning an HTML capture into the weighted features of
+its simhash.
+
+The extractor is selected with `simhash.extractor` in conf.yml, either a name
+or a dict with a `name` and the options of the extractor:
+
+- `unigram`: count of each word of the visible text (default),
+- `shingle`: count of each sequence of `k` words, sensitive to word order,
+- `tag_weighted`: word counts where words in the title and headings count
+  `weights` times,
+- `boilerplate`: word counts without navigation, header, footer, aside and
+  form elements.
+
+Extractors iterate over the text nodes of the selectolax tree instead of
+building the whole text. The `signature` of an extractor (name, version and
+options) is stored with the simhashes of a URL so that simhashes calculated
+with different extractors are never mixed. Bump `version` when the features
+of an extractor change.
+"""
+import json
+import string
+from abc import ABC, abstractmethod
+from collections import Counter
+
+from .stats import timing
+
+
+TRANSLATOR = str.maketrans(string.punctuation, ' '*len(string.punctuation))
+
+EXTRACTORS = {}
+
+
+def register(cls):
+    """Register an extractor class by name.
+    """
+    EXTRACTORS[cls.name] = cls
+    return cls
+
+
+def words(text):
+    """Return the lowercase words of `text`, without punctuation.
+    """
+    return text.lower().translate(TRANSLATOR).split()
+
+
+def iter_words(root):
+    """Yield the words of the text nodes of the document `root`.
+    """
+    # `traverse` continues after the last child of a node, it is only used on
+    # the root.
+    for child in root.traverse(include_text=True):
+        if child.tag == '-text':
+            yield from words(child.text_content)
+
+
+def parse_html(html):
+    """Return the selectolax tree of `html`. selectolax is imported on first
+    use: the web app only needs the extractor signatures.
+    """
+    from selectolax.parser import HTMLParser  # pylint: disable=import-outside-toplevel
+    return HTMLParser(html)
+
+
+class Extractor(ABC):
+    """Base class of extractors. Subclasses implement `features`.
+    """
+    name = None
+    version = 1
+    # elements removed before extracting features
+    strip = ('script', 'style')
+
+    def __init__(self, **options):
+        self.options = options
+
+    @property
+    def signature(self):
+        """Return the identifier of the extractor and its options.
+        """
+        signature = '%s:%d' % (self.name, self.version)
+        if self.options:
+            signature += ':' + json.dumps(self.options, sort_keys=True,
+                                          separators=(',', ':'))
+        return signature
+
+    def __call__(self, html):
+        """Return a dict of features and their weights.
+        """
+        try:
+            with timing('parse'):
+                tree = parse_html(html)
+                tree.strip_tags(list(self.strip))
+            if tree.root is None:
+                return {}
+            with timing('features'):
+                return self.features(tree)
+        except UnicodeDecodeError:
+            return {}
+
+    @abstractmethod
+    def features(self, tree):
+        """Return a dict of the features of the selectolax `tree` and their
+        weights.
+        """
+
+
+@register
+class UnigramExtractor(Extractor):
+    """Count of each word.
+    """
+    name = 'unigram'
+
+    def features(self, tree):
+        return dict(Counter(iter_words(tree.root)))
+
+
+@register
+class ShingleExtractor(Extractor):
+    """Count of each sequence of `k` consecutive words.
+    """
+    name = 'shingle'
+
+    def __init__(self, k=3):
+        super().__init__(k=k)
+        self.k = k
+
+    def features(self, tree):
+        tokens = list(iter_words(tree.root))
+        if len(tokens) <= self.k:
+            return {' '.join(tokens): 1} if tokens else {}
+        return dict(Counter(' '.join(tokens[i:i + self.k])
+                            for i in range(len(tokens) - self.k + 1)))
+
+
+@register
+class TagWeightedExtractor(Extractor):
+    """Count of each word, words of the elements in `weights` count as many
+    times as their weight.
+    """
+    name = 'tag_weighted'
+    default_weights = {'title': 5, 'h1': 4, 'h2': 3, 'h3': 2}
+
+    def __init__(self, weights=None):
+        super().__init__(weights=weights or self.default_weights)
+        self.weights = weights or self.default_weights
+
+    def features(self, tree):
+        counts = Counter(iter_words(tree.root))
+        for tag, weight in self.weights.items():
+            for node in tree.css(tag):
+                for word in words(node.text(separator=' ')):
+                    counts[word] += weight - 1
+        return dict(counts)
+
+
+@register
+class BoilerplateExtractor(UnigramExtractor):
+    """Count of each word outside of navigation and page layout elements.
+    """
+    name = 'boilerplate'
+    strip = ('script', 'style', 'noscript', 'nav', 'header', 'footer',
+             'aside', 'form')
+
+
+def get_extractor(conf=None):
+    """Return the extractor configured by `conf`, a name or a dict with a name
+    and options.
+    """
+    if not conf:
+        conf = 'unigram'
+    if isinstance(conf, str):
+        conf = {'name': conf}
+    options = dict(conf)
+    name = options.pop('name', 'unigram')
+    try:
+        return EXTRACTORS[name](**options)
+    except (KeyError, TypeError) as exc:
+        raise ValueError('invalid feature extractor %s' % conf) from exc
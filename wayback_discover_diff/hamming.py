@@ -0,0 +1,101 @@
+"""Vectorized Hamming distances between simhashes.
+
+Simhashes are decoded into a 2D `uint8` NumPy array, one row of simhash bytes
+per capture, and compared with XOR and popcount over 64 bit words with
+`np.bitwise_count` (NumPy 2) when available, else over 16 bit words with a
+lookup table. NumPy is an optional dependency:
+`pip install wayback-discover-diff[hamming]`.
+
+    hashes = decode_simhashes(simhash for _, simhash in captures)
+    distances = consecutive(hashes)
+"""
+from binascii import a2b_base64
+import numpy as np
+
+
+POPCOUNT_TABLE = np.array([bin(i).count('1') for i in range(256)],
+                          dtype=np.uint8)
+# 16 bit table, used for simhashes of an even number of bytes
+POPCOUNT_TABLE16 = (POPCOUNT_TABLE[np.arange(1 << 16) & 0xff] +
+                    POPCOUNT_TABLE[np.arange(1 << 16) >> 8])
+# Max number of XORed words computed at once by `pairwise`.
+BLOCK_WORDS = 1 << 22
+
+
+def decode_simhashes(simhashes):
+    """Decode base64 simhashes of the same size into an array of shape
+    `(count, simhash bytes)`.
+    """
+    raw = [a2b_base64(simhash) for simhash in simhashes]
+    size = len(raw[0]) if raw else 0
+    if any(len(simhash) != size for simhash in raw):
+        raise ValueError('simhashes of different sizes')
+    return np.frombuffer(b''.join(raw), dtype=np.uint8).reshape(len(raw), size)
+
+
+def lookup_popcount(words):
+    """Return the number of bits set in each element of `words` with a byte
+    lookup table.
+    """
+    if words.dtype == np.uint8:
+        return POPCOUNT_TABLE[words]
+    if words.dtype == np.uint16:
+        return POPCOUNT_TABLE16[words]
+    counts = POPCOUNT_TABLE[words.view(np.uint8)]
+    return counts.reshape(words.shape + (-1,)).sum(axis=-1, dtype=np.uint8)
+
+
+_popcount = getattr(np, 'bitwise_count', lookup_popcount)
+
+
+def _words(hashes):
+    """View simhash rows as 64 bit words if their size allows it, or bytes
+    for the lookup table.
+    """
+    hashes = np.ascontiguousarray(hashes)
+    if _popcount is lookup_popcount:
+        if hashes.shape[-1] % 2 == 0:
+            return hashes.view(np.uint16)
+    elif hashes.shape[-1] % 8 == 0:
+        return hashes.view(np.uint64)
+    return hashes
+
+
+def _distance(xored):
+    """Sum the popcounts of the last axis of XORed simhashes.
+    """
+    return _popcount(xored).sum(axis=-1, dtype=np.uint16)
+
+
+def one_to_many(simhash, hashes):
+    """Return the distances between one simhash (a row) and each row of
+    `hashes`.
+    """
+    return _distance(_words(hashes) ^ _words(simhash.reshape(1, -1)))
+
+
+def consecutive(hashes):
+    """Return the distances between each row of `hashes` and the next one.
+    """
+    words = _words(hashes)
+    return _distance(words[1:] ^ words[:-1])
+
+
+def pairwise(hashes, others=None):
+    """Return the matrix of distances between each row of `hashes` and each
+    row of `others` (or `hashes`). Rows are processed in blocks to bound
+    memory use, one word of the simhashes at a time.
+    """
+    words = _words(hashes)
+    other_words = words if others is None else _words(others)
+    # one contiguous row per word
+    columns = np.ascontiguousarray(other_words.T)
+    result = np.empty((len(words), len(other_words)), dtype=np.uint16)
+    block = max(1, BLOCK_WORDS // max(1, len(other_words)))
+    for start in range(0, len(words), block):
+        rows = words[start:start + block]
+        distances = result[start:start + block]
+        distances[...] = 0
+        for i, column in enumerate(columns):
+            distances += _popcount(rows[:, i, np.newaxis] ^ column)
+    return result
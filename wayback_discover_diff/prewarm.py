@@ -0,0 +1,201 @@
+"""Pre-warm simhashes of popular URLs before they expire.
+
+The web app counts `/simhash` and `/calculate-simhash` requests per SURT URL
+key & year in daily sorted sets (`{popular}:YYYYMMDD`), so that variants of a
+URL count together, and keeps a requested URL of each key to start jobs. The
+`Prewarm` task, run periodically by Celery beat, starts incremental Discover
+jobs for the `top` most requested URL & years of the last `window_days` days
+which are not stored or expire in less than `refresh_before` seconds. Prewarm jobs only download new
+captures and stop when the daily download budget is spent.
+
+    celery -A wayback_discover_diff.worker.CELERY beat
+"""
+import logging
+import threading
+from datetime import datetime, timedelta, timezone
+from time import time
+from celery import Task
+from celery.utils import uuid
+from redis.exceptions import RedisError
+
+from .stats import statsd_incr
+from .storage import get_redis
+from .util import claim_job, job_expire, timestamps_key, url_key
+
+
+_logger = logging.getLogger('wayback_discover_diff.prewarm')
+
+
+def popular_key(day):
+    """Redis key of the request counts of `day` (a datetime). The hash tag
+    keeps the daily keys on the same node for ZUNIONSTORE.
+    """
+    return '{popular}:%s' % day.strftime('%Y%m%d')
+
+
+def popular_urls_key(day):
+    """Redis key of a requested URL of each URL key counted on `day`.
+    """
+    return '{popular}:urls:%s' % day.strftime('%Y%m%d')
+
+
+WINDOW_KEY = '{popular}:window'
+
+
+def budget_key(day):
+    """Redis key of the number of captures downloaded by prewarm jobs on
+    `day`.
+    """
+    return 'prewarm:downloads:%s' % day.strftime('%Y%m%d')
+
+
+def today():
+    """Return the current UTC datetime, day of the request and budget keys.
+    """
+    return datetime.now(timezone.utc)
+
+
+def track_request(redis, url, year, expire):
+    """Count a request for URL & year under the URL key. Errors are logged,
+    tracking must not fail requests.
+    """
+    try:
+        urlkey = url_key(url)
+        day = today()
+        pipe = redis.pipeline(transaction=False)
+        pipe.zincrby(popular_key(day), 1, '%s %s' % (year, urlkey))
+        pipe.expire(popular_key(day), expire)
+        pipe.hset(popular_urls_key(day), urlkey, url)
+        pipe.expire(popular_urls_key(day), expire)
+        pipe.execute()
+    except (RedisError, ValueError):
+        _logger.error('cannot track request of %s %s', url, year, exc_info=1)
+
+
+def top_requested(redis, count, days):
+    """Return the `count` most requested `(url, year)` of the last `days` days.
+    `url` is the latest requested URL of the URL key.
+    """
+    now = today()
+    days = [now - timedelta(days=i) for i in range(days)]
+    redis.zunionstore(WINDOW_KEY, [popular_key(day) for day in days])
+    members = [member.split(' ', 1)
+               for member in redis.zrevrange(WINDOW_KEY, 0, count - 1)]
+    pipe = redis.pipeline(transaction=False)
+    for _, urlkey in members:
+        for day in days:
+            pipe.hget(popular_urls_key(day), urlkey)
+    urls = pipe.execute()
+    top = []
+    for i, (year, _) in enumerate(members):
+        url = next((url for url in urls[i * len(days):(i + 1) * len(days)]
+                    if url), None)
+        if url:
+            top.append((url, int(year)))
+    return top
+
+
+class DownloadBudget:
+    """Daily limit of captures downloaded by prewarm jobs, shared by all
+    workers. Downloads are counted locally and added to the Redis counter
+    every `batch` downloads.
+    """
+
+    def __init__(self, redis, limit, batch=50):
+        self.redis = redis
+        self.limit = limit
+        self.batch = batch
+        self.key = budget_key(today())
+        self.pending = 0
+        self.exhausted = False
+        self._lock = threading.Lock()
+
+    def spent(self):
+        """Return the number of downloads counted in Redis today.
+        """
+        return int(self.redis.get(self.key) or 0)
+
+    def spend(self):
+        """Count a download. Return False if the budget is spent.
+        """
+        with self._lock:
+            if self.exhausted:
+                return False
+            self.pending += 1
+            if self.pending >= self.batch:
+                try:
+                    self.flush()
+                except RedisError:
+                    # keep counting locally until the next flush
+                    _logger.error('cannot update prewarm download budget',
+                                  exc_info=1)
+            return not self.exhausted
+
+    def flush(self):
+        """Add local downloads to the Redis counter.
+        """
+        if not self.pending:
+            return
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.incrby(self.key, self.pending)
+        pipe.expire(self.key, 2 * 86400)
+        (total, _) = pipe.execute()
+        self.pending = 0
+        if total >= self.limit:
+            self.exhausted = True
+
+
+class Prewarm(Task):
+    """Celery beat task starting prewarm jobs.
+    """
+    name = 'Prewarm'
+
+    def __init__(self, cfg):
+        conf = cfg.get('prewarm') or {}
+        self.top = conf.get('top', 100)
+        self.window_days = conf.get('window_days', 7)
+        self.refresh_before = conf.get('refresh_before', 3600)
+        self.download_budget = conf.get('download_budget', 100000)
+        self.job_expire = job_expire(cfg)
+        self.redis = get_redis(cfg)
+
+    def run(self):
+        """Start incremental Discover jobs for popular URL & years which
+        expire soon. Return the ids of the started jobs.
+        """
+        started = []
+        try:
+            budget = DownloadBudget(self.redis, self.download_budget)
+            if budget.spent() >= self.download_budget:
+                _logger.info('prewarm download budget is spent')
+                return started
+            top = top_requested(self.redis, self.top, self.window_days)
+            # one batch of reads, spread over the Redis nodes: whether the
+            # year is stored, a marker of no captures or a timestamp of the
+            # year, and the TTL of the simhashes
+            pipe = self.redis.pipeline(transaction=False)
+            for url, year in top:
+                urlkey = url_key(url)
+                pipe.hexists(urlkey, year)
+                pipe.zrangebyscore(timestamps_key(urlkey),
+                                   '%s0000000000' % year,
+                                   '%s9999999999' % year, start=0, num=1)
+                pipe.ttl(urlkey)
+            replies = pipe.execute()
+            for i, (url, year) in enumerate(top):
+                (no_captures, timestamps, ttl) = replies[3 * i:3 * i + 3]
+                # -1: no expiration, else expires later
+                if ((no_captures or timestamps) and
+                        (ttl == -1 or ttl > self.refresh_before)):
+                    continue
+                job_id = uuid()
+                if claim_job(self.redis, url, year, job_id, self.job_expire):
+                    continue
+                self.app.send_task('Discover', args=[url, year, time()],
+                                   kwargs={'prewarm': True}, task_id=job_id)
+                statsd_incr('prewarm-job')
+                started.append(job_id)
+        except (RedisError, ValueError):
+            _logger.error('cannot prewarm popular simhashes', exc_info=1)
+        _logger.info('started %d prewarm jobs', len(started))
+        return started
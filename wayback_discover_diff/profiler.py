@@ -0,0 +1,227 @@
+"""On-demand sampling profiler for running worker and web processes.
+
+The profiler runs in a background thread only while active, sampling the
+stacks of all other threads every `interval` seconds, and writes the result
+in the collapsed stack format used by flamegraph tools
+(`frame;frame;frame count` per line) to
+`<output_dir>/<host>-<pid>-<label>-<time>.collapsed`. When it is not active
+it costs nothing besides a signal handler and an idle thread waiting for
+the signal. `output_dir` must be private to the service: it is created with
+mode 0700 and rejected if it is a symlink or belongs to another user.
+
+It can be started:
+
+- by sending `signal` (SIGUSR2 by default) to a gunicorn or Celery worker
+  process,
+- with the `profile` Celery remote control command, e.g.
+  `celery -A wayback_discover_diff.worker.CELERY control profile 30`,
+  which signals all the pool processes of the workers,
+- with the `/admin/profile?seconds=N&token=T` endpoint of the web app, if
+  `profiler.admin_token` is configured.
+"""
+import logging
+import os
+import signal
+import socket
+import stat
+import sys
+import tempfile
+import threading
+from collections import Counter
+from time import sleep, strftime, time
+
+
+_logger = logging.getLogger(__name__)
+
+DEFAULT_OUTPUT_DIR = os.path.join(tempfile.gettempdir(),
+                                  'wayback-discover-diff-profiles')
+# Files are created, never overwritten, and symlinks are not followed.
+CREATE_FLAGS = os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_NOFOLLOW
+
+
+def private_dir(path):
+    """Create directory `path` readable by the current user only if needed.
+    Raise OSError if it is a symlink, not a directory or is not private.
+    """
+    try:
+        os.mkdir(path, 0o700)
+    except FileExistsError:
+        pass
+    info = os.lstat(path)
+    if (not stat.S_ISDIR(info.st_mode) or info.st_uid != os.getuid() or
+            info.st_mode & 0o077):
+        raise OSError('%s is not a private directory' % path)
+    return path
+
+
+class SamplingProfiler:
+    """Low overhead statistical profiler of the current process.
+    """
+
+    def __init__(self, output_dir=DEFAULT_OUTPUT_DIR, interval=0.005, seconds=30,
+                 max_seconds=600, label=None):
+        self.output_dir = output_dir
+        self.interval = interval
+        self.seconds = seconds
+        self.max_seconds = max_seconds
+        # callable returning a label for the output file, e.g. the current job
+        self.label = label
+        self._lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def running(self):
+        """Return True while a profile is in progress.
+        """
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, seconds=None):
+        """Start profiling for `seconds` in a background thread. Return the
+        path of the output file or None if a profile is already in progress.
+        """
+        seconds = min(seconds or self.seconds, self.max_seconds)
+        with self._lock:
+            if self.running:
+                return None
+            label = self.label() if self.label else None
+            path = os.path.join(self.output_dir, '%s-%d-%s-%s.collapsed' % (
+                socket.gethostname().split('.')[0], os.getpid(),
+                label or 'process', strftime('%Y%m%d%H%M%S')))
+            self._thread = threading.Thread(target=self._run,
+                                            args=(seconds, path),
+                                            name='sampling-profiler',
+                                            daemon=True)
+            self._thread.start()
+        _logger.info('profiling for %.1fsec to %s', seconds, path)
+        return path
+
+    def _run(self, seconds, path):
+        stacks = Counter()
+        own_id = threading.get_ident()
+        names = {}
+        end = time() + seconds
+        while time() < end:
+            for thread_id, frame in sys._current_frames().items():  # pylint: disable=protected-access
+                if thread_id != own_id:
+                    stacks[(thread_id, collapse_stack(frame))] += 1
+            sleep(self.interval)
+        for thread in threading.enumerate():
+            names[thread.ident] = thread.name
+        try:
+            private_dir(self.output_dir)
+            with os.fdopen(os.open(path, CREATE_FLAGS, 0o600), 'w') as out:
+                for (thread_id, stack), count in stacks.most_common():
+                    out.write('%s;%s %d\n' % (names.get(thread_id, thread_id),
+                                              stack, count))
+            _logger.info('wrote profile %s', path)
+        except OSError:
+            _logger.error('cannot write profile %s', path, exc_info=1)
+
+
+def collapse_stack(frame):
+    """Return the stack of `frame` from the outermost call, as
+    `func (file:line);func (file:line)`.
+    """
+    frames = []
+    while frame is not None:
+        code = frame.f_code
+        frames.append('%s (%s:%d)' % (code.co_name, code.co_filename,
+                                      code.co_firstlineno))
+        frame = frame.f_back
+    return ';'.join(reversed(frames))
+
+
+def request_path(profiler, pid):
+    """Path of the file used to pass the profile duration to process `pid`
+    along with the signal, in the private `requests` directory of
+    `output_dir`.
+    """
+    return os.path.join(profiler.output_dir, 'requests', '%d' % pid)
+
+
+def read_request(profiler):
+    """Return the profile duration requested for this process, if any.
+    """
+    path = request_path(profiler, os.getpid())
+    try:
+        private_dir(os.path.dirname(path))
+        with os.fdopen(os.open(path, os.O_RDONLY | os.O_NOFOLLOW)) as request:
+            seconds = float(request.read())
+        os.unlink(path)
+        return seconds
+    except (OSError, ValueError):
+        return None
+
+
+def install_signal_handler(profiler, signame='SIGUSR2'):
+    """Start `profiler` when the process receives signal `signame`. The
+    duration is read from the request file written by `signal_processes` if
+    any.
+
+    The handler only writes to a pipe, the profiler is started by a thread
+    reading it: the handler runs between two instructions of the main thread,
+    which may hold the locks of `SamplingProfiler.start` or of the logging
+    module.
+    """
+    (read_fd, write_fd) = os.pipe()
+    os.set_blocking(write_fd, False)
+
+    def wait_signals():
+        while os.read(read_fd, 1):
+            profiler.start(read_request(profiler))
+
+    def handler(signum, frame):
+        try:
+            os.write(write_fd, b'\0')
+        except BlockingIOError:
+            # a profile is already requested
+            pass
+
+    threading.Thread(target=wait_signals, name='profiler-signal',
+                     daemon=True).start()
+    signal.signal(getattr(signal, signame), handler)
+
+
+def signal_processes(profiler, pids, seconds=None, signame='SIGUSR2'):
+    """Ask processes `pids` to profile themselves for `seconds`. Return the
+    pids that were signaled.
+    """
+    signaled = []
+    for pid in pids:
+        try:
+            if seconds:
+                path = request_path(profiler, pid)
+                private_dir(profiler.output_dir)
+                private_dir(os.path.dirname(path))
+                try:
+                    # left by a process which was not signaled
+                    os.unlink(path)
+                except FileNotFoundError:
+                    pass
+                with os.fdopen(os.open(path, CREATE_FLAGS, 0o600), 'w') as request:
+                    request.write(str(seconds))
+            os.kill(pid, getattr(signal, signame))
+            signaled.append(pid)
+        except OSError:
+            _logger.error('cannot signal process %d to profile', pid, exc_info=1)
+    return signaled
+
+
+def register_control_command(profiler, signame='SIGUSR2'):
+    """Register the `profile` Celery remote control command. It profiles the
+    pool processes of the worker, where tasks run, or the worker process itself
+    with the solo and threads pools.
+    """
+    from celery.worker.control import control_command
+
+    @control_command(args=[('seconds', float)], signature='[seconds]')
+    def profile(state, seconds=None):
+        """Profile worker processes for N seconds."""
+        pids = state.consumer.pool.info.get('processes') or []
+        if pids:
+            pids = signal_processes(profiler, pids, seconds, signame)
+            return {'ok': 'profiling processes %s' % pids}
+        path = profiler.start(seconds)
+        if path is None:
+            return {'error': 'profile already in progress'}
+        return {'ok': 'profiling to %s' % path}
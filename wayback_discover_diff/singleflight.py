@@ -0,0 +1,51 @@
+"""Coalesce concurrent identical calls in a process.
+"""
+import threading
+
+from .stats import statsd_incr
+
+
+class SingleFlight:
+    """Run a single call at a time per key. Threads calling `do` with a key
+    already in flight wait for it and share its result (or exception).
+    """
+
+    def __init__(self, metric=None):
+        # statsd counter of coalesced calls
+        self.metric = metric
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, func, *args, **kwargs):
+        """Return `func(*args, **kwargs)` or the result of the same call in
+        flight for `key`.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+        if not leader:
+            if self.metric:
+                statsd_incr(self.metric)
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = func(*args, **kwargs)
+            return call.result
+        except Exception as exc:
+            call.error = exc
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
@@ -1,14 +1,28 @@
 """Statsd methods to record statistics.
+
+Timings are also kept in in-process histograms which can be exposed in the
+Prometheus text format (`/metrics` endpoint of the web app or
+`start_metrics_server` in workers) if `metrics.prometheus` is enabled.
 """
 import logging
+import random
 import socket
+import threading
+from bisect import bisect_left
 from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, HTTPServer
 from timeit import default_timer as time
 import statsd
 
 
 STATSD_CLIENT = statsd.StatsClient('localhost', 8125)
 
+# Fraction of stage timings which are measured, see `timing`.
+SAMPLE_RATE = 1.0
+
+# In-process histograms and counters, only when Prometheus metrics are enabled.
+REGISTRY = None
+
 
 def configure(host, port):
     """Confiugure StatsD client.
@@ -25,10 +39,22 @@ def configure(host, port):
                       port, prefix, str(exc))
 
 
+def configure_metrics(sample_rate=1.0, prometheus=False, port=None):
+    """Configure stage timings sampling and Prometheus metrics. `port` is only
+    used by workers, see `start_metrics_server`.
+    """
+    global SAMPLE_RATE, REGISTRY
+    SAMPLE_RATE = sample_rate
+    if prometheus and REGISTRY is None:
+        REGISTRY = Registry()
+
+
 def statsd_incr(metric, count=1):
     """Utility method to increment statsd metric.
     """
     STATSD_CLIENT.incr(metric, count)
+    if REGISTRY is not None:
+        REGISTRY.incr(metric, count)
 
 
 def statsd_timing(metric, dt_sec):
@@ -36,12 +62,139 @@ def statsd_timing(metric, dt_sec):
     the difference between two times), we must convert to millisec.
     """
     STATSD_CLIENT.timing(metric, int(dt_sec * 1000))
+    if REGISTRY is not None:
+        REGISTRY.observe(metric, dt_sec)
+
+
+def statsd_gauge(metric, value):
+    """Utility method to set statsd gauge metric.
+    """
+    STATSD_CLIENT.gauge(metric, value)
+    if REGISTRY is not None:
+        REGISTRY.set(metric, value)
+
+
+def sampled():
+    """Return True if the current operation should be timed, see
+    `SAMPLE_RATE`.
+    """
+    return SAMPLE_RATE >= 1 or random.random() < SAMPLE_RATE
 
 
 @contextmanager
 def timing(metric):
+    """Record the duration of the enclosed block as timing `metric`. Only a
+    `SAMPLE_RATE` fraction of calls are measured to keep the overhead low on
+    hot paths.
+    """
+    if not sampled():
+        yield
+        return
     t0 = time()
     try:
-        yield self
+        yield
     finally:
-        STATSD_CLIENT.timing(metric, int((time() - t0) * 1000))
+        statsd_timing(metric, time() - t0)
+
+
+class Registry:
+    """Thread-safe in-process histograms of timings (in seconds), event
+    counters and gauges, rendered in the Prometheus text exposition format.
+    """
+    buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+               2.5, 5.0, 10.0, 30.0, 60.0, 300.0, 1800.0)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.histograms = {}
+        self.counters = {}
+        self.gauges = {}
+
+    def observe(self, metric, value):
+        """Add a timing `value` in seconds to histogram `metric`.
+        """
+        with self._lock:
+            hist = self.histograms.get(metric)
+            if hist is None:
+                # one count per bucket plus +Inf, then sum
+                hist = self.histograms[metric] = [0] * (len(self.buckets) + 1) + [0.0]
+            hist[bisect_left(self.buckets, value)] += 1
+            hist[-1] += value
+
+    def incr(self, metric, count=1):
+        """Increment counter `metric`.
+        """
+        with self._lock:
+            self.counters[metric] = self.counters.get(metric, 0) + count
+
+    def set(self, metric, value):
+        """Set gauge `metric`.
+        """
+        with self._lock:
+            self.gauges[metric] = value
+
+    def render(self):
+        """Return all metrics in the Prometheus text format.
+        """
+        lines = []
+        with self._lock:
+            histograms = {k: list(v) for k, v in self.histograms.items()}
+            counters = dict(self.counters)
+            gauges = dict(self.gauges)
+        if histograms:
+            lines.append('# TYPE wayback_discover_diff_stage_seconds histogram')
+        for metric, hist in sorted(histograms.items()):
+            total = 0
+            for bound, count in zip(self.buckets + ('+Inf',), hist):
+                total += count
+                lines.append('wayback_discover_diff_stage_seconds_bucket'
+                             '{stage="%s",le="%s"} %d' % (metric, bound, total))
+            lines.append('wayback_discover_diff_stage_seconds_sum{stage="%s"} %f'
+                         % (metric, hist[-1]))
+            lines.append('wayback_discover_diff_stage_seconds_count{stage="%s"} %d'
+                         % (metric, total))
+        if counters:
+            lines.append('# TYPE wayback_discover_diff_events_total counter')
+        for metric, count in sorted(counters.items()):
+            lines.append('wayback_discover_diff_events_total{event="%s"} %d'
+                         % (metric, count))
+        if gauges:
+            lines.append('# TYPE wayback_discover_diff_gauge gauge')
+        for metric, value in sorted(gauges.items()):
+            lines.append('wayback_discover_diff_gauge{name="%s"} %s'
+                         % (metric, value))
+        return '\n'.join(lines) + '\n'
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """Serve `REGISTRY` metrics on any GET request.
+    """
+    def do_GET(self):
+        body = (REGISTRY.render() if REGISTRY is not None else '').encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        pass
+
+
+def start_metrics_server(port, max_tries=64):
+    """Serve Prometheus metrics over HTTP in a daemon thread. Worker processes
+    of the same host try successive ports starting from `port`. Return the
+    port used or None.
+    """
+    _logger = logging.getLogger(__name__)
+    for offset in range(max_tries):
+        try:
+            server = HTTPServer(('', port + offset), MetricsHandler)
+        except OSError:
+            continue
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        _logger.info('serving metrics on port %d', port + offset)
+        return port + offset
+    _logger.error('cannot serve metrics on ports %d-%d', port,
+                  port + max_tries - 1)
+    return None
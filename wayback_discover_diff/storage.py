@@ -0,0 +1,268 @@
+"""Redis storage of simhash data, on a single server, distributed over several
+servers with consistent hashing or on a Redis Cluster.
+
+The `redis` section of conf.yml configures a single server with `url`, a list
+of servers with `nodes` (their other settings are shared) or a Redis Cluster
+with `cluster: true`. All the keys of a URL are on the same node: the simhash
+hash is stored under the SURT urlkey and the derived keys (job, pending,
+compressed, meta) use the `{urlkey}` hash tag, so they are routed by the
+urlkey like in Redis Cluster.
+
+`ShardedRedis` supports the commands used by the web app and the workers.
+Its pipelines send one pipeline per node. After adding or removing a node,
+move the keys to their new node with
+
+    python -m wayback_discover_diff.storage rebalance
+
+which uses MIGRATE, so the simhashes and their expiration are kept.
+"""
+import argparse
+from bisect import bisect
+import hashlib
+import logging
+from redis import StrictRedis, BlockingConnectionPool
+from redis.cluster import RedisCluster
+
+from .util import load_config
+
+
+_logger = logging.getLogger('wayback_discover_diff.storage')
+
+# Commands whose first argument is the only key.
+SINGLE_KEY_COMMANDS = frozenset((
+    'get', 'set', 'incrby', 'expire', 'ttl', 'pttl', 'exists',
+    'hget', 'hset', 'hkeys', 'hmget', 'hgetall', 'hmset', 'hincrby', 'hdel',
+    'hscan', 'hscan_iter', 'zadd', 'zincrby', 'zrem', 'zrange', 'zrevrange',
+    'zrangebyscore', 'zremrangebyscore', 'zcard', 'zscore'))
+
+
+def key_tag(key):
+    """Return the part of `key` used to route it: the content of its first
+    `{...}` hash tag if it is not empty, else the whole key, like Redis
+    Cluster.
+    """
+    start = key.find('{')
+    if start != -1:
+        end = key.find('}', start + 1)
+        if end > start + 1:
+            return key[start + 1:end]
+    return key
+
+
+def ring_hash(value):
+    """Return the 64 bit position of `value` on the hash ring.
+    """
+    return int.from_bytes(hashlib.md5(value.encode('utf-8')).digest()[:8],
+                          byteorder='big')
+
+
+class HashRing:
+    """Consistent hash ring with `replicas` points per node. Adding a node
+    only moves the keys of about 1/N of the ring to it.
+    """
+
+    def __init__(self, names, replicas=160):
+        points = sorted((ring_hash('%s-%d' % (name, i)), name)
+                        for name in names for i in range(replicas))
+        self._hashes = [point for point, _ in points]
+        self._names = [name for _, name in points]
+
+    def get(self, key):
+        """Return the name of the node of `key`.
+        """
+        i = bisect(self._hashes, ring_hash(key_tag(key)))
+        return self._names[i % len(self._names)]
+
+
+class ShardedRedis:
+    """Redis client distributing keys over `nodes`, a dict of clients by
+    name. Node names (their URLs) must not change: they place the nodes on
+    the ring.
+    """
+
+    def __init__(self, nodes, replicas=160):
+        self.nodes = nodes
+        self.ring = HashRing(nodes, replicas)
+
+    def node(self, key):
+        """Return the client of the node of `key`.
+        """
+        return self.nodes[self.ring.get(key)]
+
+    def __getattr__(self, name):
+        if name not in SINGLE_KEY_COMMANDS:
+            raise AttributeError(name)
+
+        def command(key, *args, **kwargs):
+            return getattr(self.node(key), name)(key, *args, **kwargs)
+        return command
+
+    def delete(self, *keys):
+        deleted = 0
+        for node, node_keys in self.group(keys).items():
+            deleted += self.nodes[node].delete(*node_keys)
+        return deleted
+
+    def zunionstore(self, dest, keys, **kwargs):
+        if len(self.group([dest] + list(keys))) > 1:
+            raise ValueError('zunionstore keys must be on the same node, '
+                             'use a hash tag')
+        return self.node(dest).zunionstore(dest, keys, **kwargs)
+
+    def group(self, keys):
+        """Return `keys` grouped by node name.
+        """
+        grouped = {}
+        for key in keys:
+            grouped.setdefault(self.ring.get(key), []).append(key)
+        return grouped
+
+    def pipeline(self, transaction=False):
+        if transaction:
+            raise ValueError('transactions are not supported by ShardedRedis')
+        return ShardedPipeline(self)
+
+    def close(self):
+        for client in self.nodes.values():
+            client.close()
+
+
+class ShardedPipeline:
+    """Pipeline buffering commands until `execute`, which sends a pipeline to
+    each node involved and returns the results in the order of the commands.
+    """
+
+    def __init__(self, redis):
+        self.redis = redis
+        # (command, [(node, args, kwargs)]), several parts for multi-key
+        # commands spread over nodes
+        self.commands = []
+
+    def __getattr__(self, name):
+        if name not in SINGLE_KEY_COMMANDS:
+            raise AttributeError(name)
+
+        def buffered(key, *args, **kwargs):
+            self.commands.append((name, [(self.redis.ring.get(key),
+                                          (key,) + args, kwargs)]))
+            return self
+        return buffered
+
+    def delete(self, *keys):
+        self.commands.append(('delete', [(node, node_keys, {}) for node, node_keys
+                                         in self.redis.group(keys).items()]))
+        return self
+
+    def execute(self):
+        commands, self.commands = self.commands, []
+        pipes = {}
+        positions = []
+        for name, parts in commands:
+            command_positions = []
+            for node, args, kwargs in parts:
+                pipe = pipes.get(node)
+                if pipe is None:
+                    pipe = pipes[node] = [self.redis.nodes[node].pipeline(
+                        transaction=False), 0]
+                getattr(pipe[0], name)(*args, **kwargs)
+                command_positions.append((node, pipe[1]))
+                pipe[1] += 1
+            positions.append((name, command_positions))
+        results = {node: pipe.execute() for node, (pipe, _) in pipes.items()}
+        output = []
+        for name, command_positions in positions:
+            values = [results[node][i] for node, i in command_positions]
+            if name == 'delete':
+                output.append(sum(values))
+            else:
+                output.append(values[0])
+        return output
+
+
+def node_client(url, options):
+    """Return a client of the Redis server at `url`.
+    """
+    return StrictRedis(
+        connection_pool=BlockingConnectionPool.from_url(url, **options))
+
+
+def get_redis(cfg):
+    """Return the Redis client configured in the `redis` section of `cfg`.
+    """
+    options = dict(cfg['redis'])
+    url = options.pop('url', None)
+    nodes = options.pop('nodes', None)
+    replicas = options.pop('replicas', 160)
+    if options.pop('cluster', False):
+        # BlockingConnectionPool option
+        options.pop('timeout', None)
+        return RedisCluster.from_url(url, **options)
+    if nodes:
+        return ShardedRedis({node: node_client(node, options) for node in nodes},
+                            replicas)
+    return node_client(url, options)
+
+
+def migrate_address(client):
+    """Return the MIGRATE arguments of the server of `client`.
+    """
+    kwargs = client.connection_pool.connection_kwargs
+    return {'host': kwargs.get('host', 'localhost'),
+            'port': kwargs.get('port', 6379),
+            'destination_db': kwargs.get('db', 0),
+            'auth': kwargs.get('password')}
+
+
+def rebalance(redis, batch=100, timeout=5000, dry_run=False):
+    """Move the keys of each node of `redis` (a ShardedRedis) which belong to
+    another node to it. Return the number of keys moved.
+    """
+    moved = 0
+    for name, client in redis.nodes.items():
+        pending = {}
+        for key in client.scan_iter(count=batch):
+            if isinstance(key, bytes):
+                key = key.decode('utf-8')
+            owner = redis.ring.get(key)
+            if owner == name:
+                continue
+            keys = pending.setdefault(owner, [])
+            keys.append(key)
+            if len(keys) >= batch:
+                moved += _migrate(client, redis.nodes[owner], keys, timeout,
+                                  dry_run)
+                pending[owner] = []
+        for owner, keys in pending.items():
+            if keys:
+                moved += _migrate(client, redis.nodes[owner], keys, timeout,
+                                  dry_run)
+        _logger.info('rebalanced node %s', name)
+    return moved
+
+
+def _migrate(source, target, keys, timeout, dry_run):
+    if not dry_run:
+        source.migrate(keys=keys, timeout=timeout, replace=True,
+                       **migrate_address(target))
+    return len(keys)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Move Redis keys to their node after changing `redis.nodes`.')
+    parser.add_argument('command', choices=['rebalance'])
+    parser.add_argument('--batch', type=int, default=100,
+                        help='number of keys per MIGRATE')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='only count the keys to move')
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+    redis = get_redis(load_config())
+    if not isinstance(redis, ShardedRedis):
+        parser.error('`redis.nodes` is not configured')
+    moved = rebalance(redis, batch=args.batch, dry_run=args.dry_run)
+    _logger.info('%s %d keys', 'would move' if args.dry_run else 'moved', moved)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,136 @@
+"""HTTP clients of the upstream WBM services (CDX server and playback).
+
+Each service can have several replicas, configured in the `upstream` section
+of conf.yml. `UpstreamPool` keeps a keep-alive connection pool per replica,
+spreads requests over them round-robin and ejects a replica for
+`eject_seconds` after `fail_threshold` consecutive failures. A request which
+fails with a connection error or a 5xx response is retried on the next
+replica. Callers must check the status of the response returned by the last
+replica.
+"""
+import logging
+import threading
+from time import time
+from urllib.parse import urlsplit
+import urllib3
+from urllib3.exceptions import HTTPError
+from urllib3.util.retry import Retry
+
+from .stats import statsd_incr
+
+
+DEFAULT_ENDPOINT = 'http://web.archive.org'
+
+_logger = logging.getLogger('wayback_discover_diff.upstream')
+
+
+class Endpoint:
+    """Connection pool and health state of one replica.
+    """
+    def __init__(self, url, **pool_kw):
+        self.url = url
+        self.prefix = urlsplit(url).path.rstrip('/')
+        self.pool = urllib3.connection_from_url(url, **pool_kw)
+        self.failures = 0
+        self.ejected_until = 0
+
+
+class UpstreamPool:
+    """Load balance requests over replicas `endpoints` (base URLs, optionally
+    with a path prefix) of an upstream service.
+    """
+
+    def __init__(self, endpoints, maxsize=50, timeout=20, connect_timeout=None,
+                 retries=2, backoff_factor=0, fail_threshold=3,
+                 eject_seconds=30, headers=None, name='upstream'):
+        if not endpoints:
+            raise ValueError('no %s endpoints configured' % name)
+        self.name = name
+        self.fail_threshold = fail_threshold
+        self.eject_seconds = eject_seconds
+        pool_kw = {
+            'maxsize': maxsize,
+            'timeout': urllib3.Timeout(connect=connect_timeout or timeout,
+                                       read=timeout),
+            'retries': Retry(total=retries, backoff_factor=backoff_factor),
+            'headers': headers,
+            }
+        self.endpoints = [Endpoint(url, **pool_kw) for url in endpoints]
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def pick(self):
+        """Return the next healthy replica, round-robin. If all replicas are
+        ejected, return the one which would be readmitted first.
+        """
+        now = time()
+        with self._lock:
+            count = len(self.endpoints)
+            for i in range(count):
+                endpoint = self.endpoints[(self._next + i) % count]
+                if endpoint.ejected_until <= now:
+                    self._next = (self._next + i + 1) % count
+                    return endpoint
+            return min(self.endpoints, key=lambda e: e.ejected_until)
+
+    def mark(self, endpoint, ok):
+        """Record the outcome of a request to `endpoint`.
+        """
+        with self._lock:
+            if ok:
+                endpoint.failures = 0
+                return
+            endpoint.failures += 1
+            if endpoint.failures < self.fail_threshold:
+                return
+            endpoint.failures = 0
+            endpoint.ejected_until = time() + self.eject_seconds
+        statsd_incr('upstream-ejected')
+        _logger.warning('ejecting %s endpoint %s for %dsec', self.name,
+                        endpoint.url, self.eject_seconds)
+
+    def request(self, method, path, **kwargs):
+        """Make a request to a replica like `urllib3.HTTPConnectionPool.request`.
+        Connection errors and 5xx responses count as failures and are retried
+        once on each other replica. Raise the last connection error or return
+        the last 5xx response if all replicas fail.
+        """
+        error = None
+        attempts = len(self.endpoints)
+        for attempt in range(attempts):
+            endpoint = self.pick()
+            try:
+                response = endpoint.pool.request(method, endpoint.prefix + path,
+                                                 **kwargs)
+            except HTTPError as exc:
+                self.mark(endpoint, False)
+                error = exc
+                continue
+            ok = response.status < 500
+            self.mark(endpoint, ok)
+            if ok or attempt == attempts - 1:
+                return response
+            statsd_incr('upstream-retry-%s' % self.name)
+            _logger.warning('%s endpoint %s returned %d, retrying', self.name,
+                            endpoint.url, response.status)
+            # reuse the connection of a response which is not preloaded
+            response.drain_conn()
+            response.release_conn()
+            error = None
+        raise error
+
+
+def get_upstreams(cfg, headers=None):
+    """Return the `(cdx, playback)` upstream pools configured in `cfg`. Settings
+    of the `upstream` section can be overridden per service.
+    """
+    conf = dict(cfg.get('upstream') or {})
+    services = {name: dict(conf.pop(name, None) or {})
+                for name in ('cdx', 'playback')}
+    pools = []
+    for name, service in services.items():
+        settings = dict(conf, **service)
+        endpoints = settings.pop('endpoints', None) or [DEFAULT_ENDPOINT]
+        pools.append(UpstreamPool(endpoints, headers=headers, name=name,
+                                  **settings))
+    return tuple(pools)
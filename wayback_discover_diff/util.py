@@ -1,14 +1,22 @@
 """SPN Utility methods.
 """
 import logging
-from collections import defaultdict
 from math import ceil
 import os
 import re
 import yaml
 from redis.exceptions import RedisError
-from surt import surt
-import tldextract
+from werkzeug.urls import url_fix
+
+from .extractors import get_extractor
+
+
+def surt(url):
+    """Return the SURT of `url`. The surt package is imported on first use, it
+    loads tldextract and its public suffix list.
+    """
+    from surt import surt as _surt  # pylint: disable=import-outside-toplevel
+    return _surt(url)
 
 
 def load_config():
@@ -29,40 +37,322 @@ def load_config():
     return config
 
 
-def timestamp_simhash(redis, url, timestamp):
-    """Get stored simhash data from Redis for URL and timestamp
+def simhash_key(urlkey, size=None):
+    """Redis key of the simhashes of a URL: the urlkey for the default
+    simhash size or `{urlkey}:<size>` for the other sizes calculated by the
+    worker (`simhash.extra_sizes`).
+    """
+    if size is None:
+        return urlkey
+    return '{%s}:%d' % (urlkey, size)
+
+
+def timestamps_key(urlkey):
+    """Redis key of the time-ordered index of the capture timestamps stored
+    for a URL: a sorted set of timestamps scored by their numeric value.
+    """
+    return '{%s}:ts' % urlkey
+
+
+# Member of the timestamp index once the simhashes stored before the index
+# existed have been added, scored below every timestamp.
+INDEXED = 'indexed'
+
+
+def timestamp_bound(value, upper=False):
+    """Return the 14 digit timestamp of a `from` (or `to` if `upper`)
+    timestamp of any precision, e.g. `2019` is `20190000000000` or
+    `20199999999999`. Raise ValueError if it is not a timestamp.
+    """
+    if not value or not value.isdigit() or len(value) > 14:
+        raise ValueError('invalid timestamp %s' % value)
+    return value.ljust(14, '9' if upper else '0')
+
+
+def pending_key(urlkey, year):
+    """Redis key of the marker set while a job for URL & year is running.
+    Keys derived from the urlkey use it as hash tag to be stored on the node
+    of the URL simhashes, see storage.py.
+    """
+    return '{%s}:%s:pending' % (urlkey, year)
+
+
+def url_key(url):
+    """Return the SURT urlkey of the job keys of `url`, normalized like the
+    worker does.
+    """
+    return surt(url_fix(url))
+
+
+def pending_job(redis, url, year):
+    """Return info on the running job for URL & year, if any. Simhashes are
+    stored progressively, so `stored` is the number of captures available so
+    far out of `total`.
     """
+    try:
+        job = redis.hgetall(pending_key(url_key(url), year))
+        if job:
+            return {'job_id': job.get('job_id'),
+                    'stored': int(job.get('stored', 0)),
+                    'total': int(job.get('total', 0))}
+    except (RedisError, ValueError) as exc:
+        logging.error('error loading job status for url %s year %s (%s)',
+                      url, year, exc)
+    return None
+
+
+def meta_key(urlkey):
+    """Redis key of the extractor signature and simhash size used to
+    calculate the simhashes of a URL.
+    """
+    return '{%s}:meta' % urlkey
+
+
+def simhash_meta(cfg):
+    """Return the extractor signature and simhash sizes configured in `cfg`,
+    stored under `meta_key` with the simhashes of each URL.
+    """
+    conf = cfg.get('simhash') or {}
+    size = conf.get('size', 256)
+    meta = {'extractor': get_extractor(conf.get('extractor')).signature,
+            'size': size}
+    extra_sizes = sorted(set(conf.get('extra_sizes') or []) - {size})
+    if extra_sizes:
+        meta['extra_sizes'] = ','.join(map(str, extra_sizes))
+    return meta
+
+
+def meta_sizes(meta):
+    """Return the simhash sizes of `meta`, see `simhash_meta`: the default
+    size first, then the extra sizes.
+    """
+    return [int(meta['size'])] + [int(size) for size in
+                                  (meta.get('extra_sizes') or '').split(',')
+                                  if size]
+
+
+def meta_compatible(stored, meta):
+    """Return True if the simhash metadata `stored` in Redis matches `meta`.
+    """
+    return (stored.get('extractor') == meta['extractor'] and
+            str(stored.get('size')) == str(meta['size']) and
+            stored.get('extra_sizes') == meta.get('extra_sizes'))
+
+
+def stale_simhashes(redis, urlkey, meta):
+    """Return True if the simhashes of `urlkey` have been calculated with
+    another extractor or simhash sizes than `meta`, or have no metadata.
+    Markers of years without captures do not depend on the extractor.
+    `meta` None skips the check.
+    """
+    if meta is None:
+        return False
+    stored = redis.hgetall(meta_key(urlkey))
+    if stored:
+        return not meta_compatible(stored, meta)
+    return any(len(field) != 4 for field, _ in redis.hscan_iter(urlkey))
+
+
+def job_key(urlkey, year):
+    """Redis key of the id of the job queued or running for URL & year.
+    """
+    return '{%s}:%s:job' % (urlkey, year)
+
+
+def job_expire(cfg):
+    """Return the TTL of the key of a queued or running job: it may wait
+    `simhash.queue_timeout` seconds in the queue, then run until the task
+    soft time limit.
+    """
+    return ((cfg.get('simhash') or {}).get('queue_timeout', 3600) +
+            (cfg.get('celery') or {}).get('task_soft_time_limit', 7200))
+
+
+def claim_job(redis, url, year, job_id, expire):
+    """Register `job_id` as the job of URL & year with SET NX, so that
+    concurrent requests from all web processes start a single job. Return
+    the id of the job already registered or None if `job_id` was.
+    """
+    key = job_key(url_key(url), year)
+    for _ in range(2):
+        if redis.set(key, job_id, nx=True, ex=expire):
+            return None
+        existing = redis.get(key)
+        # else the key has just expired, try again
+        if existing:
+            return existing
+    return None
+
+
+def negative_key(digest):
+    """Redis key of the reason why captures with `digest` have no simhash,
+    e.g. they are not text or cannot be downloaded.
+    """
+    return 'neg:%s' % digest
+
+
+def progress_key(job_id):
+    """Redis key of the progress counters of a job.
+    """
+    return 'job:%s:progress' % job_id
+
+
+PROGRESS_COUNTERS = ('total', 'fetched', 'cached', 'hashed', 'failed')
+
+
+def job_progress(redis, job_id):
+    """Return the progress info of a job written by the worker or None if the
+    job has not started yet.
+    """
+    try:
+        progress = redis.hgetall(progress_key(job_id))
+        if progress:
+            for counter in PROGRESS_COUNTERS:
+                progress[counter] = int(progress.get(counter, 0))
+            return progress
+    except (RedisError, ValueError) as exc:
+        logging.error('error loading progress of job %s (%s)', job_id, exc)
+    return None
+
+
+def promote_from_cold(cold, redis, urlkey, year, end=None):
+    """Copy simhash data of `urlkey` and `year`, or from timestamp `year` to
+    `end` (14 digits), from the cold store into Redis. Return True if there
+    was any.
+    """
+    if cold is None:
+        return False
+    try:
+        if end is None:
+            return cold.promote_year(redis, urlkey, year)
+        return cold.promote(redis, urlkey, year, end)
+    except (OSError, ValueError) as exc:
+        logging.error('error loading cold simhash data for %s from %s to %s (%s)',
+                      urlkey, year, end or year, exc)
+    return False
+
+
+def timestamp_simhash(redis, url, timestamp, cold=None, size=None, meta=None):
+    """Get stored simhash data from Redis for URL and timestamp. On a miss,
+    look into the cold store if any. `size` selects another simhash size than
+    the default one, they are not in the cold store. Simhashes which do not
+    match `meta` are ignored, see `stale_simhashes`.
+    """
+    if size is not None:
+        cold = None
     try:
         if url and timestamp:
-            results = redis.hget(surt(url), timestamp)
-            if results:
-                return {'simhash': results}
-            results = redis.hget(surt(url), timestamp[:4])
-            if results:
-                return {'status': 'error', 'message': 'NO_CAPTURES'}
+            if stale_simhashes(redis, surt(url), meta):
+                return {'status': 'error', 'message': 'CAPTURE_NOT_FOUND'}
+            urlkey = simhash_key(surt(url), size)
+            for attempt in range(2):
+                results = redis.hget(urlkey, timestamp)
+                if results:
+                    return {'simhash': results}
+                results = redis.hget(urlkey, timestamp[:4])
+                if results:
+                    return {'status': 'error', 'message': 'NO_CAPTURES'}
+                if attempt or not promote_from_cold(cold, redis, urlkey,
+                                                    timestamp[:4]):
+                    break
     except RedisError as exc:
         logging.error('error loading simhash data for url %s timestamp %s (%s)',
                       url, timestamp, exc)
     return {'status': 'error', 'message': 'CAPTURE_NOT_FOUND'}
 
 
-def year_simhash(redis, url, year, page=None, snapshots_per_page=None):
-    """Get stored simhash data for url, year and page (optional).
+def year_timestamps(redis, urlkey, year):
+    """Return the timestamps of `urlkey` captures stored for `year` or None if
+    the year is marked without captures.
+    """
+    # TODO replace hkeys with hscan
+    timestamps = []
+    for timestamp in redis.hkeys(urlkey):
+        if timestamp == str(year):
+            return None
+        if timestamp[:4] == str(year):
+            timestamps.append(timestamp)
+    return timestamps
+
+
+def index_timestamps(redis, urlkey):
+    """Add the simhashes of `urlkey` stored before the timestamp index existed
+    to the index and mark it as complete.
+    """
+    timestamps = [timestamp for timestamp in redis.hkeys(urlkey)
+                  if len(timestamp) == 14]
+    key = timestamps_key(urlkey)
+    ttl = redis.ttl(urlkey)
+    pipe = redis.pipeline(transaction=False)
+    pipe.zadd(key, {INDEXED: -1})
+    for i in range(0, len(timestamps), 10000):
+        pipe.zadd(key, {timestamp: int(timestamp)
+                        for timestamp in timestamps[i:i + 10000]})
+    if ttl > 0:
+        pipe.expire(key, ttl)
+    pipe.execute()
+
+
+def range_simhash(redis, url, start, end, limit, cursor=None, size=None,
+                  meta=None, cold=None):
+    """Get stored simhash data for URL from `start` to `end` (14 digit
+    timestamps). Return `(captures, cursor)`: at most `limit` captures
+    after timestamp `cursor` and the cursor of the next page, if any. Cursors
+    are timestamps, so pages do not change when captures are added. If
+    nothing is stored for the URL, look into the cold store if any.
     """
+    if size is not None:
+        cold = None
+    try:
+        urlkey = surt(url)
+        if stale_simhashes(redis, urlkey, meta):
+            return {'status': 'error', 'message': 'NOT_CAPTURED'}
+        if (not redis.exists(urlkey) and
+                not promote_from_cold(cold, redis, urlkey, start, end)):
+            return {'status': 'error', 'message': 'NOT_CAPTURED'}
+        key = timestamps_key(urlkey)
+        # The index may only have the captures stored since it exists.
+        if redis.zscore(key, INDEXED) is None:
+            index_timestamps(redis, urlkey)
+        low = '(%s' % cursor if cursor else start
+        timestamps = redis.zrangebyscore(key, low, end, start=0, num=limit + 1)
+        next_cursor = None
+        if len(timestamps) > limit:
+            timestamps = timestamps[:limit]
+            next_cursor = timestamps[-1]
+        if not timestamps:
+            return ([], None)
+        simhashes = redis.hmget(simhash_key(urlkey, size), timestamps)
+        return ([[timestamp, simhash] for timestamp, simhash
+                 in zip(timestamps, simhashes) if simhash], next_cursor)
+    except RedisError as exc:
+        logging.error('error loading simhash data for url %s from %s to %s (%s)',
+                      url, start, end, exc)
+    return {'status': 'error', 'message': 'NOT_CAPTURED'}
+
+
+def year_simhash(redis, url, year, page=None, snapshots_per_page=None,
+                 cold=None, size=None, meta=None):
+    """Get stored simhash data for url, year and page (optional). On a miss,
+    look into the cold store if any. `size` selects another simhash size than
+    the default one. Simhashes which do not match `meta` are ignored.
+    """
+    if size is not None:
+        cold = None
     try:
         if url and year:
-            # TODO replace hkeys with hscan
-            results = redis.hkeys(surt(url))
-            if results:
-                timestamps_to_fetch = []
-                for timestamp in results:
-                    if timestamp == str(year):
-                        return {'status': 'error', 'message': 'NO_CAPTURES'}
-                    if timestamp[:4] == str(year):
-                        timestamps_to_fetch.append(timestamp)
-                if timestamps_to_fetch:
-                    return handle_results(redis, timestamps_to_fetch, url,
-                                          snapshots_per_page, page)
+            if stale_simhashes(redis, surt(url), meta):
+                return {'status': 'error', 'message': 'NOT_CAPTURED'}
+            urlkey = simhash_key(surt(url), size)
+            timestamps_to_fetch = year_timestamps(redis, urlkey, year)
+            if (timestamps_to_fetch == [] and
+                    promote_from_cold(cold, redis, urlkey, year)):
+                timestamps_to_fetch = year_timestamps(redis, urlkey, year)
+            if timestamps_to_fetch is None:
+                return {'status': 'error', 'message': 'NO_CAPTURES'}
+            if timestamps_to_fetch:
+                return handle_results(redis, timestamps_to_fetch, url,
+                                      snapshots_per_page, page, size)
             # TODO return empty result and NOT error.
     except RedisError as exc:
         logging.error('error loading simhash data for url %s year %s page %d (%s)',
@@ -71,7 +361,7 @@ def year_simhash(redis, url, year, page=None, snapshots_per_page=None):
 
 
 def handle_results(redis, timestamps_to_fetch, url, snapshots_per_page,
-                   page=None):
+                   page=None, size=None):
     """Utility method used by `year_simhash`
     """
     available_simhashes = []
@@ -84,7 +374,7 @@ def handle_results(redis, timestamps_to_fetch, url, snapshots_per_page,
         else:
             number_of_pages = 1
     try:
-        results = redis.hmget(surt(url), timestamps_to_fetch)
+        results = redis.hmget(simhash_key(surt(url), size), timestamps_to_fetch)
         # TODO this crashes because of simhash bytes
         for i, simhash in enumerate(results):
             available_simhashes.append([str(timestamps_to_fetch[i]), simhash])
@@ -101,8 +391,10 @@ EMAIL_RE = re.compile(r"(^[a-zA-Z0-9_.+-]+@[a-zA-Z0-9-]+\.[a-zA-Z0-9-.]+$)")
 
 
 def url_is_valid(url):
-    """URL validation.
+    """URL validation. tldextract is imported on first use, it loads the
+    public suffix list.
     """
+    import tldextract  # pylint: disable=import-outside-toplevel
     try:
         if not url:
             return False
@@ -117,27 +409,56 @@ def url_is_valid(url):
 def compress_captures(captures):
     """Input: [["20130603143716","NRyJrLc2FWA="],["20130402202841","FT6d7Jc3vWA="],...]
     Output:
-    Captures: [[2013, [06, [03, ['143716', 0]]],
-                      [04, [02, ['202841', 1]]]
+    Captures: [[2013, [04, [02, ['202841', 0]]],
+                      [06, [03, ['143716', 1]]]
               ]]
-    Hashes: ['NRyJrLc2FWA=', 'FT6d7Jc3vWA=']
-    """
-    hashdict = {}
-    grouped = defaultdict(lambda: defaultdict(lambda: defaultdict(list)))
-    for ts, simhash in captures:
-        year, month, day, hms = ts[0:4], ts[4:6], ts[6:8], ts[8:]
-        hashid = hashdict.get(simhash)
-        if hashid is None:
-            hashid = len(hashdict)
-            hashdict[simhash] = hashid
-        cap = [hms, hashid]
-        grouped[int(year)][int(month)][int(day)].append(cap)
-    new_captures = [
-        [y] + [
-            [m] + [
-                [d] + dc for d, dc in mc.items()
-            ] for m, mc in yc.items()
-        ] for y, yc in grouped.items()
-    ]
-    hashes = [hash for hash, hashid in sorted(hashdict.items(), key=lambda x: x[1])]
-    return (new_captures, hashes)
+    Hashes: ['FT6d7Jc3vWA=', 'NRyJrLc2FWA=']
+    Captures are grouped in a single pass over the sorted timestamps. The
+    `['pages', N]` entry of paginated captures is kept first.
+    """
+    hashids = {}
+    new_captures = []
+    previous = ''
+    for ts, simhash in sorted(captures):
+        if ts == 'pages':
+            new_captures.insert(0, [ts, simhash])
+            continue
+        hashid = hashids.setdefault(simhash, len(hashids))
+        if ts[0:4] != previous[0:4]:
+            year = [int(ts[0:4])]
+            new_captures.append(year)
+        if ts[0:6] != previous[0:6]:
+            month = [int(ts[4:6])]
+            year.append(month)
+        if ts[0:8] != previous[0:8]:
+            day = [int(ts[6:8])]
+            month.append(day)
+        day.append([ts[8:], hashid])
+        previous = ts
+    return (new_captures, list(hashids))
+
+
+def compressed_key(urlkey, year):
+    """Redis key of the compressed captures of a year stored by the worker
+    when its job is finished.
+    """
+    return '{%s}:%s:compressed' % (urlkey, year)
+
+
+def compressed_year(redis, url, year, meta=None):
+    """Return the stored `/simhash?compress=1` JSON response for URL and year
+    or None if it has not been computed or does not match `meta`.
+    """
+    try:
+        if stale_simhashes(redis, surt(url), meta):
+            return None
+        stored = redis.hgetall(compressed_key(surt(url), year))
+        if stored:
+            return ('{"captures":%s,"hashes":%s,"status":"COMPLETE",'
+                    '"total_captures":%s}\n' % (stored['captures'],
+                                                stored['hashes'],
+                                                stored['total_captures']))
+    except (RedisError, KeyError) as exc:
+        logging.error('error loading compressed simhash data for url %s year %s (%s)',
+                      url, year, exc)
+    return None
@@ -1,19 +1,41 @@
 """Web endpoints
 """
+import gzip
+import hmac
+import json
 import logging
-from time import time
-import pkg_resources
+from functools import lru_cache
+from importlib.metadata import version as package_version
+from time import time, sleep
 from celery import states
 from celery.result import AsyncResult
+from celery.utils import uuid
 from celery.exceptions import CeleryError
-from flask import Flask, request
+from flask import Flask, Response, g, jsonify, request
 from redis.exceptions import RedisError
-from .stats import statsd_incr
-from .util import (year_simhash, timestamp_simhash, url_is_valid,
-                   compress_captures)
+try:
+    import brotli
+except ImportError:
+    brotli = None
+from . import columnar, stats
+from .capacity import get_snapshot
+from .prewarm import track_request
+from .singleflight import SingleFlight
+from .stats import statsd_incr, statsd_timing, timing
+from .util import (year_simhash, timestamp_simhash, range_simhash,
+                   url_is_valid, compress_captures, compressed_year,
+                   pending_job, job_progress, claim_job, job_key, job_expire,
+                   url_key, simhash_meta,
+                   timestamp_bound, PROGRESS_COUNTERS)
 
 APP = Flask(__name__, instance_relative_config=True)
 APP._logger = logging.getLogger('wayback_discover_diff.web')
+# On-disk cold tier consulted on Redis misses, see coldstore.py.
+APP.coldstore = None
+# Responses smaller than this are not worth compressing.
+MIN_COMPRESS_SIZE = 1024
+# Concurrent identical `/simhash` requests share one Redis fetch.
+READS = SingleFlight('get-simhash-coalesced')
 
 def get_app(config):
     """Utility method to set APP configuration. Its used by application.py.
@@ -23,32 +45,95 @@ def get_app(config):
     )
     APP.config.update(CELERYD_HIJACK_ROOT_LOGGER=False)
     APP.config.update(config)
+    # simhashes calculated with another extractor or sizes are not served
+    APP.meta = simhash_meta(config)
     return APP
 
 
-def get_active_task(url, year):
-    """Check for current simhash processing tasks for target url & year
+@APP.before_request
+def start_request_timer():
+    """Time a sample of requests, see `stats.timing`.
     """
-    try:
-        pending = APP.celery.control.inspect().active()
-        if pending:
-            for _, tasks in pending.items():
-                for task in tasks:
-                    args = task['args']
-                    if len(args) >= 2 and args[0] == url and args[1] == year:
-                        return task
-        return None
-    except RedisError:
-        # Redis connection timeout is quite common in production Celery.
-        return None
+    g.request_started = time() if stats.sampled() else None
+
+
+@APP.after_request
+def record_request_timer(response):
+    """Record the duration of sampled requests per endpoint.
+    """
+    started = g.get('request_started')
+    if started is not None and request.endpoint:
+        statsd_timing('web-request.%s' % request.endpoint, time() - started)
+    return response
+
+
+@APP.after_request
+def compress_response(response):
+    """Compress responses with brotli (if installed) or gzip when the client
+    accepts it.
+    """
+    if (response.status_code != 200 or response.direct_passthrough or
+            response.is_streamed or 'Content-Encoding' in response.headers):
+        return response
+    response.vary.add('Accept-Encoding')
+    if brotli is not None and request.accept_encodings['br']:
+        encoding = 'br'
+    elif request.accept_encodings['gzip']:
+        encoding = 'gzip'
+    else:
+        return response
+    data = response.get_data()
+    if len(data) < MIN_COMPRESS_SIZE:
+        return response
+    with timing('web-compress'):
+        if encoding == 'br':
+            data = brotli.compress(data, quality=4)
+        else:
+            data = gzip.compress(data, compresslevel=5)
+    response.set_data(data)
+    response.headers['Content-Encoding'] = encoding
+    return response
+
+
+@APP.route('/metrics')
+def metrics():
+    """Return metrics in the Prometheus text format if enabled.
+    """
+    if stats.REGISTRY is None:
+        return Response('metrics are not enabled\n', status=404,
+                        mimetype='text/plain')
+    return Response(stats.REGISTRY.render(),
+                    mimetype='text/plain; version=0.0.4')
+
+
+@APP.route('/admin/profile')
+def admin_profile():
+    """Profile this web process for N seconds, see profiler.py. Only enabled
+    if `profiler.admin_token` is configured.
+    """
+    token = getattr(APP, 'profiler_token', None)
+    if not token or not hmac.compare_digest(request.args.get('token', ''),
+                                            token):
+        return Response('forbidden\n', status=403, mimetype='text/plain')
+    seconds = request.args.get('seconds', type=float)
+    path = APP.profiler.start(seconds)
+    if path is None:
+        return {'status': 'error', 'info': 'profile already in progress.'}
+    return {'status': 'started', 'file': path}
+
+
+@lru_cache(maxsize=1)
+def get_version():
+    """Return the installed package version, looked up once.
+    """
+    return package_version("wayback-discover-diff")
 
 
 @APP.route('/')
 def root():
     """Return info on the current package version.
     """
-    version = pkg_resources.require("wayback-discover-diff")[0].version
-    return "wayback-discover-diff service version: %s" % version
+    return "wayback-discover-diff service version: %s" % get_version()
 
 
 @APP.route('/simhash')
@@ -61,37 +146,75 @@ def simhash():
         url = request.args.get('url')
         if not url:
             return {'status': 'error', 'info': 'url param is required.'}
-        if not url_is_valid(url):
+        with timing('web-normalize'):
+            valid = url_is_valid(url)
+        if not valid:
             return {'status': 'error', 'info': 'invalid url format.'}
+        size = request.args.get('size', type=int)
+        if size is not None:
+            simhash_conf = APP.config.get('simhash') or {}
+            if size == simhash_conf.get('size', 256):
+                # stored under the urlkey
+                size = None
+            elif size not in (simhash_conf.get('extra_sizes') or []):
+                return {'status': 'error', 'info': 'invalid size param.'}
+        if 'from' in request.args or 'to' in request.args:
+            return simhash_range(url, size)
         timestamp = request.args.get('timestamp')
         if not timestamp:
             year = request.args.get('year', type=int)
             if not year:
                 return {'status': 'error', 'info': 'year param is required.'}
+            track_popularity(url, year)
             page = request.args.get('page', type=int)
+            columnar_format = request.accept_mimetypes.best_match(
+                ['application/json', columnar.MIMETYPE]) == columnar.MIMETYPE
+            compress = request.args.get('compress') in ['true', '1']
+            if compress and not page and not columnar_format and size is None:
+                # stored by the worker when the job finished
+                with timing('web-redis'):
+                    stored = compressed_year(APP.redis, url, year, APP.meta)
+                if stored:
+                    response = Response(stored, mimetype='application/json')
+                    response.vary.add('Accept')
+                    return response
             snapshots_per_page = APP.config.get('snapshots', {}).get('number_per_page')
-            results_tuple = year_simhash(APP.redis, url, year, page,
-                                         snapshots_per_page)
-            # check if year_simhash produced an error response and return it
-            if isinstance(results_tuple, dict):
-                return results_tuple
-            task = get_active_task(url, year)
+            with timing('web-redis'):
+                (results_tuple, job) = READS.do(
+                    (url, year, page, size), fetch_year, url, year, page,
+                    snapshots_per_page, size)
+                # check if year_simhash produced an error response and return it
+                if isinstance(results_tuple, dict):
+                    return results_tuple
 
             output = dict(captures=results_tuple[0],
                           total_captures=results_tuple[1],
-                          status='PENDING' if task else 'COMPLETE')
-            if request.args.get('compress') in ['true', '1']:
-                (captures, hashes) = compress_captures(output['captures'])
-                output['captures'] = captures
-                output['hashes'] = hashes
-            return output
-
-        results = timestamp_simhash(APP.redis, url, timestamp)
-        # check if timestamp_simhash produced an error response and return it
-        if isinstance(results, dict):
-            return results
-        task = get_active_task(url, timestamp[:4])
-        if task:
+                          status='PENDING' if job else 'COMPLETE')
+            if job:
+                # results are partial until the job finishes
+                output['job_id'] = job['job_id']
+                output['stored_captures'] = job['stored']
+                output['expected_captures'] = job['total']
+            with timing('web-serialize'):
+                if columnar_format:
+                    return columnar_response(output, year)
+                if compress:
+                    (captures, hashes) = compress_captures(output['captures'])
+                    output['captures'] = captures
+                    output['hashes'] = hashes
+                response = jsonify(output)
+                response.vary.add('Accept')
+                return response
+
+        with timing('web-redis'):
+            results = timestamp_simhash(APP.redis, url, timestamp,
+                                        cold=APP.coldstore, size=size,
+                                        meta=APP.meta)
+            # check if timestamp_simhash produced an error response and return it
+            if isinstance(results, dict):
+                return results
+            pending = pending_job(APP.redis, url, timestamp[:4])
+        if pending:
             return {'status': 'PENDING', 'captures': results}
         return {'status': 'COMPLETE', 'captures': results}
     except (ValueError, CeleryError) as exc:
@@ -99,9 +222,90 @@ def simhash():
         return {'status': 'error', 'info': 'Internal server error.'}
 
 
+def get_range():
+    """Return the 14 digit `from` and `to` timestamps of the request. Raise
+    ValueError if they are invalid.
+    """
+    start = timestamp_bound(request.args.get('from') or '0')
+    end = timestamp_bound(request.args.get('to') or '9', upper=True)
+    if start > end:
+        raise ValueError('invalid range %s-%s' % (start, end))
+    return (start, end)
+
+
+def simhash_range(url, size=None):
+    """Return the simhash data of URL from `from` to `to`, timestamps of any
+    precision, in pages of `limit` captures. The `cursor` of the response
+    gets the next page.
+    """
+    try:
+        (start, end) = get_range()
+        cursor = request.args.get('cursor')
+        if cursor:
+            timestamp_bound(cursor)
+    except ValueError:
+        return {'status': 'error', 'info': 'invalid from, to or cursor param.'}
+    per_page = APP.config.get('snapshots', {}).get('number_per_page') or 600
+    limit = min(request.args.get('limit', per_page, type=int), per_page)
+    if limit < 1:
+        return {'status': 'error', 'info': 'invalid limit param.'}
+    with timing('web-redis'):
+        results = range_simhash(APP.redis, url, start, end, limit, cursor,
+                                size, meta=APP.meta, cold=APP.coldstore)
+        if isinstance(results, dict):
+            return results
+        (captures, next_cursor) = results
+        # status of the job of the range and of the years of short ranges
+        years = range(int(start[:4]), int(end[:4]) + 1)
+        pending = (pending_job(APP.redis, url, '%s-%s' % (start, end)) or
+                   len(years) <= 10 and any(pending_job(APP.redis, url, year)
+                                            for year in years))
+    output = dict(captures=captures, total_captures=len(captures),
+                  status='PENDING' if pending else 'COMPLETE')
+    if next_cursor:
+        output['cursor'] = next_cursor
+    if request.args.get('compress') in ['true', '1']:
+        (output['captures'], output['hashes']) = compress_captures(captures)
+    return jsonify(output)
+
+
+def track_popularity(url, year):
+    """Count requests per URL & year for the prewarm task if enabled.
+    """
+    prewarm = APP.config.get('prewarm')
+    if prewarm:
+        track_request(APP.redis, url, year,
+                      (prewarm.get('window_days', 7) + 1) * 86400)
+
+
+def fetch_year(url, year, page, snapshots_per_page, size=None):
+    """Return the simhashes of URL & year and its pending job, if any.
+    """
+    results = year_simhash(APP.redis, url, year, page, snapshots_per_page,
+                           cold=APP.coldstore, size=size, meta=APP.meta)
+    if isinstance(results, dict):
+        return (results, None)
+    return (results, pending_job(APP.redis, url, year))
+
+
+def columnar_response(output, year):
+    """Return the captures of `year` in `output` in the columnar binary format,
+    see columnar.py. The other fields are sent as headers.
+    """
+    captures = output.pop('captures')
+    if captures and captures[0][0] == 'pages':
+        output['pages'] = captures[0][1]
+    response = Response(columnar.encode_captures(captures, year),
+                        mimetype=columnar.MIMETYPE)
+    for key, value in output.items():
+        response.headers['X-%s' % key.replace('_', '-').title()] = str(value)
+    response.vary.add('Accept')
+    return response
+
+
 @APP.route('/calculate-simhash')
 def request_url():
-    """Start simhash calculation for URL & year.
+    """Start simhash calculation for URL & year, or from `from` to `to`.
     Validate parameters url & timestamp before starting Celery task.
     """
     try:
@@ -111,17 +315,44 @@ def request_url():
             return {'status': 'error', 'info': 'url param is required.'}
         if not url_is_valid(url):
             return {'status': 'error', 'info': 'invalid url format.'}
-        year = request.args.get('year', type=int)
-        if not year:
-            return {'status': 'error', 'info': 'year param is required.'}
-        # see if there is an active job for this request
-        task = get_active_task(url, year)
-        if task:
-            return {'status': 'PENDING', 'job_id': task['id']}
-        res = APP.celery.tasks['Discover'].apply_async(
-            args=[url, year, time()]
-            )
-        return {'status': 'started', 'job_id': res.id}
+        kwargs = {}
+        if 'from' in request.args or 'to' in request.args:
+            # only calculate the captures of the range, `year` is the label
+            # of the job keys
+            try:
+                (start, end) = get_range()
+            except ValueError:
+                return {'status': 'error', 'info': 'invalid from or to param.'}
+            year = '%s-%s' % (start, end)
+            kwargs = {'from_ts': start, 'to_ts': end}
+        else:
+            year = request.args.get('year', type=int)
+            if not year:
+                return {'status': 'error', 'info': 'year param is required.'}
+            track_popularity(url, year)
+        # Register the job before sending it so that concurrent identical
+        # requests get the same job instead of starting another one.
+        job_id = uuid()
+        try:
+            existing = claim_job(APP.redis, url, year, job_id,
+                                 job_expire(APP.config))
+        except RedisError:
+            APP._logger.error('cannot register job of %s %s', url, year, exc_info=1)
+            existing = None
+        if existing:
+            statsd_incr('calculate-simhash-duplicate')
+            return {'status': 'PENDING', 'job_id': existing}
+        # The web app does not register the task, send it by name.
+        try:
+            APP.celery.send_task('Discover', args=[url, year, time()],
+                                 kwargs=kwargs, task_id=job_id)
+        except CeleryError:
+            try:
+                APP.redis.delete(job_key(url_key(url), year))
+            except RedisError:
+                pass
+            raise
+        return {'status': 'started', 'job_id': job_id}
     except CeleryError as exc:
         APP._logger.warning('Cannot calculate simhash of %s, %s', url,
                             year, exc_info=1)
@@ -132,6 +363,54 @@ def request_url():
         return {'status': 'error', 'info': 'year param must be numeric.'}
 
 
+def get_job_status(job_id):
+    """Return job status from the progress info written by the worker. Fall
+    back to the Celery result backend only for jobs without progress info,
+    e.g. not started yet or killed before writing it.
+    """
+    progress = job_progress(APP.redis, job_id)
+    if progress:
+        state = progress.get('state')
+        if state == 'error':
+            return {'status': 'error', 'job_id': job_id,
+                    'info': progress.get('info')}
+        if state == states.SUCCESS:
+            return {'status': state, 'job_id': job_id,
+                    'duration': progress.get('duration', 1)}
+        info = progress.get('info')
+        if not info:
+            processed = (progress['cached'] + progress['hashed'] +
+                         progress['failed'])
+            info = 'Processed %d out of %d captures.' % (processed,
+                                                         progress['total'])
+        output = {'status': states.PENDING, 'job_id': job_id, 'info': info}
+        for counter in PROGRESS_COUNTERS:
+            output[counter] = progress[counter]
+        return output
+
+    task = AsyncResult(job_id, app=APP.celery)
+    if task.state == states.PENDING:
+        if task.info:
+            info = task.info.get('info', 1)
+        else:
+            info = None
+        # job did not finish yet
+        return {'status': task.state, 'job_id': task.id, 'info': info}
+
+    if task.state in (states.FAILURE, states.REVOKED):
+        return {'status': 'error', 'job_id': task.id,
+                'info': 'Job {}.'.format(task.state.lower())}
+    if task.info and task.info.get('status', 0) == 'error':
+        # something went wrong in the background job
+        return {'info': task.info.get('info', 1), 'job_id': task.id,
+                'status': task.info.get('status', 0)}
+    if task.info:
+        duration = task.info.get('duration', 1)
+    else:
+        duration = 1
+    return {'status': task.state, 'job_id': task.id, 'duration': duration}
+
+
 @APP.route('/job')
 def job_status():
     """Return job status.
@@ -141,24 +420,55 @@ def job_status():
         job_id = request.args.get('job_id')
         if not job_id:
             return {'status': 'error', 'info': 'job_id param is required.'}
-        task = AsyncResult(job_id, app=APP.celery)
-        if task.state == states.PENDING:
-            if task.info:
-                info = task.info.get('info', 1)
-            else:
-                info = None
-            # job did not finish yet
-            return {'status': task.state, 'job_id': task.id, 'info': info}
-
-        if task.info and task.info.get('status', 0) == 'error':
-            # something went wrong in the background job
-            return {'info': task.info.get('info', 1), 'job_id': task.id,
-                    'status': task.info.get('status', 0)}
-        if task.info:
-            duration = task.info.get('duration', 1)
-        else:
-            duration = 1
-        return {'status': task.state, 'job_id': task.id, 'duration': duration}
+        return get_job_status(job_id)
     except (CeleryError, AttributeError) as exc:
         APP._logger.error('Cannot get job status of %s', job_id, exc_info=1)
         return {'status': 'error', 'info': 'Cannot get status.'}
+
+
+@APP.route('/job/stream')
+def job_status_stream():
+    """Stream job status as server-sent events until the job is finished or
+    `job_stream.timeout` expires. The stream holds a web worker, so keep the
+    timeout short; clients reconnect after `retry` ms, i.e. long polling.
+    """
+    statsd_incr('status-stream-request')
+    job_id = request.args.get('job_id')
+    if not job_id:
+        return {'status': 'error', 'info': 'job_id param is required.'}
+    stream_conf = APP.config.get('job_stream', {})
+    interval = stream_conf.get('interval', 1)
+    timeout = stream_conf.get('timeout', 20)
+
+    def events():
+        started = time()
+        yield 'retry: %d\n\n' % (interval * 1000)
+        while True:
+            try:
+                status = get_job_status(job_id)
+            except (CeleryError, AttributeError) as exc:
+                APP._logger.error('Cannot get job status of %s', job_id,
+                                  exc_info=1)
+                status = {'status': 'error', 'info': 'Cannot get status.'}
+            yield 'data: %s\n\n' % json.dumps(status)
+            if (status['status'] != states.PENDING or
+                    time() - started >= timeout):
+                break
+            sleep(interval)
+
+    return Response(events(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache'})
+
+
+@APP.route('/capacity')
+def capacity():
+    """Return the last capacity snapshot published by the `Capacity` task.
+    """
+    try:
+        snapshot = get_snapshot(APP.redis)
+    except (RedisError, ValueError):
+        APP._logger.error('Cannot get capacity snapshot', exc_info=1)
+        snapshot = None
+    if snapshot is None:
+        return {'status': 'error', 'info': 'capacity metrics are not available.'}
+    return snapshot
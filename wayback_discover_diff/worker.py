@@ -0,0 +1,78 @@
+"""worker.py -- Celery worker entry point, e.g.
+`celery -A wayback_discover_diff.worker.CELERY worker`.
+"""
+from celery import Celery
+from celery.signals import task_postrun, task_prerun, worker_process_init
+# loaded on first use by the extractors, import it before the pool forks
+import selectolax.parser  # pylint: disable=unused-import
+from wayback_discover_diff import stats
+from wayback_discover_diff.capacity import Capacity
+from wayback_discover_diff.application import (CFG, PROFILER, metrics_conf,
+                                                profiler_signal)
+from wayback_discover_diff.discover import (Discover, DiscoverChunk,
+                                             DiscoverFailed, DiscoverFinalize)
+from wayback_discover_diff.prewarm import Prewarm
+from wayback_discover_diff.profiler import (install_signal_handler,
+                                            register_control_command)
+
+# Init Celery app
+CELERY = Celery(**CFG['celery'])
+DISCOVER = Discover(CFG)
+CELERY.register_task(DISCOVER)
+# chunks of large years, see `simhash.chunk_size`
+CELERY.register_task(DiscoverChunk(CFG))
+CELERY.register_task(DiscoverFinalize(CFG))
+CELERY.register_task(DiscoverFailed(CFG))
+
+# Periodic tasks, run with `celery beat`
+beat_schedule = {}
+# Pre-warm popular URLs
+prewarm_conf = CFG.get('prewarm')
+if prewarm_conf:
+    CELERY.register_task(Prewarm(CFG))
+    beat_schedule['prewarm'] = {'task': 'Prewarm',
+                                'schedule': prewarm_conf.get('interval', 600)}
+# Capacity metrics used to scale workers
+capacity_conf = CFG.get('capacity')
+if capacity_conf:
+    CELERY.register_task(Capacity(CFG))
+    beat_schedule['capacity'] = {'task': 'Capacity',
+                                 'schedule': capacity_conf.get('interval', 30)}
+if beat_schedule:
+    CELERY.conf.beat_schedule = beat_schedule
+register_control_command(PROFILER, profiler_signal)
+# (task id, task) running in this process, see `running_job`
+RUNNING = {}
+
+
+@task_prerun.connect
+def task_started(task_id=None, task=None, **_):
+    RUNNING['task'] = (task_id, task)
+
+
+@task_postrun.connect
+def task_finished(**_):
+    RUNNING.pop('task', None)
+
+
+def running_job():
+    """Return the job id of the task running in this process, shared by the
+    chunks of a job, or its task id for tasks which are not part of a job.
+    """
+    if 'task' not in RUNNING:
+        return None
+    (task_id, task) = RUNNING['task']
+    return getattr(task, 'job_id', None) or task_id
+
+
+@worker_process_init.connect
+def init_worker_process(**_):
+    """Serve Prometheus metrics from each Celery worker process if enabled and
+    install the profiler signal handler.
+    """
+    port = (metrics_conf or {}).get('port')
+    if stats.REGISTRY is not None and port:
+        stats.start_metrics_server(port)
+    # label profiles with the job running in this process
+    PROFILER.label = running_job
+    install_signal_handler(PROFILER, profiler_signal)
@@ -0,0 +1,34 @@
+"""wsgi.py -- web application entry point, e.g. for gunicorn
+`wayback_discover_diff.wsgi:APP`.
+
+The web tier only sends tasks to Celery workers so it does not build the
+Discover task, its HTTP and thread pools.
+"""
+import os
+from celery import Celery
+from flask_cors import CORS
+from wayback_discover_diff.application import CFG, PROFILER, admin_token
+from wayback_discover_diff.coldstore import get_coldstore
+from wayback_discover_diff.storage import get_redis
+from wayback_discover_diff import web
+
+# Init Flask app
+APP = web.get_app(CFG)
+
+# Initialize CORS support
+cors = CFG.get('cors')
+if cors:
+    CORS(APP, origins=cors)
+
+# Initialize Celery, Redis and profiler
+APP.celery = Celery(**CFG['celery'])
+APP.profiler = PROFILER
+APP.profiler_token = admin_token
+APP.redis = get_redis(CFG)
+APP.coldstore = get_coldstore(CFG)
+
+# ensure  the instance folder exists
+try:
+    os.makedirs(APP.instance_path)
+except OSError:
+    pass